@@ -0,0 +1,278 @@
+"""
+Атомарная запись JSON-файлов данных бота
+
+Файл не переписывается на месте: данные пишутся во временный файл в том же
+каталоге, сбрасываются на диск (fsync) и подменяют старый файл одним rename.
+При сбое посреди записи на диске остается старая или новая версия целиком,
+а не пустой или обрезанный JSON, который потом чинят repair_system.py и quick_fix.py.
+
+GroupCommitWriter объединяет записи, пришедшие в течение GROUP_COMMIT_WINDOW:
+файлы пачки пишутся и сбрасываются на диск вместе, каталог синхронизируется один
+раз, а несколько записей одного файла сводятся к последней. Так remove_user,
+меняющий три списка, стоит одного раунда записи вместо трех перезаписей.
+Каждый файл пачки записывается независимо: ошибка записи одного файла не
+отменяет остальные, а сам файл остается в очереди и повторяется с растущей
+задержкой, пока запись не пройдет или его не заменит более новая запись.
+"""
+import os
+import json
+import atexit
+import logging
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать остальных записей пачки (в секундах)
+GROUP_COMMIT_WINDOW = 0.005
+# Задержка перед повтором неудавшейся записи (в секундах); каждая следующая вдвое больше
+WRITE_RETRY_BASE_DELAY = 0.5
+WRITE_RETRY_MAX_DELAY = 30
+
+
+def file_token(path):
+    """Возвращает признак версии файла (inode, размер, mtime_ns) или None, если файла нет"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _fsync_dir(directory):
+    """Сбрасывает на диск запись каталога (переименование файла); где так нельзя - пропускаем"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _stage(path, text):
+    """
+    Пишет текст во временный файл рядом с path и сбрасывает его на диск
+
+    :return: (путь временного файла, признак файла после подмены)
+    """
+    tmp_path = os.path.join(os.path.dirname(path) or ".",
+                            f".{os.path.basename(path)}.tmp.{os.getpid()}.{threading.get_ident()}")
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+    except Exception:
+        _remove_quietly(tmp_path)
+        raise
+    return tmp_path, (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _commit(files):
+    """
+    Атомарно записывает пачку файлов: временные файлы с fsync, rename, fsync каталогов
+
+    Каждый файл записывается независимо от остальных.
+
+    :param files: Пары (путь, текст)
+    :return: ({путь: признак записанной версии}, {путь: исключение} для файлов, которые записать не удалось)
+    """
+    staged = []
+    errors = {}
+    for path, text in files:
+        try:
+            staged.append((path,) + _stage(path, text))
+        except Exception as e:
+            errors[path] = e
+
+    tokens = {}
+    for path, tmp_path, token in staged:
+        try:
+            os.replace(tmp_path, path)
+        except Exception as e:
+            _remove_quietly(tmp_path)
+            errors[path] = e
+            continue
+        tokens[path] = token
+    for directory in {os.path.dirname(path) or "." for path in tokens}:
+        _fsync_dir(directory)
+    return tokens, errors
+
+
+def copy_file_atomic(src, dst):
+    """
+    Атомарно заменяет dst копией src (с правами и временем изменения, как shutil.copy2)
+
+    :param src: Исходный файл
+    :param dst: Целевой файл
+    """
+    tmp_path = os.path.join(os.path.dirname(dst) or ".",
+                            f".{os.path.basename(dst)}.tmp.{os.getpid()}.{threading.get_ident()}")
+    try:
+        with open(src, 'rb') as f_src, open(tmp_path, 'wb') as f_dst:
+            shutil.copyfileobj(f_src, f_dst)
+            f_dst.flush()
+            os.fsync(f_dst.fileno())
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(os.path.dirname(dst) or ".")
+
+
+def write_text_atomic(path, text):
+    """
+    Атомарно записывает текстовый файл и дожидается его сброса на диск
+
+    :param path: Путь к файлу
+    :param text: Содержимое
+    :return: признак записанной версии (см. file_token)
+    :raises OSError: если файл записать не удалось (старая версия остается на месте)
+    """
+    tokens, errors = _commit([(path, text)])
+    if path in errors:
+        raise errors[path]
+    return tokens[path]
+
+
+def write_json_atomic(path, data, indent=4):
+    """
+    Атомарно записывает JSON-файл и дожидается его сброса на диск
+
+    :param path: Путь к файлу
+    :param data: Данные
+    :param indent: Отступ JSON (None - в одну строку)
+    :return: признак записанной версии (см. file_token)
+    """
+    return write_text_atomic(path, json.dumps(data, ensure_ascii=False, indent=indent))
+
+
+class GroupCommitWriter:
+    """Фоновая атомарная запись файлов с объединением близких по времени записей"""
+
+    def __init__(self, window=GROUP_COMMIT_WINDOW):
+        self.window = window
+        self._cond = threading.Condition()
+        # Ждут записи и пишутся сейчас: путь -> (номер записи, текст)
+        self._queued = {}
+        self._writing = {}
+        # Последняя записанная версия: путь -> (номер записи, признак файла)
+        self._committed = {}
+        # Файлы, которые не удалось записать: путь -> (число неудачных попыток, ошибка),
+        # и время (monotonic), раньше которого запись не повторяется
+        self._failed = {}
+        self._retry_at = {}
+        self._ticket = 0
+        self._thread = None
+
+    def write(self, path, data, indent=4):
+        """
+        Ставит файл в запись. Данные сериализуются сразу, поэтому их можно менять после вызова
+
+        :param path: Путь к файлу
+        :param data: Данные
+        :param indent: Отступ JSON
+        :return: номер записи (см. committed)
+        """
+        text = json.dumps(data, ensure_ascii=False, indent=indent)
+        with self._cond:
+            self._ticket += 1
+            self._queued[path] = (self._ticket, text)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            self._cond.notify_all()
+            return self._ticket
+
+    def pending(self, path):
+        """True, если запись файла еще не дошла до диска (файл на диске старее данных в памяти)"""
+        with self._cond:
+            return path in self._queued or path in self._writing
+
+    def failed(self, path=None):
+        """
+        Возвращает ошибки записи, которая еще не удалась (файл ждет повтора)
+
+        :param path: Путь к файлу (None - все файлы)
+        :return: текст последней ошибки файла или None; без path - {путь: текст ошибки}
+        """
+        with self._cond:
+            if path is not None:
+                failure = self._failed.get(path)
+                return failure[1] if failure else None
+            return {failed_path: error for failed_path, (_, error) in self._failed.items()}
+
+    def committed(self, path):
+        """Возвращает (номер записи, признак файла) последней записанной версии или None"""
+        with self._cond:
+            return self._committed.get(path)
+
+    def flush(self, timeout=None):
+        """
+        Ждет, пока все поставленные записи дойдут до диска
+
+        Файлы, запись которых уже не удалась, не ждут повтора: они остаются в
+        очереди, а flush сообщает о неудаче.
+
+        :param timeout: Максимальное время ожидания в секундах
+        :return: True если все записи завершены, False по таймауту или если какие-то файлы записать не удалось
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not self._writing and all(path in self._failed for path in self._queued), timeout)
+            if self._failed:
+                logger.error(f"Не записаны файлы данных: {list(self._failed)}")
+            return not self._queued and not self._writing
+
+    def _due(self, now):
+        """Файлы очереди, которые можно писать сейчас (у неудавшихся выдерживается задержка повтора)"""
+        return [path for path in self._queued if self._retry_at.get(path, 0) <= now]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due(time.monotonic()):
+                    retry_at = [self._retry_at[path] for path in self._queued]
+                    self._cond.wait(min(retry_at) - time.monotonic() if retry_at else None)
+            # Даем догнать остальным записям пачки
+            time.sleep(self.window)
+            with self._cond:
+                batch = {path: self._queued.pop(path) for path in self._due(time.monotonic())}
+                self._writing = batch
+
+            tokens, errors = _commit((path, text) for path, (_, text) in batch.items())
+
+            with self._cond:
+                for path, token in tokens.items():
+                    self._committed[path] = (batch[path][0], token)
+                    self._failed.pop(path, None)
+                    self._retry_at.pop(path, None)
+                for path, error in errors.items():
+                    attempts = self._failed.get(path, (0, None))[0] + 1
+                    self._failed[path] = (attempts, str(error))
+                    self._retry_at[path] = time.monotonic() + min(
+                        WRITE_RETRY_MAX_DELAY, WRITE_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+                    # Более новая запись того же файла, поставленная во время записи, главнее
+                    if path not in self._queued:
+                        self._queued[path] = batch[path]
+                    logger.error(f"Ошибка при записи файла данных {path} (попытка {attempts}): {error}")
+                self._writing = {}
+                self._cond.notify_all()
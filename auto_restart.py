@@ -13,6 +13,9 @@ import signal
 import psutil
 from datetime import datetime
 
+from atomic_write import write_json_atomic
+from chat_store import chats_migrated
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -159,8 +162,7 @@ def start_bot():
                 size = os.path.getsize(BOT_COMMANDS_FILE)
                 if size == 0:
                     # Создаем пустой список команд
-                    with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-                        json.dump([], f)
+                    write_json_atomic(BOT_COMMANDS_FILE, [], indent=None)
                     return True, "Создан пустой список команд"
 
                 # Проверяем содержимое файла
@@ -168,8 +170,7 @@ def start_bot():
                     content = f.read().strip()
                     if not content:
                         # Создаем пустой список команд
-                        with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-                            json.dump([], f)
+                        write_json_atomic(BOT_COMMANDS_FILE, [], indent=None)
                         return True, "Создан пустой список команд"
 
                     try:
@@ -177,35 +178,19 @@ def start_bot():
 
                         if not isinstance(commands, list):
                             # Исправляем структуру файла
-                            with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-                                json.dump([], f)
+                            write_json_atomic(BOT_COMMANDS_FILE, [], indent=None)
                             return False, "Структура файла команд исправлена (не список)"
 
-                        # Проверяем зависшие команды
-                        pending_count = 0
-                        fixed_timestamp = 0
-                        now = time.time()
-
-                        for cmd in commands:
-                            if cmd.get('status') == 'pending':
-                                pending_count += 1
-
-                                # Проверяем возраст команды
-                                try:
-                                    cmd_time = float(cmd.get('timestamp', '0'))
-                                    if now - cmd_time > 300:  # 5 минут
-                                        cmd['timestamp'] = '0'
-                                        fixed_timestamp += 1
-                                except:
-                                    cmd['timestamp'] = '0'
-                                    fixed_timestamp += 1
-
-                        # Если есть исправленные метки времени, сохраняем файл
-                        if fixed_timestamp > 0:
-                            with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-                                json.dump(commands, f, ensure_ascii=False, indent=4)
-                            return True, f"Исправлено {fixed_timestamp} меток времени для зависших команд"
+                        # Зависшие команды - это команды, захваченные упавшим ботом. Бот сам забирает
+                        # их после истечения аренды, здесь аренды освобождаются сразу
+                        from command_queue import get_command_queue
+                        queue = get_command_queue()
+                        released = queue.release_expired_leases()
+
+                        if released > 0:
+                            return True, f"Освобождены аренды {released} зависших команд"
 
+                        pending_count = queue.count_by_status().get('pending', 0)
                         return True, f"Файл команд в порядке. Ожидающих команд: {pending_count}"
                     except json.JSONDecodeError:
                         # Создаем резервную копию поврежденного файла
@@ -213,8 +198,7 @@ def start_bot():
                         os.rename(BOT_COMMANDS_FILE, backup_file)
 
                         # Создаем новый пустой файл
-                        with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-                            json.dump([], f)
+                        write_json_atomic(BOT_COMMANDS_FILE, [], indent=None)
 
                         return False, f"Файл команд был поврежден и восстановлен. Резервная копия: {backup_file}"
             except Exception as e:
@@ -264,7 +248,10 @@ def start_bot():
             for filename in sync_files_to_check:
                 # Проверяем файл в корневой директории
                 file_path = os.path.join(BASE_DIR, filename)
-                if not os.path.exists(file_path):
+                if filename == 'chats.json' and chats_migrated(file_path):
+                    # Чаты бота перенесены в каталог чатов (см. chat_store.py)
+                    pass
+                elif not os.path.exists(file_path):
                     issues.append(f"Файл {filename} отсутствует в директории бота")
                 elif os.path.getsize(file_path) == 0:
                     issues.append(f"Файл {filename} в директории бота пуст")
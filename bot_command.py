@@ -1,153 +1,594 @@
 import os
 import json
+import asyncio
 import logging
 import time
 import traceback
+import weakref
 from datetime import datetime
 
+from command_archive import CommandArchive
+from command_ipc import IPC_TIMEOUT, IpcUnavailable, request_bot, request_bot_async
+from command_queue import (BASE_DIR, ENQUEUE_BLOCK_TIMEOUT, PRIORITY_BULK, PRIORITY_INTERACTIVE, TERMINAL_STATUSES,
+                           QueueFull, get_command_queue, new_command_id)
+
 logger = logging.getLogger(__name__)
 
-# Путь к файлу с командами бота
-BOT_COMMANDS_FILE = "bot_commands.json"
 # Максимальный размер файла команд (в байтах)
 MAX_COMMANDS_FILE_SIZE = 1024 * 1024  # 1 МБ
 
+# Интервалы опроса очереди при ожидании результата, когда бот недоступен по каналу (в секундах)
+WAIT_POLL_MIN_INTERVAL = 0.05
+WAIT_POLL_MAX_INTERVAL = 1.0
+
+# Списки получателей для рассылок
+BROADCAST_AUDIENCES = {
+    "allowed_users": "allowed_users.json",
+    "streamers": "streamers.json",
+    "admins": "admins.json"
+}
+
 
 def cleanup_commands_file():
     """
-    Очищает файл команд от выполненных и устаревших команд
+    Переносит выполненные команды из очереди в архив
+    """
+    try:
+        # Очередь сводит изменения под блокировкой, поэтому файл не перезаписывается поверх бота
+        removed = get_command_queue().clear_finished(CommandArchive())
+        if removed:
+            logger.info(f"Перенесено в архив {removed} завершенных команд")
+    except Exception as e:
+        logger.error(f"Ошибка при очистке файла команд: {e}")
+
+
+def _enqueue(cmds, overflow=None, timeout=None):
     """
-    if not os.path.exists(BOT_COMMANDS_FILE):
-        return
+    Ставит команды в очередь через канал бота, а если бот не запущен - напрямую в журнал
 
+    :return: количество принятых команд (повторы по ключу идемпотентности не считаются)
+    :raises QueueFull: если очередь переполнена
+    """
     try:
-        with open(BOT_COMMANDS_FILE, 'r', encoding='utf-8') as f:
-            commands = json.load(f)
+        request, wait = _enqueue_request(cmds, overflow, timeout)
+        response = request_bot(request, timeout=wait)
+    except IpcUnavailable:
+        known, cmds = _split_known(cmds)
+        return len(known) + get_command_queue().enqueue(cmds, overflow=overflow, timeout=timeout)
+    return len(_accepted_ids(response))
 
-        # Фильтруем команды, оставляя только ожидающие выполнения
-        pending_commands = [cmd for cmd in commands if cmd.get('status') == 'pending']
 
-        # Если есть изменения, сохраняем файл
-        if len(commands) != len(pending_commands):
-            with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(pending_commands, f, ensure_ascii=False, indent=4)
-            logger.info(f"Очищено {len(commands) - len(pending_commands)} завершенных команд")
-    except Exception as e:
-        logger.error(f"Ошибка при очистке файла команд: {e}")
+def _split_known(cmds):
+    """
+    Отделяет команды, которые бот уже принял, от еще не записанных
 
+    Бот мог принять команды, но ответить после таймаута; к повторной записи
+    команда может быть уже выполнена и перенесена из очереди, поэтому id
+    сверяются с очередью, хвостом выполненных и недоставленными. Команды,
+    которые бот еще не прочитал из журнала, он сам пропустит по id.
 
-def send_bot_command(command, params):
+    :return: (id уже принятых команд, команды для записи в очередь)
     """
-    Отправляет команду боту через файл
+    ids = [cmd.get("id") for cmd in cmds if cmd.get("id")]
+    if not ids:
+        return [], cmds
+    queue = get_command_queue()
+    dead = {cmd.get("id") for cmd in queue.dead_letters()}
+    known = [command_id for command_id in ids if command_id in dead or queue.get(command_id) is not None]
+    if known:
+        logger.info(f"Бот уже принял {len(known)} команд, повторно они не записываются")
+    known_ids = set(known)
+    return known, [cmd for cmd in cmds if cmd.get("id") not in known_ids]
+
+
+def _enqueue_request(cmds, overflow, timeout):
+    """Возвращает запрос постановки в очередь для канала бота и время ожидания ответа"""
+    # Ответ может задержаться на время ожидания места в очереди
+    wait = IPC_TIMEOUT + ((timeout or ENQUEUE_BLOCK_TIMEOUT) if overflow == "block" else 0)
+    return {"op": "enqueue", "commands": cmds, "overflow": overflow, "timeout": timeout}, wait
+
+
+def _accepted_ids(response):
+    """Разбирает ответ бота на постановку в очередь: список принятых id или исключение"""
+    if response.get("ok"):
+        return response["ids"]
+    if response.get("error") == "queue_full":
+        raise QueueFull(response.get("message"))
+    raise RuntimeError(response.get("message"))
+
+
+def _find_command(command_id):
+    """Ищет команду в очереди и среди недоставленных без обращения к боту"""
+    queue = get_command_queue()
+    cmd = queue.get(command_id)
+    if cmd is None:
+        cmd = next((dead for dead in queue.dead_letters() if dead.get("id") == command_id), None)
+    return cmd
+
+
+def get_command_status(command_id):
+    """
+    Возвращает команду из очереди по id (через канал бота, если он запущен)
+
+    :param command_id: ID команды
+    :return: команда или None, если бот ее еще не прочитал или она уже перенесена в архив
+    """
+    try:
+        response = request_bot({"op": "status", "id": command_id})
+        if response.get("ok"):
+            return response.get("command")
+    except IpcUnavailable:
+        pass
+    return _find_command(command_id)
+
+
+def wait_for_command(command_id, timeout=30):
+    """
+    Ждет, пока бот выполнит команду (статус completed, error или dead)
+
+    Если бот доступен по локальному каналу, он сам отвечает по завершении
+    команды; иначе очередь опрашивается с растущим интервалом.
+
+    :param command_id: ID команды
+    :param timeout: Максимальное время ожидания в секундах
+    :return: команда с конечным статусом или None по таймауту
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        response = request_bot({"op": "wait", "id": command_id, "timeout": timeout}, timeout=timeout + IPC_TIMEOUT)
+        if response.get("ok"):
+            return response.get("command")
+    except IpcUnavailable:
+        # Бот не запущен или перезапустился во время ожидания
+        pass
+
+    interval = WAIT_POLL_MIN_INTERVAL
+    while True:
+        cmd = _find_command(command_id)
+        if cmd is not None and cmd.get("status") in TERMINAL_STATUSES:
+            return cmd
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, WAIT_POLL_MAX_INTERVAL)
+
+
+async def wait_for_command_async(command_id, timeout=30):
+    """
+    Асинхронный вариант wait_for_command для обработчиков aiogram и веб-админки
+
+    :param command_id: ID команды
+    :param timeout: Максимальное время ожидания в секундах
+    :return: команда с конечным статусом или None по таймауту
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        response = await request_bot_async({"op": "wait", "id": command_id, "timeout": timeout},
+                                           timeout=timeout + IPC_TIMEOUT)
+        if response.get("ok"):
+            return response.get("command")
+    except IpcUnavailable:
+        pass
+
+    interval = WAIT_POLL_MIN_INTERVAL
+    while True:
+        cmd = await asyncio.to_thread(_find_command, command_id)
+        if cmd is not None and cmd.get("status") in TERMINAL_STATUSES:
+            return cmd
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * 2, WAIT_POLL_MAX_INTERVAL)
+
+
+def send_bot_command(command, params, overflow=None, timeout=None, send_at=None, delay=None,
+                     priority=PRIORITY_INTERACTIVE, idempotency_key=None):
+    """
+    Отправляет команду боту через локальный канал или журнал команд
 
     :param command: Название команды
     :param params: Параметры команды
-    :return: True если команда была добавлена в очередь
+    :param overflow: Политика при переполнении очереди ("spill", "block", "reject")
+    :param timeout: Время ожидания места в очереди для политики "block"
+    :param send_at: Время выполнения (datetime или секунды с начала эпохи)
+    :param delay: Задержка выполнения в секундах (вместо send_at)
+    :param priority: Приоритет ("interactive" - срочная команда, "bulk" - массовая)
+    :param idempotency_key: Ключ идемпотентности: повторная команда с тем же ключом не ставится в очередь
+    :return: ID команды (True, если команда с тем же ключом уже стоит в очереди) или False при ошибке
     """
     logger.debug(f"Отправка команды боту: {command} с параметрами {params}")
 
-    # Очищаем файл команд от завершенных, если он существует
-    if os.path.exists(BOT_COMMANDS_FILE):
-        cleanup_commands_file()
+    cmd = _make_command(command, params, _resolve_send_at(send_at, delay), priority)
+    if idempotency_key is not None:
+        cmd["idempotency_key"] = str(idempotency_key)
 
-    # Создаем структуру команды
+    # Команда дописывается в журнал (ботом или нами) - файл очереди целиком не перечитывается и не переписывается
+    try:
+        if not _enqueue([cmd], overflow=overflow, timeout=timeout):
+            logger.info(f"Команда {command} с ключом {idempotency_key} уже в очереди, повтор отброшен")
+            return True
+        logger.debug(f"Команда {command} добавлена в очередь (id={cmd['id']})")
+        return cmd["id"]
+    except QueueFull as e:
+        logger.warning(f"Команда {command} не добавлена: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении команды: {e}")
+        traceback.print_exc()
+        return False
+
+
+def _resolve_send_at(send_at=None, delay=None):
+    """
+    Переводит send_at/delay во время выполнения команды
+
+    :return: секунды с начала эпохи или None, если команду нужно выполнить сразу
+    """
+    if delay is not None:
+        return time.time() + delay
+    if isinstance(send_at, datetime):
+        return send_at.timestamp()
+    return send_at
+
+
+def _make_command(command, params, send_at=None, priority=PRIORITY_INTERACTIVE):
+    """Создает структуру команды для очереди"""
     cmd = {
+        "id": new_command_id(),
         "command": command,
         "params": params,
         "status": "pending",
+        "priority": priority,
         "timestamp": str(time.time())  # Используем время в секундах как временную метку
     }
+    if send_at is not None:
+        # Бот держит команду в расписании и выполнит ее не раньше этого времени
+        cmd["send_at"] = float(send_at)
+    return cmd
+
+
+def send_bot_commands(commands, overflow=None, timeout=None, send_at=None, delay=None, priority=PRIORITY_BULK):
+    """
+    Отправляет пачку команд одной записью в журнал (одна блокировка и одна запись)
+
+    Пачка добавляется в очередь целиком: при переполнении с политикой "reject"
+    отклоняются все команды пачки.
+
+    :param commands: Список пар (команда, параметры)
+    :param overflow: Политика при переполнении очереди ("spill", "block", "reject")
+    :param timeout: Время ожидания места в очереди для политики "block"
+    :param send_at: Время выполнения всех команд пачки (datetime или секунды с начала эпохи)
+    :param delay: Задержка выполнения в секундах (вместо send_at)
+    :param priority: Приоритет команд пачки (по умолчанию - массовый)
+    :return: Список ID добавленных команд или пустой список при ошибке
+    """
+    send_at = _resolve_send_at(send_at, delay)
+    cmds = [_make_command(command, params, send_at, priority) for command, params in commands]
+    if not cmds:
+        return []
 
-    # Загружаем текущий список команд
-    commands = []
-    if os.path.exists(BOT_COMMANDS_FILE):
-        try:
-            with open(BOT_COMMANDS_FILE, 'r', encoding='utf-8') as f:
-                file_content = f.read()
-                if file_content.strip():
-                    commands = json.loads(file_content)
-                else:
-                    commands = []
-        except Exception as e:
-            logger.error(f"Ошибка при чтении файла команд: {e}")
-            traceback.print_exc()
-            # Создаем резервную копию поврежденного файла
-            if os.path.exists(BOT_COMMANDS_FILE):
-                backup_file = f"{BOT_COMMANDS_FILE}.bak.{int(time.time())}"
-                try:
-                    os.rename(BOT_COMMANDS_FILE, backup_file)
-                    logger.info(f"Создана резервная копия поврежденного файла: {backup_file}")
-                except:
-                    pass
-            commands = []
-
-    # Проверяем размер файла команд
-    if len(commands) > 100:  # Если слишком много команд
-        logger.warning(f"Слишком много команд в очереди: {len(commands)}. Очистка.")
-        # Оставляем только последние 50 команд
-        commands = commands[-50:]
-
-    # Добавляем новую команду
-    commands.append(cmd)
-
-    # Сохраняем обновленный список
     try:
-        with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(commands, f, ensure_ascii=False, indent=4)
-        logger.debug(f"Команда {command} добавлена в очередь")
-        return True
+        _enqueue(cmds, overflow=overflow, timeout=timeout)
+        logger.debug(f"В очередь добавлено {len(cmds)} команд")
+        return [cmd["id"] for cmd in cmds]
+    except QueueFull as e:
+        logger.warning(f"Пачка из {len(cmds)} команд не добавлена: {e}")
+        return []
     except Exception as e:
-        logger.error(f"Ошибка при сохранении команды: {e}")
+        logger.error(f"Ошибка при сохранении пачки команд: {e}")
         traceback.print_exc()
-        return False
+        return []
 
 
-def send_message_to_user(user_id, message_text):
+def send_message_to_user(user_id, message_text, overflow=None, timeout=None, send_at=None, delay=None,
+                         priority=PRIORITY_INTERACTIVE, idempotency_key=None):
     """
     Отправляет сообщение пользователю через бота
 
     :param user_id: ID пользователя
     :param message_text: Текст сообщения
-    :return: True если команда была добавлена в очередь
+    :param overflow: Политика при переполнении очереди ("spill", "block", "reject")
+    :param timeout: Время ожидания места в очереди для политики "block"
+    :param send_at: Время отправки (datetime или секунды с начала эпохи)
+    :param delay: Задержка отправки в секундах (вместо send_at)
+    :param priority: Приоритет ("interactive" - срочное уведомление, "bulk" - массовое)
+    :param idempotency_key: Ключ идемпотентности (например, id операции в админке)
+    :return: ID команды (для wait_for_command) или False, если команда не добавлена
     """
     logger.debug(f"Отправка сообщения пользователю {user_id}: {message_text[:50]}...")
 
-    # Создаем структуру команды
-    cmd = {
-        "command": "send_message",
-        "params": {
-            "user_id": str(user_id),  # Преобразуем в строку для безопасности
-            "text": message_text
-        },
-        "status": "pending",
-        "timestamp": str(time.time())  # Используем время в секундах как временную метку
+    params = {
+        "user_id": str(user_id),  # Преобразуем в строку для безопасности
+        "text": message_text
+    }
+    return send_bot_command("send_message", params, overflow=overflow, timeout=timeout,
+                            send_at=send_at, delay=delay, priority=priority, idempotency_key=idempotency_key)
+
+
+def send_messages_to_users(user_ids, message_text, overflow=None, timeout=None, send_at=None, delay=None,
+                           priority=PRIORITY_BULK):
+    """
+    Отправляет одно сообщение нескольким пользователям отдельными командами
+
+    :param user_ids: Список ID пользователей
+    :param message_text: Текст сообщения
+    :param overflow: Политика при переполнении очереди ("spill", "block", "reject")
+    :param timeout: Время ожидания места в очереди для политики "block"
+    :param send_at: Время отправки (datetime или секунды с начала эпохи)
+    :param delay: Задержка отправки в секундах (вместо send_at)
+    :param priority: Приоритет сообщений (по умолчанию - массовый)
+    :return: Список ID добавленных команд
+    """
+    commands = [("send_message", {"user_id": str(user_id), "text": message_text}) for user_id in user_ids]
+    return send_bot_commands(commands, overflow=overflow, timeout=timeout, send_at=send_at, delay=delay,
+                             priority=priority)
+
+
+def load_broadcast_audience(audience):
+    """
+    Загружает список получателей рассылки
+
+    :param audience: Название списка ("allowed_users", "streamers", "admins")
+    :return: Список ID пользователей без повторов
+    """
+    filename = BROADCAST_AUDIENCES.get(audience)
+    if filename is None:
+        raise ValueError(f"Неизвестный список получателей: {audience}")
+
+    file_path = os.path.join(BASE_DIR, filename)
+    if not os.path.exists(file_path):
+        return []
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        user_ids = json.load(f)
+
+    return list(dict.fromkeys(str(user_id) for user_id in user_ids))
+
+
+def broadcast_message(message_text, audience="allowed_users", user_ids=None, overflow=None, timeout=None,
+                      send_at=None, delay=None):
+    """
+    Ставит в очередь рассылку одной командой "broadcast"
+
+    Бот выполняет рассылку как одно задание: отправляет сообщения частями в
+    пределах лимитов Telegram и сохраняет прогресс, поэтому после перезапуска
+    рассылка продолжается с места остановки.
+
+    :param message_text: Текст сообщения
+    :param audience: Список получателей ("allowed_users", "streamers", "admins")
+    :param user_ids: Явный список получателей (вместо audience)
+    :param overflow: Политика при переполнении очереди ("spill", "block", "reject")
+    :param timeout: Время ожидания места в очереди для политики "block"
+    :param send_at: Время начала рассылки (datetime или секунды с начала эпохи)
+    :param delay: Задержка начала рассылки в секундах (вместо send_at)
+    :return: ID команды рассылки или None при ошибке
+    """
+    recipients = _broadcast_recipients(audience, user_ids)
+    if not recipients:
+        return None
+
+    params = {
+        "user_ids": recipients,
+        "text": message_text
     }
+    ids = send_bot_commands([("broadcast", params)], overflow=overflow, timeout=timeout,
+                            send_at=send_at, delay=delay)
+    if not ids:
+        return None
+
+    logger.info(f"Рассылка {ids[0]} поставлена в очередь ({len(recipients)} получателей)")
+    return ids[0]
+
+
+def _broadcast_recipients(audience, user_ids):
+    """Возвращает получателей рассылки без повторов или None, если список не загружен или пуст"""
+    try:
+        if user_ids is None:
+            recipients = load_broadcast_audience(audience)
+        else:
+            recipients = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке получателей рассылки: {e}")
+        return None
+
+    if not recipients:
+        logger.warning("Рассылка не создана: список получателей пуст")
+        return None
+    return recipients
 
-    # Загружаем текущий список команд
-    commands = []
-    if os.path.exists(BOT_COMMANDS_FILE):
+
+# ---------- Асинхронные варианты (обработчики aiogram, веб-админка) ----------
+
+class _GroupCommit:
+    """
+    Объединяет одновременные постановки команд одного цикла событий в одну запись
+
+    Пока одна пачка записывается, новые команды копятся и уходят следующей
+    записью, поэтому число записей (и fsync) растет не с числом вызовов, а с
+    числом "волн" вызовов.
+    """
+
+    def __init__(self):
+        # (overflow, timeout) -> список пар (команды вызова, future)
+        self._pending = {}
+        self._writers = set()
+
+    async def submit(self, cmds, overflow=None, timeout=None):
+        """
+        Добавляет команды в ближайшую запись
+
+        :return: список принятых id из cmds
+        :raises QueueFull: если очередь переполнена
+        """
+        future = asyncio.get_running_loop().create_future()
+        key = (overflow, timeout)
+        self._pending.setdefault(key, []).append((cmds, future))
+        if key not in self._writers:
+            self._writers.add(key)
+            asyncio.create_task(self._write(key))
+        return await future
+
+    async def _write(self, key):
+        overflow, timeout = key
+        # Вызовы, добавленные во время записи, уходят следующей пачкой
+        while self._pending.get(key):
+            batch = self._pending.pop(key)
+            try:
+                accepted = await self._write_batch(batch, overflow, timeout)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for cmds, future in batch:
+                if not future.done():
+                    future.set_result([cmd["id"] for cmd in cmds if cmd["id"] in accepted])
+        self._writers.discard(key)
+
+    @staticmethod
+    async def _write_batch(batch, overflow, timeout):
+        """Записывает пачку одной записью и возвращает множество принятых id"""
         try:
-            with open(BOT_COMMANDS_FILE, 'r', encoding='utf-8') as f:
-                file_content = f.read()
-                if file_content.strip():
-                    commands = json.loads(file_content)
-                else:
-                    commands = []
-        except Exception as e:
-            logger.error(f"Ошибка при чтении файла команд: {e}")
-            traceback.print_exc()
-            commands = []
-
-    # Добавляем новую команду
-    commands.append(cmd)
-
-    # Сохраняем обновленный список
+            return set(await _enqueue_async([cmd for cmds, _ in batch for cmd in cmds], overflow, timeout))
+        except QueueFull:
+            if len(batch) == 1:
+                raise
+        # Общая пачка не поместилась: записываем вызовы по отдельности, как если бы они шли порознь
+        accepted = set()
+        for cmds, future in batch:
+            try:
+                accepted.update(await _enqueue_async(cmds, overflow, timeout))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+        return accepted
+
+
+# Писатели пачек по циклам событий (у каждого цикла свои future)
+_group_commits = weakref.WeakKeyDictionary()
+
+
+async def _enqueue_async(cmds, overflow=None, timeout=None):
+    """
+    Ставит команды в очередь через канал бота, а если бот не запущен - записью в журнал в отдельном потоке
+
+    :return: список принятых id
+    :raises QueueFull: если очередь переполнена
+    """
+    request, wait = _enqueue_request(cmds, overflow, timeout)
     try:
-        with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(commands, f, ensure_ascii=False, indent=4)
-        logger.debug(f"Команда send_message добавлена в очередь для пользователя {user_id}")
-        return True
+        return _accepted_ids(await request_bot_async(request, timeout=wait))
+    except IpcUnavailable:
+        known, cmds = await asyncio.to_thread(_split_known, cmds)
+        accepted = await asyncio.to_thread(get_command_queue().enqueue_accepted, cmds, overflow, timeout)
+        return known + [cmd["id"] for cmd in accepted]
+
+
+def _group_commit():
+    loop = asyncio.get_running_loop()
+    group_commit = _group_commits.get(loop)
+    if group_commit is None:
+        group_commit = _group_commits[loop] = _GroupCommit()
+    return group_commit
+
+
+async def send_bot_command_async(command, params, overflow=None, timeout=None, send_at=None, delay=None,
+                                 priority=PRIORITY_INTERACTIVE, idempotency_key=None):
+    """
+    Асинхронный вариант send_bot_command: не блокирует цикл событий
+
+    Одновременные вызовы из одного процесса записываются в очередь одной пачкой.
+
+    :return: ID команды (True, если команда с тем же ключом уже стоит в очереди) или False при ошибке
+    """
+    cmd = _make_command(command, params, _resolve_send_at(send_at, delay), priority)
+    if idempotency_key is not None:
+        cmd["idempotency_key"] = str(idempotency_key)
+
+    try:
+        if not await _group_commit().submit([cmd], overflow, timeout):
+            logger.info(f"Команда {command} с ключом {idempotency_key} уже в очереди, повтор отброшен")
+            return True
+        logger.debug(f"Команда {command} добавлена в очередь (id={cmd['id']})")
+        return cmd["id"]
+    except QueueFull as e:
+        logger.warning(f"Команда {command} не добавлена: {e}")
+        return False
     except Exception as e:
-        logger.error(f"Ошибка при сохранении команды: {e}")
-        traceback.print_exc()
-        return False
\ No newline at end of file
+        logger.error(f"Ошибка при сохранении команды: {e}", exc_info=True)
+        return False
+
+
+async def send_bot_commands_async(commands, overflow=None, timeout=None, send_at=None, delay=None,
+                                  priority=PRIORITY_BULK):
+    """
+    Асинхронный вариант send_bot_commands
+
+    :return: Список ID добавленных команд или пустой список при ошибке
+    """
+    send_at = _resolve_send_at(send_at, delay)
+    cmds = [_make_command(command, params, send_at, priority) for command, params in commands]
+    if not cmds:
+        return []
+
+    try:
+        ids = await _group_commit().submit(cmds, overflow, timeout)
+        logger.debug(f"В очередь добавлено {len(ids)} команд")
+        return ids
+    except QueueFull as e:
+        logger.warning(f"Пачка из {len(cmds)} команд не добавлена: {e}")
+        return []
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении пачки команд: {e}", exc_info=True)
+        return []
+
+
+async def send_message_to_user_async(user_id, message_text, overflow=None, timeout=None, send_at=None, delay=None,
+                                     priority=PRIORITY_INTERACTIVE, idempotency_key=None):
+    """
+    Асинхронный вариант send_message_to_user
+
+    :return: ID команды (для wait_for_command_async) или False, если команда не добавлена
+    """
+    params = {
+        "user_id": str(user_id),
+        "text": message_text
+    }
+    return await send_bot_command_async("send_message", params, overflow=overflow, timeout=timeout,
+                                        send_at=send_at, delay=delay, priority=priority,
+                                        idempotency_key=idempotency_key)
+
+
+async def send_messages_to_users_async(user_ids, message_text, overflow=None, timeout=None, send_at=None,
+                                       delay=None, priority=PRIORITY_BULK):
+    """
+    Асинхронный вариант send_messages_to_users
+
+    :return: Список ID добавленных команд
+    """
+    commands = [("send_message", {"user_id": str(user_id), "text": message_text}) for user_id in user_ids]
+    return await send_bot_commands_async(commands, overflow=overflow, timeout=timeout, send_at=send_at,
+                                         delay=delay, priority=priority)
+
+
+async def broadcast_message_async(message_text, audience="allowed_users", user_ids=None, overflow=None,
+                                  timeout=None, send_at=None, delay=None):
+    """
+    Асинхронный вариант broadcast_message (список получателей читается в отдельном потоке)
+
+    :return: ID команды рассылки или None при ошибке
+    """
+    recipients = await asyncio.to_thread(_broadcast_recipients, audience, user_ids)
+    if not recipients:
+        return None
+
+    ids = await send_bot_commands_async([("broadcast", {"user_ids": recipients, "text": message_text})],
+                                        overflow=overflow, timeout=timeout, send_at=send_at, delay=delay)
+    if not ids:
+        return None
+
+    logger.info(f"Рассылка {ids[0]} поставлена в очередь ({len(recipients)} получателей)")
+    return ids[0]
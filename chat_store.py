@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+"""
+Хранилище чатов поддержки по файлу на чат
+
+chats.json - один словарь всех чатов (id -> user_id, status, created_at,
+closed_at, messages[]), поэтому каждое новое сообщение стоит сериализации
+всех когда-либо открытых чатов. ShardedChatStore хранит каждый чат в своем
+файле каталога chats/ рядом с chats.json:
+
+  chats/index.json    - поля всех чатов без сообщений (id -> user_id, status, ...)
+  chats/<id>.jsonl    - записи чата, по одной на строку:
+                        {"chat": {...}}     - поля чата (действует последняя запись)
+                        {"message": {...}}  - сообщение
+
+  chats/changes.log   - журнал изменений: ID чата, файл которого записан, по одному на строку
+
+Новое сообщение дописывается одной строкой в файл своего чата, индекс
+переписывается только при создании и удалении чата или изменении его полей,
+а чтение одного чата разбирает только его файл. Перезагрузка читает только
+новые строки журнала изменений и перечитывает только упомянутые в нем чаты;
+все чаты сверяются лишь при первой загрузке и после того, как журнал начат
+заново (он ограничен CHATS_CHANGES_MAX_SIZE).
+
+Включается переменной окружения BOT_CHATS_STORAGE=sharded; SyncedDataStorage
+при этом работает с прежним API. chats.json переносится автоматически при
+первом запуске или вручную командой
+    python chat_store.py --migrate [--force]
+После переноса chats.json переименовывается в chats.json.migrated, а
+каталог чатов используется независимо от BOT_CHATS_STORAGE. Скрипты
+обслуживания копируют чаты через copy_chats и не создают chats.json заново;
+chats.json, записанный после переноса другими программами, бот переносит в
+каталог чатов при следующей перезагрузке: чат из файла заменяет свою копию,
+только если он новее ее (см. ShardedChatStore.migrate_from_json).
+"""
+import os
+import re
+import sys
+import copy
+import json
+import time
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from atomic_write import file_token, write_json_atomic, write_text_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows - работаем без блокировок
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Получаем абсолютный путь к текущей директории
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Хранилище чатов: "json" (chats.json) или "sharded" (файл на чат)
+CHATS_STORAGE = os.environ.get("BOT_CHATS_STORAGE", "json")
+# Имя каталога чатов (рядом с chats.json)
+CHATS_DIR_NAME = "chats"
+# Имена файлов индекса и блокировки в каталоге чатов
+CHATS_INDEX_NAME = "index.json"
+CHATS_LOCK_NAME = ".lock"
+CHATS_CHANGES_NAME = "changes.log"
+# Размер журнала изменений, после которого он начинается заново
+CHATS_CHANGES_MAX_SIZE = 1024 * 1024
+# Суффикс, с которым chats.json остается после переноса
+MIGRATED_SUFFIX = ".migrated"
+
+# ID чата, который можно использовать как имя файла
+_SAFE_CHAT_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def chats_dir_for(chats_file):
+    """Возвращает каталог чатов для файла chats.json"""
+    return os.path.join(os.path.dirname(os.path.abspath(chats_file)), CHATS_DIR_NAME)
+
+
+def chats_migrated(chats_file):
+    """True если чаты из chats_file перенесены в каталог чатов и файл больше не используется"""
+    return os.path.exists(os.path.join(chats_dir_for(chats_file), CHATS_INDEX_NAME))
+
+
+def _chat_header(chat):
+    """Поля чата без сообщений"""
+    return {key: value for key, value in chat.items() if key != "messages"}
+
+
+def _same_chat(old, chat):
+    """
+    Быстрая проверка, что чат не менялся с последней записи
+
+    Сравниваются поля чата, количество сообщений и последнее сообщение, а не
+    вся переписка. Правку более старого сообщения сохраняйте через save_chat.
+    """
+    if old is None:
+        return False
+    old_messages = old.get("messages") or []
+    messages = chat.get("messages") or []
+    if len(messages) != len(old_messages) or _chat_header(chat) != _chat_header(old):
+        return False
+    return not messages or messages[-1] == old_messages[-1]
+
+
+def _chat_lines(records):
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+
+class ShardedChatStore:
+    """Чаты поддержки по файлу на чат с небольшим индексом"""
+
+    def __init__(self, chats_dir):
+        self.chats_dir = chats_dir
+        self.index_file = os.path.join(chats_dir, CHATS_INDEX_NAME)
+        self.lock_file = os.path.join(chats_dir, CHATS_LOCK_NAME)
+        self.changes_file = os.path.join(chats_dir, CHATS_CHANGES_NAME)
+        os.makedirs(chats_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        # Индекс и признак его файла на момент загрузки
+        self._index = {}
+        self._index_token = None
+        # Последнее известное содержимое чатов и признаки их файлов: id -> ...
+        self._chats = {}
+        self._tokens = {}
+        self._loaded = False
+        # Прочитанная часть журнала изменений: (inode, смещение)
+        self._changes_pos = None
+
+    @contextmanager
+    def _locked(self):
+        """Блокировка записи между потоками и процессами"""
+        with self._lock:
+            if self._lock_fd is None:
+                self._lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def chat_path(self, chat_id):
+        """Путь к файлу чата"""
+        chat_id = str(chat_id)
+        if _SAFE_CHAT_ID.fullmatch(chat_id):
+            return os.path.join(self.chats_dir, f"{chat_id}.jsonl")
+        # ID, непригодный для имени файла, заменяем хешем
+        return os.path.join(self.chats_dir, f"h-{hashlib.sha1(chat_id.encode('utf-8')).hexdigest()}.jsonl")
+
+    # ---------- Чтение ----------
+
+    def _refresh_index(self):
+        """Перечитывает индекс, если файл изменился; возвращает True если перечитан"""
+        token = file_token(self.index_file)
+        if token == self._index_token:
+            return False
+        if token is None:
+            self._index = {}
+        else:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                self._index = json.load(f)
+        self._index_token = token
+        return True
+
+    def _refresh_chat(self, chat_id):
+        """Перечитывает файл чата, если он изменился; возвращает True если перечитан"""
+        path = self.chat_path(chat_id)
+        # Признак снимается до чтения: изменение во время чтения заметим в следующий раз
+        token = file_token(path)
+        if chat_id in self._tokens and self._tokens[chat_id] == token:
+            return False
+        if token is None:
+            self._chats.pop(chat_id, None)
+            self._tokens[chat_id] = None
+            return True
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        chat = {}
+        messages = []
+        # Недописанную последнюю строку (запись другого процесса) пропускаем
+        for line in data.split(b"\n")[:-1]:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                logger.error(f"Пропущена поврежденная запись чата {chat_id}: {e}")
+                continue
+            if "message" in record:
+                messages.append(record["message"])
+            elif "chat" in record:
+                chat = dict(record["chat"])
+        chat["messages"] = messages
+        self._chats[chat_id] = chat
+        self._tokens[chat_id] = token
+        return True
+
+    def _read_changes(self):
+        """
+        Читает новые строки журнала изменений
+
+        :return: множество ID изменившихся чатов или None, если журнал прочитан
+                 впервые или начат заново и изменения могли быть пропущены
+        """
+        try:
+            with open(self.changes_file, 'rb') as f:
+                st = os.fstat(f.fileno())
+                pos = self._changes_pos
+                if pos is None or pos[0] != st.st_ino or pos[1] > st.st_size:
+                    # Читаем с конца: все, что было до этого момента, вызывающий сверит сам
+                    self._changes_pos = (st.st_ino, st.st_size)
+                    return None
+                f.seek(pos[1])
+                data = f.read(st.st_size - pos[1])
+        except FileNotFoundError:
+            # Журнала еще нет: один раз сверяем все, дальше ждем его появления
+            changed = set() if self._changes_pos == (None, 0) else None
+            self._changes_pos = (None, 0)
+            return changed
+
+        # Недописанную последнюю строку оставляем до следующего чтения
+        end = data.rfind(b"\n") + 1
+        self._changes_pos = (pos[0], pos[1] + end)
+        changed = set()
+        for line in data[:end].split(b"\n"):
+            if not line.strip():
+                continue
+            try:
+                changed.add(str(json.loads(line)))
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                logger.error(f"Пропущена поврежденная запись журнала изменений чатов: {e}")
+        return changed
+
+    def get_chat(self, chat_id):
+        """
+        Читает один чат (разбирается только его файл)
+
+        :param chat_id: ID чата
+        :return: чат или None, если его нет
+        """
+        chat_id = str(chat_id)
+        with self._lock:
+            self._refresh_chat(chat_id)
+            chat = self._chats.get(chat_id)
+            return copy.deepcopy(chat) if chat is not None else None
+
+    def list_chats(self, user_id=None, status=None):
+        """
+        Возвращает поля чатов без сообщений из индекса
+
+        :param user_id: Только чаты пользователя
+        :param status: Только чаты с этим статусом
+        :return: {id чата: поля}
+        """
+        with self._lock:
+            self._refresh_index()
+            return {chat_id: dict(header) for chat_id, header in self._index.items()
+                    if (user_id is None or str(header.get("user_id")) == str(user_id))
+                    and (status is None or header.get("status") == status)}
+
+    def load_if_changed(self, current=None):
+        """
+        Читает все чаты, если с прошлой загрузки изменились индекс или файлы чатов
+
+        Неизменная перезагрузка стоит stat индекса и чтения хвоста журнала
+        изменений; перечитываются только чаты, упомянутые в журнале.
+
+        :param current: Чаты, полученные прошлым вызовом: неизменившиеся чаты берутся из него без копирования
+        :return: {id чата: чат} в формате chats.json или None, если ничего не менялось
+        """
+        with self._lock:
+            index_changed = self._refresh_index()
+            changed_ids = self._read_changes()
+            if changed_ids is None:
+                # Изменения могли быть пропущены - сверяем все чаты
+                changed_ids = set(self._index)
+            elif index_changed:
+                # Новые чаты, о которых журнал мог еще не сообщить
+                changed_ids.update(chat_id for chat_id in self._index if chat_id not in self._chats)
+            changed_ids.intersection_update(self._index)
+
+            for chat_id in changed_ids:
+                self._refresh_chat(chat_id)
+            changed = index_changed or bool(changed_ids)
+            if index_changed:
+                for chat_id in [chat_id for chat_id in self._chats if chat_id not in self._index]:
+                    del self._chats[chat_id]
+                    self._tokens.pop(chat_id, None)
+            if self._loaded and not changed:
+                return None
+            self._loaded = True
+
+            if current is None:
+                current = {}
+            chats = {}
+            for chat_id in self._index:
+                if chat_id not in self._chats:
+                    continue
+                if chat_id in changed_ids or chat_id not in current:
+                    chats[chat_id] = copy.deepcopy(self._chats[chat_id])
+                else:
+                    chats[chat_id] = current[chat_id]
+            return chats
+
+    # ---------- Запись ----------
+
+    def _append(self, chat_id, records):
+        """Дописывает записи в файл чата (O(размер записей))"""
+        data = _chat_lines(records).encode('utf-8')
+        with open(self.chat_path(chat_id), 'a+b') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                # Недописанная строка после сбоя не должна склеиться с новой записью
+                if f.read(1) != b"\n":
+                    data = b"\n" + data
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        self._tokens[chat_id] = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _rewrite(self, chat_id, chat):
+        """Атомарно переписывает файл чата целиком"""
+        records = [{"chat": _chat_header(chat)}]
+        records.extend({"message": message} for message in chat.get("messages") or [])
+        self._tokens[chat_id] = write_text_atomic(self.chat_path(chat_id), _chat_lines(records))
+
+    def _save_chat(self, chat_id, chat):
+        """
+        Записывает изменения одного чата относительно последней известной версии
+
+        :return: True если изменились поля чата (нужно переписать индекс)
+        """
+        old = self._chats.get(chat_id)
+        if old is not None and old == chat:
+            # Вызывающий чат не менял - изменения других процессов не затираем
+            return False
+
+        header = _chat_header(chat)
+        messages = chat.get("messages") or []
+        known = len(old["messages"]) if old is not None else 0
+        if (old is None or file_token(self.chat_path(chat_id)) != self._tokens.get(chat_id)
+                or messages[:known] != old["messages"]):
+            # Новый чат, файл изменен другим процессом или сообщения правились - переписываем чат
+            self._rewrite(chat_id, chat)
+        else:
+            records = []
+            if header != _chat_header(old):
+                records.append({"chat": header})
+            records.extend({"message": message} for message in messages[known:])
+            self._append(chat_id, records)
+
+        self._chats[chat_id] = copy.deepcopy(chat)
+        if self._index.get(chat_id) != header:
+            self._index[chat_id] = copy.deepcopy(header)
+            return True
+        return False
+
+    def _write_index(self):
+        self._index_token = write_json_atomic(self.index_file, self._index)
+
+    def _log_changes(self, chat_ids):
+        """Отмечает в журнале изменений записанные чаты (для перезагрузки в других процессах)"""
+        if not chat_ids:
+            return
+        data = "".join(json.dumps(chat_id, ensure_ascii=False) + "\n" for chat_id in chat_ids)
+        with open(self.changes_file, 'ab') as f:
+            f.write(data.encode('utf-8'))
+            size = f.tell()
+        if size > CHATS_CHANGES_MAX_SIZE:
+            # Читатели заметят новый файл и один раз сверят все чаты
+            write_text_atomic(self.changes_file, "")
+
+    def save_chat(self, chat_id, chat):
+        """
+        Создает или обновляет один чат
+
+        :param chat_id: ID чата
+        :param chat: Чат (user_id, status, ..., messages)
+        """
+        chat_id = str(chat_id)
+        with self._locked():
+            self._refresh_index()
+            if self._save_chat(chat_id, chat):
+                self._write_index()
+            self._log_changes([chat_id])
+
+    def append_message(self, chat_id, message):
+        """
+        Дописывает сообщение в чат, не читая и не переписывая остальные чаты
+
+        :param chat_id: ID чата
+        :param message: Сообщение
+        :raises KeyError: если чата нет
+        """
+        chat_id = str(chat_id)
+        with self._locked():
+            self._refresh_chat(chat_id)
+            if chat_id not in self._chats:
+                raise KeyError(chat_id)
+            self._append(chat_id, [{"message": message}])
+            self._chats[chat_id]["messages"].append(copy.deepcopy(message))
+            self._log_changes([chat_id])
+
+    def save_all(self, chats):
+        """
+        Записывает словарь всех чатов (формат chats.json), трогая только изменившиеся чаты
+
+        Новые сообщения дописываются в файлы своих чатов; чаты, удаленные
+        из словаря, удаляются; индекс переписывается, только если изменились
+        поля чатов. Неизменность чата проверяется без сравнения всей переписки
+        (см. _same_chat).
+
+        :param chats: {id чата: чат}
+        :return: количество записанных и удаленных чатов
+        """
+        written = []
+        with self._locked():
+            self._refresh_index()
+            index_changed = False
+            chats = {str(chat_id): chat for chat_id, chat in chats.items()}
+            for chat_id, chat in chats.items():
+                if not isinstance(chat, dict):
+                    logger.error(f"Чат {chat_id} не сохранен: неверный формат {type(chat).__name__}")
+                    continue
+                if _same_chat(self._chats.get(chat_id), chat):
+                    continue
+                index_changed = self._save_chat(chat_id, chat) or index_changed
+                written.append(chat_id)
+
+            # Удаляем только известные нам чаты: новые чаты других процессов вызывающий еще не видел
+            for chat_id in [chat_id for chat_id in self._chats if chat_id not in chats]:
+                try:
+                    os.remove(self.chat_path(chat_id))
+                except FileNotFoundError:
+                    pass
+                del self._chats[chat_id]
+                self._tokens.pop(chat_id, None)
+                self._index.pop(chat_id, None)
+                index_changed = True
+                written.append(chat_id)
+
+            if index_changed:
+                self._write_index()
+            self._log_changes(written)
+        return len(written)
+
+    # ---------- Перенос из chats.json ----------
+
+    def _import_wins(self, chat_id, chat, file_mtime):
+        """
+        Решает, заменяет ли чат из chats.json свою копию в каталоге при повторном переносе
+
+        Копия остается, если ее файл изменен позже chats.json или в ней есть
+        сообщения, которых нет в chats.json: устаревший файл не должен затирать
+        переписку, накопленную после переноса.
+
+        :param chat_id: ID чата
+        :param chat: Чат из chats.json
+        :param file_mtime: Время изменения chats.json (st_mtime_ns)
+        :return: True если чат нужно перенести
+        """
+        self._refresh_chat(chat_id)
+        old = self._chats.get(chat_id) if chat_id in self._index else None
+        if old is None:
+            return True
+        if old == chat:
+            return False
+        old_messages = old.get("messages") or []
+        messages = chat.get("messages") or []
+        return self._tokens[chat_id][2] < file_mtime and messages[:len(old_messages)] == old_messages
+
+    def migrate_from_json(self, chats_file, force=False):
+        """
+        Переносит чаты из chats.json в каталог чатов
+
+        После переноса chats.json переименовывается в chats.json.migrated,
+        чтобы правки старого файла не терялись молча. Если такая копия уже
+        есть, файл сохраняется рядом с ней с отметкой времени.
+
+        :param chats_file: Путь к chats.json
+        :param force: Переносить, даже если каталог уже содержит индекс (чаты из файла
+                      заменяют свои копии, только если они новее, см. _import_wins)
+        :return: количество перенесенных чатов или None, если перенос не нужен
+        """
+        with self._locked():
+            # Проверка под блокировкой: два одновременно запущенных бота не перенесут чаты дважды
+            if not os.path.exists(chats_file) or os.path.exists(self.index_file) and not force:
+                return None
+            file_mtime = os.stat(chats_file).st_mtime_ns
+            with open(chats_file, 'r', encoding='utf-8') as f:
+                chats = json.load(f)
+
+            self._refresh_index()
+            imported = []
+            kept = []
+            for chat_id, chat in chats.items():
+                if not isinstance(chat, dict):
+                    logger.error(f"Чат {chat_id} не перенесен: неверный формат {type(chat).__name__}")
+                    continue
+                chat_id = str(chat_id)
+                if not self._import_wins(chat_id, chat, file_mtime):
+                    if self._chats.get(chat_id) != chat:
+                        kept.append(chat_id)
+                    continue
+                self._rewrite(chat_id, chat)
+                self._chats[chat_id] = copy.deepcopy(chat)
+                self._index[chat_id] = _chat_header(chat)
+                imported.append(chat_id)
+            # Индекс пишется последним: пока его нет, перенос считается незавершенным
+            self._write_index()
+            self._log_changes(imported)
+            backup = chats_file
+            if not chats_file.endswith(MIGRATED_SUFFIX):
+                backup = chats_file + MIGRATED_SUFFIX
+                if os.path.exists(backup):
+                    # Копию первого переноса не затираем
+                    backup = f"{backup}.{time.strftime('%Y%m%d-%H%M%S')}"
+                os.replace(chats_file, backup)
+
+        if kept:
+            logger.warning(f"Не перенесено {len(kept)} чатов из {chats_file}: их копии в {self.chats_dir} новее "
+                           f"({', '.join(kept)}); файл сохранен как {backup}")
+        logger.info(f"Перенесено {len(imported)} чатов из {chats_file} в {self.chats_dir}")
+        return len(imported)
+
+
+def copy_chats(src, dst):
+    """
+    Копирует все чаты из src в dst
+
+    Для перенесенного chats.json (см. chats_migrated) чаты читаются из каталога
+    чатов и записываются в него же, иначе используется сам JSON-файл.
+
+    :param src: Путь к исходному chats.json
+    :param dst: Путь к целевому chats.json
+    :return: количество скопированных чатов
+    """
+    if chats_migrated(src):
+        chats = ShardedChatStore(chats_dir_for(src)).load_if_changed()
+    else:
+        with open(src, 'r', encoding='utf-8') as f:
+            chats = json.load(f)
+    if not isinstance(chats, dict):
+        raise ValueError(f"{src}: неверный формат чатов {type(chats).__name__}")
+
+    if chats_migrated(dst):
+        store = ShardedChatStore(chats_dir_for(dst))
+        # Загрузка нужна, чтобы удалить чаты, которых нет в src
+        store.load_if_changed()
+        store.save_all(chats)
+    else:
+        write_json_atomic(dst, chats)
+    return len(chats)
+
+
+def main():
+    """Перенос chats.json в каталог чатов из командной строки"""
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Хранилище чатов по файлу на чат')
+    parser.add_argument('--migrate', action='store_true', help='Перенести chats.json в каталог чатов')
+    parser.add_argument('--force', action='store_true',
+                        help='Перенести заново, даже если каталог чатов уже создан')
+    parser.add_argument('--chats-file', default=os.path.join(BASE_DIR, "chats.json"), help='Путь к chats.json')
+    args = parser.parse_args()
+
+    if not args.migrate:
+        parser.print_help()
+        return 0
+
+    store = ShardedChatStore(chats_dir_for(args.chats_file))
+    count = store.migrate_from_json(args.chats_file, force=args.force)
+    if count is None:
+        print(f"Перенос не выполнен: нет {args.chats_file} или каталог {store.chats_dir} уже создан "
+              f"(--force, для повторного переноса укажите --chats-file {args.chats_file}{MIGRATED_SUFFIX})")
+        return 1
+    print(f"Перенесено чатов: {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,8 +8,13 @@ import json
 import logging
 import time
 import traceback
+from collections import deque
 from datetime import datetime
 
+from command_archive import CommandArchive
+from command_queue import BOT_COMMANDS_DB, COMMAND_QUEUE_BACKEND, get_command_queue, migrate_file_queue_to_sqlite
+from command_metrics import LATENCY_BUCKETS, histogram_percentile, load_metrics, throughput_per_minute
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -27,26 +32,42 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Путь к файлу с командами бота
 BOT_COMMANDS_FILE = os.path.join(BASE_DIR, "bot_commands.json")
 
+# Окно скользящих скоростей в режиме --tail (в секундах)
+TAIL_RATE_WINDOW = 60
+
 
-def send_test_message(user_id):
+def send_test_message(user_id, wait_timeout=30):
     """
-    Отправляет тестовое сообщение через систему команд
+    Отправляет тестовое сообщение через систему команд и ждет результата доставки
 
     :param user_id: ID пользователя для отправки сообщения
-    :return: True если команда добавлена, иначе False
+    :param wait_timeout: Сколько секунд ждать доставки (0 - не ждать)
+    :return: True если команда добавлена (и, при ожидании, доставлена), иначе False
     """
     try:
-        from bot_command import send_message_to_user
+        from bot_command import send_message_to_user, wait_for_command
 
         message = f"Тестовое сообщение от системы диагностики. Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
         result = send_message_to_user(user_id, message)
 
-        if result:
-            logger.info(f"Тестовая команда отправки сообщения пользователю {user_id} добавлена в очередь")
-        else:
+        if not result:
             logger.error(f"Не удалось добавить тестовую команду для пользователя {user_id}")
-
-        return result
+            return False
+
+        logger.info(f"Тестовая команда отправки сообщения пользователю {user_id} добавлена в очередь")
+        if not wait_timeout:
+            return True
+
+        cmd = wait_for_command(result, wait_timeout)
+        if cmd is None:
+            logger.warning(f"Бот не выполнил тестовую команду за {wait_timeout} секунд")
+            return False
+        if cmd.get("status") != "completed":
+            logger.error(f"Тестовое сообщение пользователю {user_id} не доставлено: {cmd.get('error')}")
+            return False
+
+        logger.info(f"Тестовое сообщение пользователю {user_id} доставлено ({cmd.get('completed_at')})")
+        return True
     except Exception as e:
         logger.error(f"Ошибка при отправке тестового сообщения: {e}")
         traceback.print_exc()
@@ -88,34 +109,59 @@ def check_bot_commands_file():
         return True, False, 0
 
 
+def queue_storage_ready():
+    """
+    Проверяет, что хранилище очереди можно читать
+
+    :return: True если очередь доступна
+    """
+    if COMMAND_QUEUE_BACKEND == "sqlite":
+        return True
+
+    exists, valid, count = check_bot_commands_file()
+    return exists and valid
+
+
 def analyze_commands():
     """
-    Анализирует команды в файле и выводит статистику
+    Анализирует команды в очереди и выводит статистику
 
-    :return: {total, pending, completed, error, unknown}
+    :return: {total, pending, completed, error, dead, unknown, journal, lanes, metrics}
+             (metrics - сводка, которую бот накапливает по ходу работы, или None)
     """
     stats = {
         'total': 0,
         'pending': 0,
         'completed': 0,
         'error': 0,
-        'unknown': 0
+        'dead': 0,
+        'unknown': 0,
+        'journal': 0,
+        'lanes': {},
+        'metrics': None
     }
 
-    exists, valid, count = check_bot_commands_file()
-
-    if not exists or not valid:
+    if not queue_storage_ready():
         return stats
 
     try:
-        with open(BOT_COMMANDS_FILE, 'r', encoding='utf-8') as f:
-            commands = json.load(f)
+        queue = get_command_queue()
+
+        for status, count in queue.count_by_status().items():
+            stats[status] = stats.get(status, 0) + count
+            stats['total'] += count
 
-        stats['total'] = len(commands)
+        # Команды из журнала, которые бот еще не перенес в файл, тоже ожидают выполнения
+        backlog = queue.journal_backlog()
+        stats['journal'] = backlog
+        stats['total'] += backlog
+        stats['pending'] += backlog
 
-        for cmd in commands:
-            status = cmd.get('status', 'unknown')
-            stats[status] = stats.get(status, 0) + 1
+        # Глубина очереди по полосам приоритета
+        stats['lanes'] = queue.pending_by_priority()
+
+        # Задержки, пропускную способность и ошибки бот считает сам - читаем только его сводку
+        stats['metrics'] = load_metrics()
 
         return stats
     except Exception as e:
@@ -126,85 +172,226 @@ def analyze_commands():
 
 def reset_pending_commands():
     """
-    Сбрасывает метки времени для зависших команд со статусом pending
+    Освобождает команды, захваченные упавшими ботами (истекшие аренды и аренды завершившихся процессов)
 
-    :return: количество сброшенных команд
+    :return: количество освобожденных команд
     """
-    exists, valid, count = check_bot_commands_file()
-
-    if not exists or not valid or count == 0:
+    if not queue_storage_ready():
         return 0
 
     try:
-        with open(BOT_COMMANDS_FILE, 'r', encoding='utf-8') as f:
-            commands = json.load(f)
-
-        reset_count = 0
-        now = time.time()
-
-        for cmd in commands:
-            if cmd.get('status') == 'pending':
-                try:
-                    # Проверяем возраст команды
-                    cmd_time = float(cmd.get('timestamp', '0'))
-
-                    # Если команда висит больше 10 минут, сбрасываем её метку времени
-                    if now - cmd_time > 600:  # 10 минут в секундах
-                        cmd['timestamp'] = '0'
-                        reset_count += 1
-                except:
-                    # Если не удалось преобразовать timestamp, просто сбрасываем его
-                    cmd['timestamp'] = '0'
-                    reset_count += 1
+        reset_count = get_command_queue().release_expired_leases()
 
         if reset_count > 0:
-            # Сохраняем обновленные команды
-            with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(commands, f, ensure_ascii=False, indent=4)
-
-            logger.info(f"Сброшены метки времени для {reset_count} зависших команд")
+            logger.info(f"Освобождены аренды {reset_count} зависших команд")
 
         return reset_count
     except Exception as e:
-        logger.error(f"Ошибка при сбросе меток времени команд: {e}")
+        logger.error(f"Ошибка при освобождении аренд команд: {e}")
         traceback.print_exc()
         return 0
 
 
 def clear_completed_commands():
     """
-    Удаляет выполненные и ошибочные команды из файла
+    Переносит выполненные и ошибочные команды из очереди в архив
 
-    :return: количество удаленных команд
+    :return: количество перенесенных команд
     """
-    exists, valid, count = check_bot_commands_file()
+    if not queue_storage_ready():
+        return 0
 
-    if not exists or not valid or count == 0:
+    try:
+        removed_count = get_command_queue().clear_finished(CommandArchive())
+
+        if removed_count > 0:
+            logger.info(f"Перенесено в архив {removed_count} выполненных/ошибочных команд")
+
+        return removed_count
+    except Exception as e:
+        logger.error(f"Ошибка при очистке выполненных команд: {e}")
+        traceback.print_exc()
         return 0
 
+
+def list_dead_letters():
+    """
+    Выводит недоставленные команды
+
+    :return: список недоставленных команд
+    """
     try:
-        with open(BOT_COMMANDS_FILE, 'r', encoding='utf-8') as f:
-            commands = json.load(f)
+        commands = get_command_queue().dead_letters()
+    except Exception as e:
+        logger.error(f"Ошибка при чтении недоставленных команд: {e}")
+        traceback.print_exc()
+        return []
 
-        # Оставляем только команды со статусом pending
-        pending_commands = [cmd for cmd in commands if cmd.get('status') == 'pending']
+    for cmd in commands:
+        dead_at = datetime.fromtimestamp(cmd.get('dead_at', 0)).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{cmd.get('id')} {cmd.get('command')} {cmd.get('params')} попыток={cmd.get('attempts', 0)} "
+              f"({dead_at}): {cmd.get('error')}")
+    logger.info(f"Недоставленных команд: {len(commands)}")
+    return commands
 
-        removed_count = len(commands) - len(pending_commands)
 
-        if removed_count > 0:
-            # Сохраняем обновленные команды
-            with open(BOT_COMMANDS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(pending_commands, f, ensure_ascii=False, indent=4)
+def show_history(user_id=None, since=None, until=None, limit=None):
+    """
+    Выводит команды из архива (сегменты читаются по одному)
 
-            logger.info(f"Удалено {removed_count} выполненных/ошибочных команд")
+    :param user_id: Получатель
+    :param since: Первый день (ГГГГ-ММ-ДД)
+    :param until: Последний день (ГГГГ-ММ-ДД)
+    :param limit: Максимальное количество выводимых команд
+    :return: количество выведенных команд
+    """
+    count = 0
+    try:
+        for cmd in CommandArchive().iter_commands(since=since, until=until, user_id=user_id):
+            finished = cmd.get('completed_at') or datetime.fromtimestamp(
+                float(cmd.get('timestamp', 0))).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{finished} {cmd.get('id')} {cmd.get('command')} {cmd.get('status')} {cmd.get('params')}"
+                  + (f": {cmd.get('error')}" if cmd.get('error') else ""))
+            count += 1
+            if limit and count >= limit:
+                break
+    except Exception as e:
+        logger.error(f"Ошибка при чтении архива команд: {e}")
+        traceback.print_exc()
 
-        return removed_count
+    logger.info(f"Команд в архиве по запросу: {count}")
+    return count
+
+
+def requeue_dead_letters(command_ids=None):
+    """
+    Возвращает недоставленные команды в очередь
+
+    :param command_ids: ID команд (None или пустой список - все)
+    :return: количество возвращенных команд
+    """
+    try:
+        count = get_command_queue().requeue_dead_letters(set(command_ids) if command_ids else None)
+        logger.info(f"Возвращено в очередь {count} недоставленных команд")
+        return count
     except Exception as e:
-        logger.error(f"Ошибка при очистке выполненных команд: {e}")
+        logger.error(f"Ошибка при возврате недоставленных команд: {e}")
         traceback.print_exc()
         return 0
 
 
+def format_latency_metrics(metrics=None):
+    """
+    Возвращает строку с задержкой доставки команд по данным бота
+
+    :param metrics: Сводка метрик (по умолчанию читается из файла)
+    :return: строка с медианой и p99 задержки или None, если бот еще не сохранял метрики
+    """
+    metrics = load_metrics() if metrics is None else metrics
+    if not metrics or not metrics.get('count'):
+        return None
+
+    return (f"Задержка доставки (по {metrics['count']} командам): "
+            f"медиана={metrics['latency_median']:.3f} с, p99={metrics['latency_p99']:.3f} с")
+
+
+def _format_histogram(title, counts):
+    """Возвращает строку с перцентилями и непустыми корзинами гистограммы задержек"""
+    if not sum(counts):
+        return None
+
+    def bound(value):
+        return "∞" if value == float("inf") else f"{value:g}"
+
+    percentiles = ", ".join(f"{name}≤{bound(histogram_percentile(counts, fraction))} с"
+                            for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)))
+    buckets = " ".join(f"≤{bound(LATENCY_BUCKETS[index]) if index < len(LATENCY_BUCKETS) else '∞'}:{count}"
+                       for index, count in enumerate(counts) if count)
+    return f"{title} ({sum(counts)}): {percentiles} [{buckets}]"
+
+
+def format_queue_metrics(metrics=None):
+    """
+    Возвращает строки с гистограммами задержек, пропускной способностью,
+    ошибками по классам и возрастом самой старой ожидающей команды
+
+    :param metrics: Сводка метрик (по умолчанию читается из файла)
+    :return: список строк (пустой, если бот еще не сохранял метрики)
+    """
+    metrics = load_metrics() if metrics is None else metrics
+    if not metrics:
+        return []
+
+    lines = []
+    for title, key in (("Ожидание в очереди", 'queue_wait'), ("Отправка", 'send')):
+        line = _format_histogram(title, metrics.get(key, []))
+        if line:
+            lines.append(line)
+
+    completed_1, failed_1 = throughput_per_minute(metrics, 1)
+    completed_5, failed_5 = throughput_per_minute(metrics, 5)
+    lines.append(f"Пропускная способность: {completed_1:.1f}/мин за минуту, {completed_5:.1f}/мин за 5 минут; "
+                 f"ошибок {failed_1:.1f}/мин и {failed_5:.1f}/мин")
+
+    processed = metrics.get('completed', 0) + metrics.get('failed', 0)
+    errors = sorted(metrics.get('errors', {}).items(), key=lambda item: -item[1])
+    if errors:
+        lines.append("Ошибки по классам: " + ", ".join(
+            f"{error_class}={count} ({count * 100 / processed:.1f}%)" for error_class, count in errors))
+
+    oldest = metrics.get('oldest_pending_at')
+    if oldest:
+        lines.append(f"Самая старая ожидающая команда: {time.time() - oldest:.0f} с назад "
+                     f"(ожидают {metrics.get('pending', 0)})")
+    return lines
+
+
+def format_backpressure_stats():
+    """
+    Возвращает строку с глубиной очереди и счетчиками переполнения
+
+    :return: строка со статистикой или None при ошибке
+    """
+    try:
+        stats = get_command_queue().backpressure_stats()
+    except Exception as e:
+        logger.error(f"Ошибка при получении счетчиков переполнения очереди: {e}")
+        return None
+
+    return (f"Глубина очереди: {stats['depth']}/{stats['max_depth']}, максимум={stats['high_water']}, "
+            f"отложено={stats['spilled']} (ждут={stats['overflow']}), отклонено={stats['rejected']}")
+
+
+def format_lanes(stats):
+    """Возвращает строку с глубиной очереди по полосам приоритета или None"""
+    if not stats.get('lanes'):
+        return None
+    return "Ожидают по приоритетам: " + ", ".join(f"{lane}={count}" for lane, count in stats['lanes'].items())
+
+
+def format_broadcasts():
+    """
+    Возвращает строки с прогрессом незавершенных рассылок
+
+    :return: список строк (по одной на рассылку)
+    """
+    try:
+        commands = get_command_queue().all_commands()
+    except Exception as e:
+        logger.error(f"Ошибка при чтении рассылок: {e}")
+        return []
+
+    lines = []
+    for cmd in commands:
+        if cmd.get('command') != 'broadcast' or cmd.get('status') != 'pending':
+            continue
+        total = len(cmd.get('params', {}).get('user_ids', []))
+        progress = cmd.get('progress', {})
+        lines.append(f"Рассылка {cmd.get('id')}: обработано {progress.get('position', 0)}/{total}, "
+                     f"отправлено={progress.get('sent', 0)}, ошибок={progress.get('failed', 0)}")
+    return lines
+
+
 def monitor_commands(interval=5, duration=60):
     """
     Мониторит файл команд в течение указанного времени
@@ -221,7 +408,20 @@ def monitor_commands(interval=5, duration=60):
         while time.time() < end_time:
             stats = analyze_commands()
             logger.info(f"Статистика команд: всего={stats['total']}, ожидают={stats['pending']}, "
-                        f"выполнено={stats['completed']}, ошибок={stats['error']}")
+                        f"выполнено={stats['completed']}, ошибок={stats['error']}, недоставлено={stats['dead']}")
+            lanes = format_lanes(stats)
+            if lanes:
+                logger.info(lanes)
+            latency = format_latency_metrics(stats['metrics'] or {})
+            if latency:
+                logger.info(latency)
+            for line in format_queue_metrics(stats['metrics'] or {}):
+                logger.info(line)
+            backpressure = format_backpressure_stats()
+            if backpressure:
+                logger.info(backpressure)
+            for line in format_broadcasts():
+                logger.info(line)
 
             time.sleep(interval)
     except KeyboardInterrupt:
@@ -230,27 +430,121 @@ def monitor_commands(interval=5, duration=60):
     logger.info("Мониторинг завершен")
 
 
+def _rolling_rates(samples):
+    """
+    Считает скорости по первому и последнему замеру окна
+
+    :param samples: Замеры (время, поставлено, выполнено, ошибок) с нарастающими счетчиками
+    :return: (поставлено/с, выполнено/с, ошибок/с) или None, если замер один
+    """
+    if len(samples) < 2:
+        return None
+    first, last = samples[0], samples[-1]
+    elapsed = last[0] - first[0]
+    if elapsed <= 0:
+        return None
+    # Счетчики метрик уменьшаются, когда сводка устаревшего бота перестает учитываться
+    return tuple(max(0, last[i] - first[i]) / elapsed for i in range(1, 4))
+
+
+def format_tail(stats, samples, metrics):
+    """Возвращает строку мониторинга в режиме --tail"""
+    line = f"Очередь: ожидают={stats['depth']}, отложено={stats['overflow']}, недоставлено={stats['dead']}"
+    rates = _rolling_rates(samples)
+    if rates:
+        line += (f"; за {samples[-1][0] - samples[0][0]:.0f} с: поступает {rates[0]:.1f}/с, "
+                 f"выполняется {rates[1]:.1f}/с, ошибок {rates[2]:.1f}/с")
+    oldest = metrics.get('oldest_pending_at')
+    if oldest and stats['depth']:
+        line += f"; старейшая ждет {time.time() - oldest:.0f} с"
+    return line
+
+
+def tail_commands(interval=5, duration=60, window=TAIL_RATE_WINDOW):
+    """
+    Мониторит очередь инкрементально
+
+    В отличие от monitor_commands файл команд не перечитывается: на каждом шаге
+    читаются только файл смещений бота, байты журнала, дописанные с прошлого шага,
+    и сводка метрик. Поэтому мониторинг большой очереди почти не нагружает сервер.
+
+    :param interval: Интервал проверки в секундах
+    :param duration: Продолжительность мониторинга в секундах
+    :param window: Окно скользящих скоростей в секундах
+    """
+    logger.info(f"Запуск инкрементального мониторинга команд на {duration} секунд с интервалом {interval} секунд")
+
+    queue = get_command_queue()
+    samples = deque()
+    end_time = time.time() + duration
+
+    try:
+        while time.time() < end_time:
+            now = time.time()
+            stats = queue.tail_stats()
+            metrics = load_metrics() or {}
+            samples.append((now, stats['enqueued'], metrics.get('completed', 0), metrics.get('failed', 0)))
+            while len(samples) > 2 and now - samples[1][0] >= window:
+                samples.popleft()
+
+            logger.info(format_tail(stats, samples, metrics))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        logger.info("Мониторинг остановлен пользователем")
+
+    logger.info("Мониторинг завершен")
+
+
 def main():
     """Основная функция скрипта"""
     import argparse
 
     parser = argparse.ArgumentParser(description='Проверка и управление очередью команд бота')
     parser.add_argument('--send-test', type=str, help='Отправить тестовое сообщение указанному пользователю')
-    parser.add_argument('--reset', action='store_true', help='Сбросить метки времени для зависших команд')
-    parser.add_argument('--clear', action='store_true', help='Удалить выполненные и ошибочные команды')
+    parser.add_argument('--wait', type=int, default=30,
+                        help='Сколько секунд ждать доставки тестового сообщения (0 - не ждать)')
+    parser.add_argument('--reset', action='store_true', help='Освободить команды, захваченные упавшими ботами')
+    parser.add_argument('--clear', action='store_true', help='Перенести выполненные и ошибочные команды в архив')
+    parser.add_argument('--history', action='store_true', help='Показать команды из архива')
+    parser.add_argument('--user', type=str, help='Получатель для --history')
+    parser.add_argument('--since', type=str, help='Первый день для --history (ГГГГ-ММ-ДД)')
+    parser.add_argument('--until', type=str, help='Последний день для --history (ГГГГ-ММ-ДД)')
+    parser.add_argument('--limit', type=int, help='Максимум команд для --history')
+    parser.add_argument('--dead-letters', action='store_true', help='Показать недоставленные команды')
+    parser.add_argument('--requeue-dead', nargs='*', metavar='ID',
+                        help='Вернуть в очередь недоставленные команды (без ID - все)')
     parser.add_argument('--monitor', action='store_true', help='Мониторить очередь команд')
+    parser.add_argument('--tail', action='store_true',
+                        help='Мониторить инкрементально: только глубина очереди и скорости, без чтения файла команд')
     parser.add_argument('--interval', type=int, default=5, help='Интервал мониторинга в секундах')
     parser.add_argument('--duration', type=int, default=60, help='Продолжительность мониторинга в секундах')
+    parser.add_argument('--broadcast', type=str, help='Поставить в очередь рассылку с указанным текстом')
+    parser.add_argument('--audience', type=str, default='allowed_users',
+                        choices=['allowed_users', 'streamers', 'admins'], help='Получатели рассылки')
+    parser.add_argument('--migrate-sqlite', action='store_true',
+                        help=f'Перенести команды из bot_commands.json и журнала в {BOT_COMMANDS_DB}')
 
     args = parser.parse_args()
 
-    # Проверка файла команд
-    exists, valid, count = check_bot_commands_file()
+    # Проверка файла команд (при --tail файл команд не читается вовсе)
+    if args.tail:
+        pass
+    elif COMMAND_QUEUE_BACKEND == "sqlite":
+        logger.info(f"Очередь команд хранится в SQLite ({BOT_COMMANDS_DB})")
+    else:
+        exists, valid, count = check_bot_commands_file()
+
+        logger.info(f"Проверка файла команд: существует={exists}, корректен={valid}, команд={count}")
 
-    logger.info(f"Проверка файла команд: существует={exists}, корректен={valid}, команд={count}")
+    if args.migrate_sqlite:
+        migrate_file_queue_to_sqlite()
 
     if args.send_test:
-        send_test_message(args.send_test)
+        send_test_message(args.send_test, args.wait)
+
+    if args.broadcast:
+        from bot_command import broadcast_message
+        broadcast_message(args.broadcast, audience=args.audience)
 
     if args.reset:
         reset_pending_commands()
@@ -258,14 +552,39 @@ def main():
     if args.clear:
         clear_completed_commands()
 
-    if args.monitor:
+    if args.history:
+        show_history(args.user, args.since, args.until, args.limit)
+
+    if args.dead_letters:
+        list_dead_letters()
+
+    if args.requeue_dead is not None:
+        requeue_dead_letters(args.requeue_dead)
+
+    if args.tail:
+        tail_commands(args.interval, args.duration)
+    elif args.monitor:
         monitor_commands(args.interval, args.duration)
 
-    if not any([args.send_test, args.reset, args.clear, args.monitor]):
+    if not any([args.send_test, args.broadcast, args.reset, args.clear, args.history, args.dead_letters,
+                args.requeue_dead is not None, args.monitor, args.tail, args.migrate_sqlite]):
         # Если не указаны аргументы, просто выводим статистику
         stats = analyze_commands()
         print(f"Статистика команд: всего={stats['total']}, ожидают={stats['pending']}, "
-              f"выполнено={stats['completed']}, ошибок={stats['error']}")
+              f"выполнено={stats['completed']}, ошибок={stats['error']}, недоставлено={stats['dead']}")
+        lanes = format_lanes(stats)
+        if lanes:
+            print(lanes)
+        latency = format_latency_metrics(stats['metrics'] or {})
+        if latency:
+            print(latency)
+        for line in format_queue_metrics(stats['metrics'] or {}):
+            print(line)
+        backpressure = format_backpressure_stats()
+        if backpressure:
+            print(backpressure)
+        for line in format_broadcasts():
+            print(line)
 
     return 0
 
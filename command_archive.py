@@ -0,0 +1,230 @@
+"""
+Архив обработанных команд бота
+
+Выполненные и ошибочные команды не удаляются из очереди бесследно, а
+переносятся в сжатые сегменты архива - по одному на день выполнения
+(bot_commands_archive/commands-ГГГГ-ММ-ДД.jsonl.gz). Каждая запись сегмента -
+одна JSON-строка; новые команды дописываются отдельным gzip-блоком, поэтому
+сегмент не приходится перепаковывать. Блок, недописанный при сбое, обрезается
+перед следующей записью в сегмент, иначе за ним не прочитались бы и новые
+блоки. Очередь остается маленькой, а история
+отправок доступна для проверки: запросы читают сегменты по одному и
+построчно, не загружая архив в память.
+"""
+import os
+import re
+import json
+import gzip
+import zlib
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime, date
+
+from command_queue import BASE_DIR, command_timestamp, lock_file, unlock_file
+
+logger = logging.getLogger(__name__)
+
+# Каталог сегментов архива
+BOT_COMMANDS_ARCHIVE_DIR = os.path.join(BASE_DIR, "bot_commands_archive")
+# Сколько дней хранить сегменты (0 - хранить всегда)
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("BOT_COMMANDS_ARCHIVE_DAYS", "90"))
+# Уровень сжатия сегментов: архив пишется на каждом цикле очистки, максимальное сжатие не окупается
+ARCHIVE_COMPRESS_LEVEL = 6
+
+_SEGMENT_NAME = re.compile(r"^commands-(\d{4}-\d{2}-\d{2})\.jsonl\.gz$")
+
+# Проверенные сегменты: путь -> (inode, размер), при котором сегмент состоял из целых блоков
+_checked_segments = {}
+
+
+def command_finished_day(cmd):
+    """
+    Возвращает день выполнения команды (по completed_at, иначе по времени постановки)
+
+    :param cmd: Команда
+    :return: datetime.date
+    """
+    completed_at = cmd.get("completed_at")
+    if completed_at:
+        try:
+            return datetime.strptime(str(completed_at), "%Y-%m-%d %H:%M:%S").date()
+        except ValueError:
+            pass
+    return date.fromtimestamp(command_timestamp(cmd))
+
+
+def _to_date(value):
+    """Приводит дату фильтра (date, datetime или строка ГГГГ-ММ-ДД) к datetime.date"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value), "%Y-%m-%d").date()
+
+
+def _complete_length(data):
+    """
+    Возвращает длину начала сегмента, состоящего из целых gzip-блоков
+
+    :param data: Содержимое сегмента
+    :return: смещение конца последнего целого блока
+    """
+    pos = 0
+    while pos < len(data):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        end = pos
+        try:
+            while not decompressor.eof and end < len(data):
+                # Распакованные данные не нужны, ограничиваем их размер
+                decompressor.decompress(data[end:end + 65536])
+                end = min(end + 65536, len(data))
+        except zlib.error:
+            break
+        if not decompressor.eof:
+            break
+        pos = end - len(decompressor.unused_data)
+    return pos
+
+
+def _addressed_to(cmd, user_id):
+    """Проверяет, адресована ли команда пользователю (в том числе как получателю рассылки)"""
+    params = cmd.get("params", {})
+    if str(params.get("user_id")) == user_id:
+        return True
+    return user_id in (str(recipient) for recipient in params.get("user_ids", []))
+
+
+class CommandArchive:
+    """Посуточные сжатые сегменты обработанных команд"""
+
+    def __init__(self, archive_dir=BOT_COMMANDS_ARCHIVE_DIR, retention_days=ARCHIVE_RETENTION_DAYS):
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.lock_file = os.path.join(archive_dir, ".lock")
+
+    @contextmanager
+    def _locked(self):
+        """Блокировка архива между процессами (несколько ботов дописывают одни сегменты)"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            lock_file(fd)
+            try:
+                yield
+            finally:
+                unlock_file(fd)
+        finally:
+            os.close(fd)
+
+    def segment_path(self, day):
+        """Путь к сегменту за день"""
+        return os.path.join(self.archive_dir, f"commands-{day.isoformat()}.jsonl.gz")
+
+    def segments(self, since=None, until=None):
+        """
+        Возвращает сегменты архива в хронологическом порядке
+
+        :param since: Первый день (включительно)
+        :param until: Последний день (включительно)
+        :return: список пар (день, путь)
+        """
+        since, until = _to_date(since), _to_date(until)
+        if not os.path.isdir(self.archive_dir):
+            return []
+        result = []
+        for name in os.listdir(self.archive_dir):
+            match = _SEGMENT_NAME.match(name)
+            if not match:
+                continue
+            day = date.fromisoformat(match.group(1))
+            if (since and day < since) or (until and day > until):
+                continue
+            result.append((day, os.path.join(self.archive_dir, name)))
+        return sorted(result)
+
+    def append(self, commands):
+        """
+        Дописывает команды в сегменты по дням выполнения
+
+        :param commands: Список обработанных команд
+        :return: количество записанных команд
+        """
+        if not commands:
+            return 0
+        by_day = {}
+        for cmd in commands:
+            by_day.setdefault(command_finished_day(cmd), []).append(cmd)
+
+        with self._locked():
+            for day, day_commands in by_day.items():
+                data = "".join(json.dumps(cmd, ensure_ascii=False) + "\n" for cmd in day_commands)
+                # Блок сжимается целиком заранее и дописывается одной записью; при чтении
+                # блоки склеиваются в один поток
+                block = gzip.compress(data.encode("utf-8"), compresslevel=ARCHIVE_COMPRESS_LEVEL)
+                self._append_block(self.segment_path(day), block)
+            self._rotate()
+        return len(commands)
+
+    def _append_block(self, path, block):
+        """Дописывает gzip-блок в сегмент, сначала обрезав недописанный при сбое хвост (под блокировкой)"""
+        with open(path, "ab") as f:
+            st = os.fstat(f.fileno())
+            if _checked_segments.get(path) != (st.st_ino, st.st_size):
+                # Сегмент дописывал другой процесс или он еще не проверялся - ищем конец целых блоков
+                with open(path, "rb") as segment:
+                    valid = _complete_length(segment.read())
+                if valid < st.st_size:
+                    logger.warning(f"Обрезан недописанный блок сегмента архива {os.path.basename(path)}: "
+                                   f"{st.st_size - valid} байт")
+                    f.truncate(valid)
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+            _checked_segments[path] = (st.st_ino, f.tell())
+
+    def _rotate(self):
+        """Удаляет сегменты старше срока хранения (под блокировкой)"""
+        if not self.retention_days:
+            return
+        oldest = date.fromtimestamp(time.time() - self.retention_days * 86400)
+        for day, path in self.segments(until=oldest):
+            if day < oldest:
+                os.remove(path)
+                logger.info(f"Удален устаревший сегмент архива команд: {os.path.basename(path)}")
+
+    def iter_commands(self, since=None, until=None, command=None, user_id=None, status=None):
+        """
+        Лениво перебирает команды архива
+
+        Сегменты вне диапазона дат не открываются; остальные читаются построчно.
+
+        :param since: Первый день (date или "ГГГГ-ММ-ДД", включительно)
+        :param until: Последний день (включительно)
+        :param command: Тип команды (например, "send_message")
+        :param user_id: Получатель
+        :param status: Статус ("completed" или "error")
+        :return: генератор команд в хронологическом порядке сегментов
+        """
+        user_id = None if user_id is None else str(user_id)
+        for day, path in self.segments(since, until):
+            try:
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            cmd = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        if command is not None and cmd.get("command") != command:
+                            continue
+                        if status is not None and cmd.get("status") != status:
+                            continue
+                        if user_id is not None and not _addressed_to(cmd, user_id):
+                            continue
+                        yield cmd
+            except (OSError, EOFError) as e:
+                # Недописанный при сбое блок бывает только в конце сегмента (следующая запись
+                # его обрезает): команды до него уже выданы, переходим к следующему сегменту
+                logger.error(f"Ошибка при чтении сегмента архива {os.path.basename(path)}: {e}")
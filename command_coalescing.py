@@ -0,0 +1,105 @@
+"""
+Объединение сообщений одному получателю
+
+Если в пачке готовых к отправке команд несколько send_message одному
+пользователю, поставленных в очередь с разницей не больше COALESCE_WINDOW
+секунд (например, админ за одну сессию выдал пользователю несколько ролей),
+бот отправляет их одним сообщением в пределах лимита длины Telegram. Это
+экономит запросы к API и лимит чата (~1 сообщение в секунду).
+
+Отключается переменной окружения BOT_COMMANDS_COALESCE=0.
+"""
+import os
+
+from command_dispatcher import get_command_chat
+from command_queue import command_timestamp, command_priority
+
+# Объединять ли сообщения одному получателю
+COALESCE_MESSAGES = os.environ.get("BOT_COMMANDS_COALESCE", "1") != "0"
+# Максимальная разница времени постановки объединяемых сообщений (в секундах)
+COALESCE_WINDOW = 10
+# Максимальная длина сообщения Telegram (в единицах UTF-16, как считает Telegram)
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Разделитель объединенных сообщений
+COALESCE_SEPARATOR = "\n\n"
+
+
+def telegram_length(text):
+    """Длина текста так, как ее считает Telegram: в единицах UTF-16 (эмодзи - две единицы)"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _can_coalesce(cmd):
+    """Объединяются только простые текстовые сообщения без дополнительных параметров"""
+    params = cmd.get("params", {})
+    return (cmd.get("command") == "send_message" and set(params) == {"user_id", "text"}
+            and isinstance(params["text"], str) and bool(params["user_id"]))
+
+
+def coalesce_messages(commands, window=COALESCE_WINDOW, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Объединяет сообщения одному получателю
+
+    :param commands: Готовые к выполнению команды
+    :param window: Максимальная разница времени постановки (в секундах)
+    :param limit: Максимальная длина объединенного сообщения
+    :return: (команды к выполнению, список пар (объединенная команда, исходные команды))
+    """
+    batch = []
+    # Открытая группа для каждого чата: новые сообщения дописываются в нее, пока позволяют окно и длина
+    open_groups = {}
+
+    for cmd in commands:
+        chat_id = get_command_chat(cmd)
+        if not _can_coalesce(cmd):
+            # Сообщения после другой команды в тот же чат не переносим выше нее
+            open_groups.pop(chat_id, None)
+            batch.append([cmd])
+            continue
+
+        group = open_groups.get(chat_id)
+        if group is not None:
+            first = group[0]
+            length = (sum(telegram_length(member["params"]["text"]) for member in group)
+                      + telegram_length(COALESCE_SEPARATOR) * len(group))
+            if (command_priority(first) == command_priority(cmd)
+                    and abs(command_timestamp(cmd) - command_timestamp(first)) <= window
+                    and length + telegram_length(cmd["params"]["text"]) <= limit):
+                group.append(cmd)
+                continue
+
+        group = [cmd]
+        open_groups[chat_id] = group
+        batch.append(group)
+
+    commands_to_run = []
+    merged = []
+    for group in batch:
+        if len(group) == 1:
+            commands_to_run.append(group[0])
+            continue
+        first = group[0]
+        merged_cmd = {
+            "command": "send_message",
+            "params": {
+                "user_id": first["params"]["user_id"],
+                "text": COALESCE_SEPARATOR.join(member["params"]["text"] for member in group)
+            },
+            "priority": command_priority(first),
+            "timestamp": first.get("timestamp"),
+            "coalesced": [member.get("id") for member in group]
+        }
+        commands_to_run.append(merged_cmd)
+        merged.append((merged_cmd, group))
+
+    return commands_to_run, merged
+
+
+def spread_coalesced_result(merged_cmd, members):
+    """Переносит результат отправки объединенного сообщения на исходные команды"""
+    for member in members:
+        member["attempts"] = member.get("attempts", 0) + 1
+        for key in ("status", "completed_at", "error", "error_class", "retryable"):
+            if key in merged_cmd:
+                member[key] = merged_cmd[key]
+        member["coalesced_with"] = [cmd_id for cmd_id in merged_cmd["coalesced"] if cmd_id != member.get("id")]
@@ -0,0 +1,212 @@
+"""
+Параллельная отправка команд бота с учетом ограничений Telegram
+
+Команды группируются по чату получателя: внутри одного чата они выполняются
+по порядку, разные чаты обрабатываются параллельно. Количество одновременных
+запросов ограничено семафором, частота - двумя token bucket: общим на бота
+(~30 сообщений в секунду) и отдельным для каждого чата (~1 сообщение в секунду).
+При ответе RetryAfter на паузу ставится только затронутый чат.
+
+Токены общего лимита раздаются полосам приоритета (interactive, bulk)
+взвешенным циклическим перебором: пока ждут обе полосы, срочные команды
+получают LANE_WEIGHTS[interactive] токенов на каждый токен массовых.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from command_handlers import mark_failed
+from command_queue import PRIORITY_BULK, PRIORITY_INTERACTIVE, command_priority
+
+logger = logging.getLogger(__name__)
+
+# Максимальное число одновременных запросов к Telegram
+MAX_CONCURRENT_SENDS = 10
+# Общий лимит бота (сообщений в секунду)
+GLOBAL_RATE_LIMIT = 30
+# Лимит для одного чата (сообщений в секунду)
+PER_CHAT_RATE_LIMIT = 1
+# Сколько раз повторять команду после RetryAfter, прежде чем считать ее ошибочной
+MAX_RETRY_AFTER_ATTEMPTS = 5
+# Доли общего лимита для полос приоритета, когда ждут обе
+LANE_WEIGHTS = {PRIORITY_INTERACTIVE: 4, PRIORITY_BULK: 1}
+
+
+class TokenBucket:
+    """Token bucket: не более rate операций в секунду с запасом capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_full(self):
+        """True, если bucket полностью восстановился (его можно забыть)"""
+        self._refill()
+        return self._tokens >= self.capacity
+
+    async def acquire(self):
+        """Ждет, пока появится свободный токен, и забирает его"""
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class WeightedFairLimiter:
+    """Раздает токены общего лимита ожидающим полосам пропорционально весам"""
+
+    def __init__(self, bucket, weights):
+        self.bucket = bucket
+        self.weights = weights
+        self._waiters = {lane: deque() for lane in weights}
+        # Текущие счетчики сглаженного взвешенного перебора (как в nginx)
+        self._current = {lane: 0 for lane in weights}
+        self._granter = None
+
+    async def acquire(self, lane):
+        """Ждет токен общего лимита для команды полосы lane"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.create_task(self._grant())
+        await waiter
+
+    def _pick_lane(self):
+        active = [lane for lane, waiters in self._waiters.items() if waiters]
+        total = sum(self.weights[lane] for lane in active)
+        for lane in active:
+            self._current[lane] += self.weights[lane]
+        lane = max(active, key=self._current.get)
+        self._current[lane] -= total
+        return lane
+
+    def _drop_cancelled(self):
+        for waiters in self._waiters.values():
+            while waiters and waiters[0].done():
+                waiters.popleft()
+
+    async def _grant(self):
+        while True:
+            self._drop_cancelled()
+            if not any(self._waiters.values()):
+                return
+            await self.bucket.acquire()
+            self._drop_cancelled()
+            if not any(self._waiters.values()):
+                return
+            self._waiters[self._pick_lane()].popleft().set_result(None)
+
+
+def get_command_chat(cmd):
+    """
+    Возвращает чат, которому адресована команда
+
+    :param cmd: Команда
+    :return: ID чата (строка) или None, если команда не привязана к чату
+    """
+    user_id = cmd.get("params", {}).get("user_id")
+    return str(user_id) if user_id else None
+
+
+class CommandDispatcher:
+    """Выполняет пачку команд параллельно в пределах лимитов Telegram"""
+
+    def __init__(self, execute, max_concurrency=MAX_CONCURRENT_SENDS,
+                 global_rate=GLOBAL_RATE_LIMIT, per_chat_rate=PER_CHAT_RATE_LIMIT, on_give_up=None):
+        """
+        :param execute: Корутина execute(cmd), выполняющая одну команду
+        :param max_concurrency: Максимальное число одновременных запросов
+        :param global_rate: Общий лимит запросов в секунду
+        :param per_chat_rate: Лимит запросов в секунду для одного чата
+        :param on_give_up: Функция on_give_up(cmd, started_at) для команды, помеченной ошибкой
+                           после MAX_RETRY_AFTER_ATTEMPTS ответов RetryAfter (started_at - начало
+                           последней попытки); execute в этом случае результат не записывает
+        """
+        self.execute = execute
+        self.on_give_up = on_give_up
+        self.per_chat_rate = per_chat_rate
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._global_limiter = WeightedFairLimiter(TokenBucket(global_rate), LANE_WEIGHTS)
+        # Состояние чатов сохраняется между циклами, чтобы лимит не сбрасывался
+        self._chat_buckets = {}
+        self._chat_paused_until = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, capacity=1)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def dispatch(self, commands):
+        """
+        Выполняет команды и ждет завершения всех
+
+        :param commands: Список команд
+        """
+        lanes = {}
+        for cmd in commands:
+            chat_id = get_command_chat(cmd)
+            # Команды без чата не ограничены по порядку - каждая идет отдельно
+            key = chat_id if chat_id is not None else id(cmd)
+            lanes.setdefault(key, (chat_id, []))[1].append(cmd)
+
+        await asyncio.gather(*(self._run_lane(chat_id, lane) for chat_id, lane in lanes.values()))
+        self._forget_idle_chats()
+
+    async def _run_lane(self, chat_id, commands):
+        """Последовательно выполняет команды одного чата"""
+        for cmd in commands:
+            await self._run_command(chat_id, cmd)
+
+    async def _run_command(self, chat_id, cmd):
+        for attempt in range(MAX_RETRY_AFTER_ATTEMPTS + 1):
+            if chat_id is not None:
+                paused_until = self._chat_paused_until.get(chat_id, 0)
+                delay = paused_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._chat_bucket(chat_id).acquire()
+            await self._global_limiter.acquire(command_priority(cmd))
+
+            started_at = time.time()
+            try:
+                async with self._semaphore:
+                    await self.execute(cmd)
+                return
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRY_AFTER_ATTEMPTS:
+                    # Ошибка записывается так же, как другие ошибки отправки: цикл обработки
+                    # повторит команду позже или перенесет ее в недоставленные
+                    mark_failed(cmd, e)
+                    logger.error(f"Превышен лимит Telegram для команды {cmd.get('command')}: {e}")
+                    if self.on_give_up is not None:
+                        self.on_give_up(cmd, started_at)
+                    return
+
+                logger.warning(f"Telegram просит подождать {e.retry_after} с (чат {chat_id})")
+                if chat_id is not None:
+                    # Ставим на паузу только этот чат, остальные продолжают отправку
+                    self._chat_paused_until[chat_id] = time.monotonic() + e.retry_after
+                else:
+                    await asyncio.sleep(e.retry_after)
+
+    def _forget_idle_chats(self):
+        """Удаляет состояние чатов, у которых лимит полностью восстановился"""
+        now = time.monotonic()
+        for chat_id in [c for c, until in self._chat_paused_until.items() if until <= now]:
+            del self._chat_paused_until[chat_id]
+        for chat_id in [c for c, bucket in self._chat_buckets.items() if bucket.is_full()]:
+            del self._chat_buckets[chat_id]
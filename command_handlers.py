@@ -0,0 +1,235 @@
+"""
+Обработчики команд бота
+
+Каждый тип команды регистрируется декоратором command_handler: функция
+execute(bot, cmd) выполняет одну команду и записывает в нее результат
+(status, completed_at, error). Если работу типа выгоднее делать пачкой, тип
+регистрируется декоратором batch_handler: функция execute(bot, commands,
+dispatch) получает все готовые команды этого типа за цикл и выполняет их
+одним проходом, а отдельные запросы к Telegram передает в dispatch - общий
+диспетчер с лимитами. Новый тип команды добавляется здесь, цикл обработки
+в main.py менять не нужно.
+
+Типы команд:
+  send_message       {user_id, text} - сообщение пользователю
+  send_message_batch {user_ids, text} - одно сообщение нескольким пользователям
+  forward_to_admins  {text} - сообщение всем администраторам
+  edit_message       {user_id, message_id, text} - правка отправленного сообщения;
+                     из нескольких правок одного сообщения в пачке выполняется последняя
+"""
+from datetime import datetime
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramRetryAfter
+
+from bot_command import load_broadcast_audience
+from command_queue import command_priority
+
+# Тип команды -> execute(bot, cmd)
+COMMAND_HANDLERS = {}
+# Тип команды -> execute(bot, commands, dispatch)
+BATCH_HANDLERS = {}
+
+
+def command_handler(command):
+    """Регистрирует обработчик одной команды типа command"""
+    def decorator(func):
+        COMMAND_HANDLERS[command] = func
+        return func
+    return decorator
+
+
+def batch_handler(command):
+    """Регистрирует обработчик пачки команд типа command"""
+    def decorator(func):
+        BATCH_HANDLERS[command] = func
+        return func
+    return decorator
+
+
+def group_by_handler(commands):
+    """
+    Делит команды на выполняемые по одной и пачки типов с пакетными обработчиками
+
+    :param commands: Готовые к выполнению команды
+    :return: (команды для выполнения по одной, {тип: команды пачки})
+    """
+    single = []
+    batches = {}
+    for cmd in commands:
+        if cmd.get("command") in BATCH_HANDLERS:
+            batches.setdefault(cmd["command"], []).append(cmd)
+        else:
+            single.append(cmd)
+    return single, batches
+
+
+def mark_completed(cmd):
+    cmd["status"] = "completed"
+    cmd["completed_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def mark_failed(cmd, error, prefix="Ошибка отправки"):
+    """Записывает в команду ошибку Telegram; ошибки, которые не исправятся повтором, помечает"""
+    cmd["status"] = "error"
+    cmd["error"] = f"{prefix}: {str(error)}"
+    cmd["error_class"] = type(error).__name__
+    # Заблокированный бот или неверный чат не исправятся повтором
+    if isinstance(error, (TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, ValueError)):
+        cmd["retryable"] = False
+
+
+def mark_invalid(cmd, error):
+    """Записывает в команду ошибку в ее параметрах (повторять бессмысленно)"""
+    cmd["status"] = "error"
+    cmd["error"] = error
+    cmd["error_class"] = "InvalidCommand"
+    cmd["retryable"] = False
+
+
+# ---------- Команды по одной ----------
+
+@command_handler("send_message")
+async def send_message(bot, cmd):
+    params = cmd.get("params", {})
+    user_id = params.get("user_id")
+    text = params.get("text")
+
+    if not user_id or not text:
+        mark_invalid(cmd, "Missing user_id or text")
+        print(f"Отсутствует user_id или text в команде {cmd}")
+        return
+
+    print(f"Отправка сообщения пользователю {user_id}: {text[:30]}...")
+    try:
+        await bot.send_message(int(user_id), text)
+    except TelegramRetryAfter:
+        # Паузу для чата выдерживает диспетчер, затем команда будет повторена
+        raise
+    except Exception as e:
+        mark_failed(cmd, e)
+        print(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+        return
+
+    mark_completed(cmd)
+    print(f"Сообщение успешно отправлено пользователю {user_id}")
+
+
+@command_handler("edit_message")
+async def edit_message(bot, cmd):
+    params = cmd.get("params", {})
+    user_id = params.get("user_id")
+    message_id = params.get("message_id")
+    text = params.get("text")
+
+    if not user_id or not message_id or not text:
+        mark_invalid(cmd, "Missing user_id, message_id or text")
+        print(f"Отсутствует user_id, message_id или text в команде {cmd}")
+        return
+
+    try:
+        await bot.edit_message_text(text, chat_id=int(user_id), message_id=int(message_id))
+    except TelegramRetryAfter:
+        raise
+    except TelegramBadRequest as e:
+        # Текст уже такой, какой нужен (например, правку повторили после сбоя)
+        if "message is not modified" not in str(e):
+            mark_failed(cmd, e, "Ошибка правки сообщения")
+            print(f"Ошибка при правке сообщения {message_id} пользователя {user_id}: {e}")
+            return
+    except Exception as e:
+        mark_failed(cmd, e, "Ошибка правки сообщения")
+        print(f"Ошибка при правке сообщения {message_id} пользователя {user_id}: {e}")
+        return
+
+    mark_completed(cmd)
+
+
+# ---------- Пачки команд ----------
+
+def _spread_results(cmd, messages):
+    """
+    Переносит результаты отправки сообщений на команду, которая их породила
+
+    Команда выполнена, если дошло хотя бы одно сообщение: повтор отправил бы
+    остальным получателям дубли. Получатели с ошибками сохраняются в failed_user_ids.
+    """
+    failed = [message for message in messages if message.get("status") != "completed"]
+    cmd["results"] = {"sent": len(messages) - len(failed), "failed": len(failed)}
+    if failed:
+        cmd["failed_user_ids"] = [message["params"]["user_id"] for message in failed]
+
+    if failed and len(failed) == len(messages):
+        first = failed[0]
+        cmd["status"] = "error"
+        cmd["error"] = first.get("error", "Сообщение не отправлено")
+        cmd["error_class"] = first.get("error_class")
+        # Повторять стоит, только если повтор может помочь хотя бы одному получателю
+        if all(message.get("retryable") is False for message in failed):
+            cmd["retryable"] = False
+    else:
+        mark_completed(cmd)
+
+
+async def _send_to_recipients(commands, recipients, dispatch):
+    """
+    Отправляет текст каждой команды ее получателям одним проходом диспетчера
+
+    :param commands: Команды пачки
+    :param recipients: Функция cmd -> список получателей (None - параметры команды неверны)
+    :param dispatch: Корутина, выполняющая список команд send_message в пределах лимитов
+    """
+    messages = {}
+    for cmd in commands:
+        text = cmd.get("params", {}).get("text")
+        user_ids = recipients(cmd)
+        if not text or not user_ids:
+            mark_invalid(cmd, "Missing recipients or text")
+            continue
+        messages[cmd["id"]] = [{"command": "send_message", "params": {"user_id": user_id, "text": text},
+                                "priority": command_priority(cmd)}
+                               for user_id in dict.fromkeys(str(user_id) for user_id in user_ids)]
+
+    await dispatch([message for group in messages.values() for message in group])
+    for cmd in commands:
+        if cmd["id"] in messages:
+            _spread_results(cmd, messages[cmd["id"]])
+
+
+@batch_handler("send_message_batch")
+async def send_message_batch(bot, commands, dispatch):
+    await _send_to_recipients(commands, lambda cmd: cmd.get("params", {}).get("user_ids"), dispatch)
+
+
+@batch_handler("forward_to_admins")
+async def forward_to_admins(bot, commands, dispatch):
+    # Список администраторов читается один раз на всю пачку
+    admins = load_broadcast_audience("admins")
+    await _send_to_recipients(commands, lambda cmd: admins, dispatch)
+
+
+@batch_handler("edit_message")
+async def edit_message_batch(bot, commands, dispatch):
+    # Из нескольких правок одного сообщения имеет смысл только последняя
+    latest = {}
+    for cmd in commands:
+        params = cmd.get("params", {})
+        latest[(str(params.get("user_id")), str(params.get("message_id")))] = cmd
+
+    edits = {}
+    for cmd in commands:
+        params = cmd.get("params", {})
+        last = latest[(str(params.get("user_id")), str(params.get("message_id")))]
+        if last is not cmd:
+            mark_completed(cmd)
+            cmd["superseded_by"] = last["id"]
+            continue
+        edits[cmd["id"]] = {"command": "edit_message", "params": params, "priority": command_priority(cmd)}
+
+    await dispatch(list(edits.values()))
+    for cmd in commands:
+        edit = edits.get(cmd["id"])
+        if edit is None:
+            continue
+        for key in ("status", "completed_at", "error", "error_class", "retryable"):
+            if key in edit:
+                cmd[key] = edit[key]
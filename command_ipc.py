@@ -0,0 +1,310 @@
+"""
+Локальный канал команд между админкой и ботом
+
+Бот открывает в своем цикле событий Unix-сокет (bot_commands.sock) или, где
+Unix-сокетов нет, локальный TCP-порт. Админка отправляет по нему команды и
+запросы статуса и сразу получает подтверждение: команда уже записана в
+очередь, а бот разбужен без ожидания уведомления о файле. Если бот не
+запущен, производители пишут в очередь напрямую, поэтому сокет - только
+ускорение, а не замена долговечной очереди.
+
+Протокол: одна JSON-строка запроса - одна JSON-строка ответа.
+  {"op": "enqueue", "commands": [...], "overflow": ..., "timeout": ...}
+      -> {"ok": true, "accepted": N, "ids": [...]} или {"ok": false, "error": "queue_full", "message": ...}
+  {"op": "status", "id": ...} -> {"ok": true, "command": {...} или null}
+  {"op": "wait", "id": ..., "timeout": ...}
+      -> {"ok": true, "command": {...}} после выполнения команды или null по таймауту
+  {"op": "ping"} -> {"ok": true, "pid": ...}
+
+Адрес задается переменной окружения BOT_COMMANDS_IPC: путь к сокету,
+"host:port" для TCP или "0", чтобы отключить канал.
+"""
+import os
+import json
+import socket
+import asyncio
+import logging
+
+from command_queue import BASE_DIR, TERMINAL_STATUSES, QueueFull
+
+logger = logging.getLogger(__name__)
+
+# Сокет по умолчанию (на системах без Unix-сокетов канал по умолчанию выключен)
+BOT_COMMANDS_SOCKET = os.path.join(BASE_DIR, "bot_commands.sock")
+IPC_ADDRESS = os.environ.get("BOT_COMMANDS_IPC", BOT_COMMANDS_SOCKET if hasattr(socket, "AF_UNIX") else "0")
+# Время ожидания ответа бота; после него производитель пишет в очередь сам
+IPC_TIMEOUT = 2.0
+# Максимальная длина запроса (пачка команд в одной строке)
+IPC_MAX_REQUEST = 16 * 1024 * 1024
+# Максимальное время ожидания результата команды одним запросом wait
+MAX_WAIT_TIMEOUT = 600
+
+
+class IpcUnavailable(Exception):
+    """Бот не отвечает по локальному каналу"""
+
+
+def _parse_address(address):
+    """
+    Разбирает адрес канала
+
+    :return: ("unix", путь), ("tcp", (хост, порт)) или None, если канал отключен
+    """
+    if not address or address == "0":
+        return None
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and os.sep not in host:
+        return "tcp", (host or "127.0.0.1", int(port))
+    return "unix", address
+
+
+# ---------- Сервер (бот) ----------
+
+class CommandServer:
+    """Обработчик запросов локального канала в цикле событий бота"""
+
+    def __init__(self, queue, notify, address=IPC_ADDRESS):
+        """
+        :param queue: Очередь команд
+        :param notify: Функция, будящая цикл обработки команд
+        :param address: Адрес канала
+        """
+        self.queue = queue
+        self.notify = notify
+        self.address = _parse_address(address)
+        self._server = None
+        # Ожидающие результата: id команды -> список future
+        self._waiters = {}
+
+    async def start(self):
+        """
+        Открывает канал
+
+        :return: True если канал открыт; False если он отключен или адрес занят другим ботом
+        """
+        if self.address is None:
+            return False
+        kind, target = self.address
+        try:
+            if kind == "unix":
+                if os.path.exists(target):
+                    if _socket_alive(target):
+                        logger.warning(f"Канал команд {target} уже открыт другим ботом, используется только очередь")
+                        return False
+                    # Сокет остался от упавшего бота
+                    os.unlink(target)
+                self._server = await asyncio.start_unix_server(self._handle, path=target,
+                                                               limit=IPC_MAX_REQUEST)
+                os.chmod(target, 0o660)
+            else:
+                self._server = await asyncio.start_server(self._handle, host=target[0], port=target[1],
+                                                          limit=IPC_MAX_REQUEST)
+        except OSError as e:
+            logger.error(f"Не удалось открыть канал команд {target}: {e}")
+            return False
+        logger.info(f"Канал команд открыт: {target}")
+        return True
+
+    async def close(self):
+        """Закрывает канал"""
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+        kind, target = self.address
+        if kind == "unix":
+            try:
+                os.unlink(target)
+            except OSError:
+                pass
+
+    async def _handle(self, reader, writer):
+        """Обслуживает одно соединение: запросы читаются и выполняются по порядку"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self._dispatch(json.loads(line))
+                except QueueFull as e:
+                    response = {"ok": False, "error": "queue_full", "message": str(e)}
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке запроса канала команд: {e}")
+                    response = {"ok": False, "error": "internal", "message": str(e)}
+                writer.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def resolve(self, commands):
+        """
+        Будит ожидающих результата команд, достигших конечного статуса
+
+        :param commands: Команды, обработанные ботом
+        """
+        if not self._waiters:
+            return
+        for cmd in commands:
+            if cmd.get("status") not in TERMINAL_STATUSES:
+                continue
+            for future in self._waiters.pop(cmd.get("id"), []):
+                if not future.done():
+                    future.set_result(cmd)
+
+    def _lookup(self, command_id):
+        """Ищет команду в очереди и среди недоставленных"""
+        cmd = self.queue.get(command_id)
+        if cmd is None:
+            cmd = next((dead for dead in self.queue.dead_letters() if dead.get("id") == command_id), None)
+        return cmd
+
+    async def _wait(self, command_id, timeout):
+        """Ждет конечного статуса команды (без опроса очереди: бота будит resolve)"""
+        # Ожидающий регистрируется до поиска: результат, пришедший во время поиска, не будет пропущен
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(command_id, []).append(future)
+        try:
+            cmd = await asyncio.to_thread(self._lookup, command_id)
+            # Пока команда захвачена, ее статус промежуточный: ошибка еще может смениться повтором
+            if cmd is not None and cmd.get("status") in TERMINAL_STATUSES and not cmd.get("lease_owner"):
+                return cmd
+            return await asyncio.wait_for(future, min(float(timeout), MAX_WAIT_TIMEOUT))
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(command_id)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._waiters[command_id]
+
+    async def _dispatch(self, request):
+        op = request.get("op")
+        if op == "enqueue":
+            commands = request.get("commands") or []
+            # Запись в очередь (с возможным ожиданием места) выполняется вне цикла событий
+            accepted = await asyncio.to_thread(self.queue.enqueue_accepted, commands,
+                                               request.get("overflow"), request.get("timeout"))
+            if accepted:
+                self.notify()
+            return {"ok": True, "accepted": len(accepted), "ids": [cmd["id"] for cmd in accepted]}
+        if op == "status":
+            # Поиск читает файлы очереди - выполняем его вне цикла событий
+            return {"ok": True, "command": await asyncio.to_thread(self._lookup, request.get("id"))}
+        if op == "wait":
+            return {"ok": True, "command": await self._wait(request.get("id"), request.get("timeout") or 0)}
+        if op == "ping":
+            return {"ok": True, "pid": os.getpid()}
+        return {"ok": False, "error": "unknown_op", "message": f"Неизвестная операция: {op}"}
+
+
+def _socket_alive(path):
+    """Проверяет, принимает ли Unix-сокет соединения"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(IPC_TIMEOUT)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+# ---------- Клиент (админка, скрипты) ----------
+
+def _parse_response(line):
+    """Разбирает строку ответа бота; непонятный ответ считается недоступностью канала"""
+    if not line:
+        raise IpcUnavailable("бот закрыл соединение")
+    try:
+        response = json.loads(line)
+    except ValueError as e:
+        raise IpcUnavailable(f"неверный ответ бота: {e}")
+    if not isinstance(response, dict):
+        raise IpcUnavailable("неверный ответ бота: ожидался объект JSON")
+    return response
+
+
+def request_bot(request, address=IPC_ADDRESS, timeout=IPC_TIMEOUT):
+    """
+    Отправляет запрос боту по локальному каналу
+
+    :param request: Запрос ({"op": ..., ...})
+    :param address: Адрес канала
+    :param timeout: Время ожидания ответа в секундах
+    :return: Ответ бота
+    :raises IpcUnavailable: если канал отключен или бот не отвечает
+    """
+    parsed = _parse_address(address)
+    if parsed is None:
+        raise IpcUnavailable("канал команд отключен")
+    kind, target = parsed
+    if kind == "unix" and not os.path.exists(target):
+        raise IpcUnavailable("бот не запущен")
+
+    try:
+        if kind == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(target)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(target, timeout=timeout)
+    except OSError as e:
+        raise IpcUnavailable(str(e))
+
+    try:
+        sock.sendall(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    except OSError as e:
+        raise IpcUnavailable(str(e))
+    finally:
+        sock.close()
+
+    return _parse_response(line)
+
+
+async def request_bot_async(request, address=IPC_ADDRESS, timeout=IPC_TIMEOUT):
+    """
+    Отправляет запрос боту по локальному каналу, не блокируя цикл событий
+
+    :param request: Запрос ({"op": ..., ...})
+    :param address: Адрес канала
+    :param timeout: Время ожидания ответа в секундах
+    :return: Ответ бота
+    :raises IpcUnavailable: если канал отключен или бот не отвечает
+    """
+    parsed = _parse_address(address)
+    if parsed is None:
+        raise IpcUnavailable("канал команд отключен")
+    kind, target = parsed
+    if kind == "unix" and not os.path.exists(target):
+        raise IpcUnavailable("бот не запущен")
+
+    async def exchange():
+        if kind == "unix":
+            reader, writer = await asyncio.open_unix_connection(target, limit=IPC_MAX_REQUEST)
+        else:
+            reader, writer = await asyncio.open_connection(*target, limit=IPC_MAX_REQUEST)
+        try:
+            writer.write(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+            await writer.drain()
+            return await reader.readline()
+        finally:
+            writer.close()
+
+    try:
+        line = await asyncio.wait_for(exchange(), timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        raise IpcUnavailable(str(e) or "бот не отвечает")
+
+    return _parse_response(line)
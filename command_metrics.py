@@ -0,0 +1,335 @@
+"""
+Метрики обработки очереди команд бота
+
+Бот обновляет метрики по мере выполнения команд, не перечитывая очередь:
+- задержку доставки "постановка в очередь -> отправка" (скользящее окно, медиана и p99);
+- гистограммы ожидания в очереди (постановка -> начало выполнения) и
+  отправки (начало -> результат);
+- число выполненных и ошибочных команд по минутам за последний час;
+- число ошибок по классам;
+- глубину очереди и время постановки самой старой ожидающей команды.
+
+Сводка сохраняется в bot_commands.metrics.json не чаще раза в
+METRICS_SAVE_INTERVAL секунд, откуда ее читает check_bot_commands.py. Если
+очередь разбирают несколько ботов, каждый пишет свою запись, а load_metrics
+их объединяет.
+"""
+import os
+import json
+import logging
+import time
+from collections import Counter, deque
+
+from command_queue import BASE_DIR, CONSUMER_ID, command_timestamp, lock_file, unlock_file
+
+logger = logging.getLogger(__name__)
+
+# Файл со сводкой метрик очереди
+BOT_COMMANDS_METRICS_FILE = os.path.join(BASE_DIR, "bot_commands.metrics.json")
+# Количество последних задержек, по которым считаются перцентили
+LATENCY_WINDOW = 1000
+# Верхние границы корзин гистограмм задержек (в секундах); последняя корзина - все, что больше
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+# За сколько последних минут хранится число выполненных команд
+THROUGHPUT_MINUTES = 60
+# Как часто бот сохраняет сводку (в секундах)
+METRICS_SAVE_INTERVAL = 1.0
+# Записи ботов, не обновлявшиеся дольше этого времени, не учитываются (в секундах)
+METRICS_STALE_AFTER = 3600
+
+
+def _percentile(sorted_values, fraction):
+    """Возвращает перцентиль уже отсортированного списка (метод ближайшего ранга)"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _bucket(value):
+    """Возвращает номер корзины гистограммы для задержки"""
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if value <= bound:
+            return index
+    return len(LATENCY_BUCKETS)
+
+
+def histogram_percentile(counts, fraction):
+    """
+    Оценивает перцентиль по гистограмме
+
+    :param counts: Счетчики корзин LATENCY_BUCKETS
+    :param fraction: Доля (0.5 - медиана)
+    :return: верхняя граница корзины, в которую попадает перцентиль (None для пустой гистограммы,
+             float("inf") для последней корзины)
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = fraction * total
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= rank and count:
+            return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else float("inf")
+    return float("inf")
+
+
+def _due_at(cmd):
+    """Время, с которого команда могла выполняться (постановка, назначенное время или повтор)"""
+    due_at = command_timestamp(cmd)
+    for key in ("send_at", "next_attempt_at"):
+        try:
+            due_at = max(due_at, float(cmd.get(key) or 0))
+        except (TypeError, ValueError):
+            continue
+    return due_at
+
+
+class CommandMetrics:
+    """Метрики очереди, накапливаемые ботом по ходу выполнения команд"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._queue_wait = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._send = [0] * (len(LATENCY_BUCKETS) + 1)
+        # [минута (секунды с начала эпохи), выполнено, ошибок]
+        self._minutes = deque(maxlen=THROUGHPUT_MINUTES)
+        self._errors = Counter()
+        self._completed = 0
+        self._failed = 0
+        self._pending = 0
+        self._oldest_pending_at = None
+        self._started_at = time.time()
+        self._dirty = False
+        self._saved_at = 0.0
+
+    def record_sent(self, cmd, sent_at=None):
+        """
+        Учитывает задержку между постановкой команды в очередь и ее отправкой
+
+        :param cmd: Выполненная команда
+        :param sent_at: Время отправки (по умолчанию - текущее)
+        """
+        try:
+            enqueued_at = float(cmd.get("timestamp", 0))
+            # Для запланированных команд задержка считается от назначенного времени
+            send_at = float(cmd.get("send_at") or 0)
+        except (TypeError, ValueError):
+            return
+        # Метку "0" ставят скрипты восстановления - реальное время постановки неизвестно
+        if enqueued_at <= 0:
+            return
+        enqueued_at = max(enqueued_at, send_at)
+
+        sent_at = time.time() if sent_at is None else sent_at
+        self._latencies.append(max(0.0, sent_at - enqueued_at))
+        self._dirty = True
+
+    def record_started(self, cmd, started_at=None):
+        """
+        Учитывает время ожидания команды в очереди (с момента, когда ее можно было выполнять)
+
+        :param cmd: Команда, выполнение которой начинается
+        :param started_at: Время начала (по умолчанию - текущее)
+        """
+        due_at = _due_at(cmd)
+        # Сообщения рассылки не имеют своей метки времени - их ожидание учитывается в самой рассылке
+        if due_at <= 0:
+            return
+        started_at = time.time() if started_at is None else started_at
+        self._queue_wait[_bucket(max(0.0, started_at - due_at))] += 1
+        self._dirty = True
+
+    def record_finished(self, cmd, started_at, finished_at=None):
+        """
+        Учитывает результат выполнения команды: время отправки, пропускную способность и ошибки
+
+        :param cmd: Выполненная команда
+        :param started_at: Время начала выполнения
+        :param finished_at: Время получения результата (по умолчанию - текущее)
+        """
+        finished_at = time.time() if finished_at is None else finished_at
+        self._send[_bucket(max(0.0, finished_at - started_at))] += 1
+
+        minute = int(finished_at // 60) * 60
+        if not self._minutes or self._minutes[-1][0] != minute:
+            self._minutes.append([minute, 0, 0])
+        if cmd.get("status") == "completed":
+            self._completed += 1
+            self._minutes[-1][1] += 1
+            self.record_sent(cmd, finished_at)
+        elif cmd.get("status") == "error":
+            self._failed += 1
+            self._minutes[-1][2] += 1
+            self._errors[cmd.get("error_class") or "Unknown"] += 1
+        self._dirty = True
+
+    def observe_pending(self, commands):
+        """
+        Запоминает глубину очереди и время постановки самой старой ожидающей команды
+
+        :param commands: Ожидающие команды (уже прочитанные ботом при перестроении расписания)
+        """
+        commands = list(commands)
+        timestamps = [command_timestamp(cmd) for cmd in commands]
+        timestamps = [timestamp for timestamp in timestamps if timestamp > 0]
+        oldest = min(timestamps) if timestamps else None
+        if len(commands) != self._pending or oldest != self._oldest_pending_at:
+            self._pending = len(commands)
+            self._oldest_pending_at = oldest
+            self._dirty = True
+
+    def snapshot(self):
+        """
+        Возвращает сводку метрик
+
+        :return: {count, latency_median, latency_p99, queue_wait, send, throughput, errors,
+                  completed, failed, pending, oldest_pending_at, started_at, updated_at}
+        """
+        values = sorted(self._latencies)
+        return {
+            "count": len(values),
+            "latency_median": _percentile(values, 0.5),
+            "latency_p99": _percentile(values, 0.99),
+            "buckets": list(LATENCY_BUCKETS),
+            "queue_wait": list(self._queue_wait),
+            "send": list(self._send),
+            "throughput": [list(minute) for minute in self._minutes],
+            "errors": dict(self._errors),
+            "completed": self._completed,
+            "failed": self._failed,
+            "pending": self._pending,
+            "oldest_pending_at": self._oldest_pending_at,
+            "started_at": self._started_at,
+            "updated_at": time.time()
+        }
+
+    def save(self, path=BOT_COMMANDS_METRICS_FILE, force=False):
+        """
+        Сохраняет сводку этого бота в общий файл метрик
+
+        :param path: Файл метрик
+        :param force: Сохранить, даже если METRICS_SAVE_INTERVAL еще не прошел
+        """
+        if not self._dirty or (not force and time.monotonic() - self._saved_at < METRICS_SAVE_INTERVAL):
+            return
+        try:
+            fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                lock_file(fd)
+                consumers = _load_consumers(path)
+                now = time.time()
+                consumers = {consumer: snapshot for consumer, snapshot in consumers.items()
+                             if now - snapshot.get("updated_at", 0) < METRICS_STALE_AFTER}
+                consumers[CONSUMER_ID] = self.snapshot()
+                tmp_file = f"{path}.tmp.{os.getpid()}"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump({"consumers": consumers}, f, ensure_ascii=False, indent=4)
+                os.replace(tmp_file, path)
+            finally:
+                unlock_file(fd)
+                os.close(fd)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении метрик очереди команд: {e}")
+
+
+def _load_consumers(path):
+    """Читает записи метрик по ботам"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    # Файл в старом формате - сводка единственного бота
+    return data["consumers"] if "consumers" in data else {"": data}
+
+
+def _merge(snapshots):
+    """
+    Объединяет сводки нескольких ботов
+
+    Счетчики и гистограммы складываются. Медиана задержки доставки - среднее
+    медиан с весами по числу измерений, p99 - максимум по ботам (оценка сверху).
+    """
+    if len(snapshots) == 1:
+        return snapshots[0]
+
+    size = len(LATENCY_BUCKETS) + 1
+    merged = {
+        "count": 0, "latency_median": None, "latency_p99": None, "buckets": list(LATENCY_BUCKETS),
+        "queue_wait": [0] * size, "send": [0] * size, "throughput": [], "errors": Counter(),
+        "completed": 0, "failed": 0, "pending": 0, "oldest_pending_at": None,
+        "started_at": None, "updated_at": 0
+    }
+    minutes = {}
+    weighted_median = 0.0
+    for snapshot in snapshots:
+        count = snapshot.get("count", 0)
+        if count and snapshot.get("latency_median") is not None:
+            weighted_median += snapshot["latency_median"] * count
+            merged["count"] += count
+            merged["latency_p99"] = max(merged["latency_p99"] or 0.0, snapshot["latency_p99"])
+        for key in ("queue_wait", "send"):
+            for index, value in enumerate(snapshot.get(key, [])[:size]):
+                merged[key][index] += value
+        for minute, completed, failed in snapshot.get("throughput", []):
+            totals = minutes.setdefault(minute, [minute, 0, 0])
+            totals[1] += completed
+            totals[2] += failed
+        merged["errors"].update(snapshot.get("errors", {}))
+        merged["completed"] += snapshot.get("completed", 0)
+        merged["failed"] += snapshot.get("failed", 0)
+        for key, pick in (("oldest_pending_at", min), ("started_at", min)):
+            if snapshot.get(key) is not None:
+                merged[key] = snapshot[key] if merged[key] is None else pick(merged[key], snapshot[key])
+        # Глубину очереди видят все боты одинаково - берем самую свежую
+        if snapshot.get("updated_at", 0) >= merged["updated_at"]:
+            merged["updated_at"] = snapshot.get("updated_at", 0)
+            merged["pending"] = snapshot.get("pending", 0)
+    if merged["count"]:
+        merged["latency_median"] = weighted_median / merged["count"]
+    merged["throughput"] = [minutes[minute] for minute in sorted(minutes)]
+    merged["errors"] = dict(merged["errors"])
+    return merged
+
+
+def load_metrics(path=BOT_COMMANDS_METRICS_FILE):
+    """
+    Загружает сводку метрик, сохраненную ботами
+
+    :return: словарь метрик (объединенный по всем работающим ботам) или None, если файла нет
+    """
+    try:
+        consumers = _load_consumers(path)
+    except Exception as e:
+        logger.error(f"Ошибка при чтении метрик очереди команд: {e}")
+        return None
+    now = time.time()
+    snapshots = [snapshot for snapshot in consumers.values()
+                 if now - snapshot.get("updated_at", 0) < METRICS_STALE_AFTER]
+    if not snapshots:
+        return None
+    return _merge(snapshots)
+
+
+def throughput_per_minute(metrics, minutes=5, now=None):
+    """
+    Считает среднюю пропускную способность за последние минуты
+
+    :param metrics: Сводка метрик
+    :param minutes: Количество последних минут
+    :param now: Текущее время (по умолчанию - time.time())
+    :return: (выполнено в минуту, ошибок в минуту)
+    """
+    now = time.time() if now is None else now
+    since = now - minutes * 60
+    # Бот мог работать меньше запрошенного окна
+    span = max(60.0, min(minutes * 60, now - (metrics.get("started_at") or since)))
+    completed = failed = 0
+    for minute, minute_completed, minute_failed in metrics.get("throughput", []):
+        if minute + 60 > since:
+            completed += minute_completed
+            failed += minute_failed
+    return completed * 60 / span, failed * 60 / span
@@ -0,0 +1,1590 @@
+"""
+Очередь команд бота
+
+Производители (админка, скрипты диагностики) не переписывают bot_commands.json,
+а дописывают команды в журнал bot_commands.journal - по одной JSON-записи на строку.
+Бот читает журнал начиная с сохраненного смещения (bot_commands.offset), переносит
+новые команды в bot_commands.json и обновляет в нем статусы один раз за цикл.
+
+Каждая команда получает уникальный id при постановке в очередь; бот хранит
+команды в словаре id -> команда, поэтому поиск и смена статуса стоят O(1).
+
+В bot_commands.json остаются только ожидающие и захваченные команды: выполненные
+при каждом сохранении дописываются в хвост bot_commands.finished (по одной
+JSON-записи на строку), где их находят запросы статуса, а затем переносятся в
+архив. Поэтому объем записи за цикл зависит от глубины очереди, а не от числа
+команд, выполненных за последний час.
+
+Вместо файлов можно использовать SQLite (переменная окружения
+BOT_COMMANDS_BACKEND=sqlite): очередь хранится в bot_commands.db в режиме WAL
+с индексами по статусу и времени постановки.
+
+Очередь ограничена MAX_QUEUE_DEPTH ожидающими командами. Что делать с командой
+сверх лимита, определяет политика QUEUE_OVERFLOW_POLICY: "spill" - отложить в
+сегмент переполнения, который бот дочитывает по мере освобождения места,
+"block" - ждать места до ENQUEUE_BLOCK_TIMEOUT секунд, "reject" - сразу отказать.
+
+Команды, которые не удалось выполнить за отведенное число попыток, бот переносит
+в хранилище недоставленных (bot_commands.dead, в SQLite - статус "dead"), откуда
+их можно вернуть в очередь через check_bot_commands.py.
+
+У каждой команды есть приоритет (полоса): "interactive" - уведомления, которых
+пользователь ждет сейчас, и "bulk" - рассылки и массовые задания. Бот делит
+между полосами общий лимит Telegram с весами, поэтому массовая рассылка не
+задерживает срочные уведомления.
+
+Команда может нести ключ идемпотентности (idempotency_key). Очередь помнит
+ключи принятых команд IDEMPOTENCY_TTL секунд (не больше MAX_IDEMPOTENCY_KEYS
+штук) и отбрасывает повторы еще при постановке, например когда админка
+повторяет запрос после таймаута.
+
+Очередь могут разбирать несколько ботов одновременно. Перед выполнением бот
+захватывает команду (claim): записывает в нее свой идентификатор (lease_owner)
+и срок аренды (lease_expires). Команды, захваченные другим живым ботом,
+пропускаются; аренда бота, который упал, истекает сама или снимается сразу,
+если его процесс на этой машине уже завершился.
+"""
+import os
+import json
+import logging
+import time
+import shutil
+import threading
+import atexit
+import uuid
+import socket
+import sqlite3
+from contextlib import contextmanager
+
+from atomic_write import file_token, write_json_atomic, write_text_atomic
+from sqlite_storage import BOT_DATA_DB, STORAGE_BACKEND
+
+try:
+    import fcntl
+except ImportError:  # Windows - работаем без блокировок
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Получаем абсолютный путь к текущей директории
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Файл с состоянием очереди (им владеет бот)
+BOT_COMMANDS_FILE = os.path.join(BASE_DIR, "bot_commands.json")
+# Журнал новых команд (только дозапись)
+BOT_COMMANDS_JOURNAL = os.path.join(BASE_DIR, "bot_commands.journal")
+# Сегмент переполнения: команды, не поместившиеся в очередь
+BOT_COMMANDS_OVERFLOW = os.path.join(BASE_DIR, "bot_commands.overflow")
+# Смещения, до которых бот прочитал журнал и сегмент переполнения, и глубина очереди
+BOT_COMMANDS_OFFSET = os.path.join(BASE_DIR, "bot_commands.offset")
+# Счетчики переполнения очереди
+BOT_COMMANDS_QUEUE_STATS = os.path.join(BASE_DIR, "bot_commands.queue_stats.json")
+# Недавно выполненные команды (по одной JSON-записи на строку)
+BOT_COMMANDS_FINISHED = os.path.join(BASE_DIR, "bot_commands.finished")
+# Недоставленные команды (по одной JSON-записи на строку)
+BOT_COMMANDS_DEAD_LETTERS = os.path.join(BASE_DIR, "bot_commands.dead")
+# Ключи идемпотентности недавно принятых команд
+BOT_COMMANDS_DEDUP = os.path.join(BASE_DIR, "bot_commands.dedup.json")
+# Файл блокировки для производителей
+BOT_COMMANDS_LOCK = os.path.join(BASE_DIR, "bot_commands.lock")
+# База данных очереди для SQLite-хранилища; при хранении данных бота в SQLite
+# очередь по умолчанию лежит в той же базе (см. sqlite_storage.py)
+BOT_COMMANDS_DB = os.environ.get(
+    "BOT_COMMANDS_DB",
+    BOT_DATA_DB if STORAGE_BACKEND == "sqlite" else os.path.join(BASE_DIR, "bot_commands.db")
+)
+
+# Хранилище очереди: "json" (журнал + bot_commands.json) или "sqlite";
+# при хранении данных бота в SQLite очередь по умолчанию тоже в SQLite
+COMMAND_QUEUE_BACKEND = os.environ.get("BOT_COMMANDS_BACKEND", "sqlite" if STORAGE_BACKEND == "sqlite" else "json")
+
+# Максимальное количество ожидающих команд в очереди
+MAX_QUEUE_DEPTH = 1000
+# Политика при переполнении: "spill", "block" или "reject"
+QUEUE_OVERFLOW_POLICY = os.environ.get("BOT_COMMANDS_OVERFLOW", "spill")
+# Сколько секунд ждать места в очереди при политике "block"
+ENQUEUE_BLOCK_TIMEOUT = 10
+# Интервал проверки свободного места при политике "block"
+ENQUEUE_BLOCK_POLL = 0.1
+
+# fsync журнала выполняется не чаще, чем раз в JOURNAL_FSYNC_INTERVAL секунд
+# или после JOURNAL_FSYNC_BATCH записей; хвост пачки сбрасывается таймером
+# через JOURNAL_FSYNC_INTERVAL после первой несброшенной записи
+JOURNAL_FSYNC_BATCH = 64
+JOURNAL_FSYNC_INTERVAL = 1.0
+# Полностью прочитанный журнал обрезается, когда его размер превышает порог
+JOURNAL_TRUNCATE_SIZE = 64 * 1024
+
+# Сколько секунд помнить ключ идемпотентности и сколько ключей хранить максимум
+IDEMPOTENCY_TTL = 24 * 3600
+MAX_IDEMPOTENCY_KEYS = 10000
+
+# Приоритеты (полосы) команд
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+PRIORITY_LANES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+# Конечные статусы команды: после них бот к команде не возвращается
+TERMINAL_STATUSES = ("completed", "error", "dead")
+# Статусы, с которыми команда переносится из bot_commands.json в хвост выполненных
+FINISHED_STATUSES = ("completed", "error")
+# Сколько выполненных команд хвост хранит для запросов статуса, пока они не устарели
+FINISHED_TAIL_SIZE = 1000
+
+# Идентификатор этого процесса-потребителя (хост:pid) и срок аренды команды (в секундах)
+CONSUMER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_DURATION = 300
+
+
+class QueueFull(Exception):
+    """Очередь команд переполнена, команда не принята"""
+
+
+def new_command_id():
+    """Возвращает уникальный идентификатор команды"""
+    return uuid.uuid4().hex
+
+
+def lock_file(fd):
+    """Захватывает эксклюзивную блокировку файла (только на Unix-системах)"""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+
+def unlock_file(fd):
+    """Снимает блокировку файла"""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _count_lines(path, start, end):
+    """Считает записи (строки) в файле между смещениями start и end"""
+    if end <= start:
+        return 0
+    try:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start).count(b"\n")
+    except FileNotFoundError:
+        return 0
+
+
+def _read_segment(path, offset, limit=None):
+    """
+    Читает записи сегмента (журнала) начиная со смещения
+
+    :param path: Путь к сегменту
+    :param offset: Смещение начала чтения
+    :param limit: Максимальное количество записей (None - все)
+    :return: (записи, новое смещение)
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if offset > f.tell():
+                # Сегмент был обрезан после последнего сохранения смещения
+                offset = 0
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], 0
+
+    records = []
+    pos = 0
+    while limit is None or len(records) < limit:
+        # Недописанную последнюю строку оставляем до следующего цикла
+        end = data.find(b"\n", pos)
+        if end < 0:
+            break
+        line = data[pos:end]
+        pos = end + 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            logger.error(f"Пропущена поврежденная запись журнала команд: {e}")
+            continue
+        if isinstance(record, dict):
+            records.append(record)
+
+    return records, offset + pos
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _records_text(commands):
+    """Содержимое сегмента: по одной JSON-записи на строку"""
+    return "".join(json.dumps(cmd, ensure_ascii=False) + "\n" for cmd in commands)
+
+
+def command_timestamp(cmd):
+    """Возвращает время постановки команды в очередь как число"""
+    try:
+        return float(cmd.get("timestamp", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def command_priority(cmd):
+    """Возвращает полосу команды (команды без приоритета считаются срочными)"""
+    priority = cmd.get("priority")
+    return priority if priority in PRIORITY_LANES else PRIORITY_INTERACTIVE
+
+
+def _owner_alive(owner):
+    """
+    Проверяет, жив ли процесс-владелец аренды
+
+    Проверить можно только процесс на этой же машине; про остальные
+    считаем, что они живы, пока не истечет срок аренды.
+    """
+    host, _, pid = str(owner).rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def lease_blocked_until(cmd, now=None):
+    """
+    Возвращает время, до которого команда захвачена другим ботом
+
+    :param cmd: Команда
+    :param now: Текущее время (по умолчанию - time.time())
+    :return: время окончания чужой аренды или 0, если команду можно захватить
+    """
+    owner = cmd.get("lease_owner")
+    if not owner or owner == CONSUMER_ID:
+        return 0
+    try:
+        expires = float(cmd.get("lease_expires") or 0)
+    except (TypeError, ValueError):
+        return 0
+    now = time.time() if now is None else now
+    if expires <= now or not _owner_alive(owner):
+        return 0
+    return expires
+
+
+def release_lease(cmd):
+    """Снимает аренду с команды"""
+    cmd.pop("lease_owner", None)
+    cmd.pop("lease_expires", None)
+
+
+def _drop_duplicates(commands, is_known):
+    """
+    Отбрасывает команды с уже известными ключами идемпотентности
+
+    :param commands: Список команд
+    :param is_known: Функция key -> bool, проверяющая индекс ключей
+    :return: команды без повторов (из повторов внутри пачки остается первый)
+    """
+    fresh = []
+    batch_keys = set()
+    for cmd in commands:
+        key = cmd.get("idempotency_key")
+        if key is not None:
+            if key in batch_keys or is_known(key):
+                continue
+            batch_keys.add(key)
+        fresh.append(cmd)
+    return fresh
+
+
+class IdempotencyIndex:
+    """
+    Ключи идемпотентности с ограничением по времени жизни и количеству
+
+    Индекс общий для всех процессов-производителей: он хранится в файле и
+    перечитывается, только если файл изменил другой процесс. Все ключи живут
+    одинаковое время, поэтому порядок добавления совпадает с порядком истечения
+    и вытеснение снимает ключи с начала словаря.
+    Методы вызываются под блокировкой очереди.
+    """
+
+    def __init__(self, path=BOT_COMMANDS_DEDUP, ttl=IDEMPOTENCY_TTL, max_keys=MAX_IDEMPOTENCY_KEYS):
+        self.path = path
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._keys = {}
+        self._token = None
+
+    def _load(self):
+        # Файл заменяется целиком, поэтому в признак входит inode
+        token = file_token(self.path)
+        if token == self._token:
+            return
+        self._keys = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._keys = {key: expires_at for key, expires_at in json.load(f)}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка при чтении индекса ключей идемпотентности: {e}")
+        self._token = token
+
+    def _evict(self, now):
+        while self._keys:
+            key = next(iter(self._keys))
+            if self._keys[key] > now and len(self._keys) <= self.max_keys:
+                break
+            del self._keys[key]
+
+    def contains(self, key):
+        """Проверяет, принималась ли недавно команда с этим ключом"""
+        self._load()
+        expires_at = self._keys.get(key)
+        return expires_at is not None and expires_at > time.time()
+
+    def add(self, keys):
+        """Запоминает ключи принятых команд"""
+        keys = [key for key in keys if key is not None]
+        if not keys:
+            return
+        self._load()
+        now = time.time()
+        for key in keys:
+            # Ключ переносится в конец, чтобы порядок словаря совпадал с порядком истечения
+            self._keys.pop(key, None)
+            self._keys[key] = now + self.ttl
+        self._evict(now)
+
+        # Атомарно: другой процесс не прочитает наполовину записанный индекс
+        self._token = write_json_atomic(self.path, list(self._keys.items()), indent=None)
+
+
+def _revive_command(cmd):
+    """Готовит недоставленную команду к повторной постановке в очередь (id сохраняется)"""
+    # Ключ идемпотентности снимается: иначе возврат в очередь был бы отброшен как повтор
+    for key in ("attempts", "next_attempt_at", "retryable", "error", "error_class", "dead_at", "completed_at",
+                "idempotency_key", "lease_owner", "lease_expires"):
+        cmd.pop(key, None)
+    cmd["status"] = "pending"
+    cmd["timestamp"] = str(time.time())
+    return cmd
+
+
+class BaseCommandQueue:
+    """Общая для хранилищ логика постановки команд с учетом переполнения"""
+
+    def _append(self, commands, spill):
+        """
+        Атомарно проверяет глубину очереди и записывает команды
+
+        :param commands: Список команд
+        :param spill: Разрешено ли откладывать команды в сегмент переполнения
+        :return: ("queued" | "spilled" | None, если места нет; список записанных команд без повторов)
+        """
+        raise NotImplementedError
+
+    def _record_rejected(self, count):
+        """Увеличивает счетчик отклоненных команд"""
+        raise NotImplementedError
+
+    def enqueue(self, commands, overflow=None, timeout=None):
+        """
+        Ставит команды в очередь одной записью
+
+        :param commands: Список команд (словарей)
+        :param overflow: Политика переполнения ("spill", "block", "reject"), по умолчанию QUEUE_OVERFLOW_POLICY
+        :param timeout: Время ожидания места для политики "block", по умолчанию ENQUEUE_BLOCK_TIMEOUT
+        :return: количество принятых команд (в очередь или в сегмент переполнения);
+                 повторы по ключу идемпотентности не принимаются и не учитываются
+        :raises QueueFull: если очередь переполнена и команды не приняты
+        """
+        return len(self.enqueue_accepted(commands, overflow, timeout))
+
+    def enqueue_accepted(self, commands, overflow=None, timeout=None):
+        """
+        То же, что enqueue, но возвращает сами принятые команды
+
+        Нужно, когда одна запись объединяет команды нескольких производителей
+        и каждому надо сообщить, приняты ли его команды.
+
+        :return: список принятых команд
+        :raises QueueFull: если очередь переполнена и команды не приняты
+        """
+        if not commands:
+            return []
+
+        policy = overflow or QUEUE_OVERFLOW_POLICY
+        timeout = ENQUEUE_BLOCK_TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            result, accepted = self._append(commands, spill=(policy == "spill"))
+            if result and len(accepted) < len(commands):
+                logger.info(f"Отброшено {len(commands) - len(accepted)} повторных команд (idempotency_key)")
+            if result == "spilled":
+                logger.warning(f"Очередь команд заполнена, {len(accepted)} команд отложено в сегмент переполнения")
+            if result:
+                return accepted
+            if policy == "block" and time.monotonic() < deadline:
+                time.sleep(ENQUEUE_BLOCK_POLL)
+                continue
+
+            self._record_rejected(len(commands))
+            raise QueueFull(f"Очередь команд заполнена (лимит {MAX_QUEUE_DEPTH}), "
+                            f"не принято команд: {len(commands)}")
+
+
+class FileCommandQueue(BaseCommandQueue):
+    """Очередь команд на файлах: журнал для производителей и JSON-состояние для бота"""
+
+    def __init__(self, state_file=BOT_COMMANDS_FILE, journal_file=BOT_COMMANDS_JOURNAL,
+                 offset_file=BOT_COMMANDS_OFFSET, overflow_file=BOT_COMMANDS_OVERFLOW,
+                 stats_file=BOT_COMMANDS_QUEUE_STATS, lock_file=BOT_COMMANDS_LOCK,
+                 dead_letter_file=BOT_COMMANDS_DEAD_LETTERS, dedup_file=BOT_COMMANDS_DEDUP,
+                 finished_file=BOT_COMMANDS_FINISHED):
+        self.state_file = state_file
+        self.journal_file = journal_file
+        self.offset_file = offset_file
+        self.overflow_file = overflow_file
+        self.stats_file = stats_file
+        self.lock_file = lock_file
+        self.dead_letter_file = dead_letter_file
+        self.finished_file = finished_file
+        self._dedup = IdempotencyIndex(dedup_file)
+
+        # Состояние производителя
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        self._journal_fd = None
+        self._unsynced = 0
+        self._last_sync = 0.0
+        self._sync_timer = None
+        # Сегмент -> (inode, смещение, проверенный размер, записей после смещения)
+        self._backlog_cache = {}
+        # Сегмент -> (inode, размер) на момент прошлого подсчета дописанных записей (мониторинг)
+        self._appended = {}
+        self._enqueued = 0
+        self._high_water_seen = -1
+
+        # Состояние потребителя: команды по id в порядке постановки в очередь
+        self._commands = None
+        self._state_token = None
+        self._generation = None
+        self._offset = None
+        self._overflow_offset = None
+        # Несохраненные изменения этого процесса: измененные/новые команды и удаленные id
+        self._changed = {}
+        self._removed = set()
+        # Хвост выполненных команд: id -> команда и (inode, прочитанное смещение) его файла
+        self._finished = {}
+        self._finished_pos = None
+
+    @property
+    def watch_paths(self):
+        """Файлы, изменение которых означает появление новых команд"""
+        return [self.journal_file, self.overflow_file, self.state_file]
+
+    @contextmanager
+    def _locked(self):
+        """Блокировка очереди между потоками и процессами"""
+        with self._lock:
+            if self._lock_fd is None:
+                self._lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            lock_file(self._lock_fd)
+            try:
+                yield
+            finally:
+                unlock_file(self._lock_fd)
+
+    # ---------- Производитель ----------
+
+    def _read_checkpoint(self):
+        """Читает сохраненные ботом смещения и глубину очереди"""
+        try:
+            with open(self.offset_file, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            return {
+                "offset": int(checkpoint.get("offset", 0)),
+                "overflow_offset": int(checkpoint.get("overflow_offset", 0)),
+                "pending": int(checkpoint.get("pending", 0)),
+                "generation": int(checkpoint.get("generation", 0))
+            }
+        except FileNotFoundError:
+            return {"offset": 0, "overflow_offset": 0, "pending": 0, "generation": 0}
+        except Exception as e:
+            logger.error(f"Ошибка при чтении смещения журнала команд: {e}")
+            return {"offset": 0, "overflow_offset": 0, "pending": 0, "generation": 0}
+
+    def _segment_backlog(self, path, offset):
+        """Считает записи сегмента после смещения, досчитывая только новые байты"""
+        try:
+            st = os.stat(path)
+            inode, size = st.st_ino, st.st_size
+        except OSError:
+            inode, size = None, 0
+        if offset > size:
+            offset = 0
+
+        cache = self._backlog_cache.get(path)
+        # Сегмент, замененный целиком (другой inode) или обрезанный, пересчитываем с начала
+        if cache and cache[:2] == (inode, offset) and cache[2] <= size:
+            count = cache[3] + _count_lines(path, cache[2], size)
+        else:
+            count = _count_lines(path, offset, size)
+
+        self._backlog_cache[path] = (inode, offset, size, count)
+        return count
+
+    def _journal_backlog(self, offset):
+        """Считает непрочитанные записи журнала, досчитывая только новые байты"""
+        return self._segment_backlog(self.journal_file, offset)
+
+    def _appended_records(self, path):
+        """Считает записи, дописанные в сегмент с прошлого вызова"""
+        try:
+            st = os.stat(path)
+            inode, size = st.st_ino, st.st_size
+        except OSError:
+            inode, size = None, 0
+        last = self._appended.get(path)
+        # После обрезки сегмента считаем с начала; записи, дописанные перед самой обрезкой, теряются
+        start = last[1] if last and last[0] == inode and last[1] <= size else 0
+        self._appended[path] = (inode, size)
+        return _count_lines(path, start, size)
+
+    def _write_records(self, path, commands):
+        data = _records_text(commands).encode("utf-8")
+
+        if path == self.journal_file:
+            if self._journal_fd is None:
+                self._journal_fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            fd = self._journal_fd
+            _write_all(fd, data)
+
+            self._unsynced += len(commands)
+            now = time.monotonic()
+            if self._unsynced >= JOURNAL_FSYNC_BATCH or now - self._last_sync >= JOURNAL_FSYNC_INTERVAL:
+                os.fsync(fd)
+                self._unsynced = 0
+                self._last_sync = now
+            elif self._sync_timer is None:
+                # Если записей больше не будет, хвост пачки сбросит таймер
+                self._sync_timer = threading.Timer(JOURNAL_FSYNC_INTERVAL, self._flush_on_timer)
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+            return
+
+        # Сегмент переполнения пишется редко - fsync сразу
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            _write_all(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _append(self, commands, spill):
+        with self._locked():
+            commands = _drop_duplicates(commands, self._dedup.contains)
+            if not commands:
+                return "queued", commands
+
+            checkpoint = self._read_checkpoint()
+            depth = checkpoint["pending"] + self._journal_backlog(checkpoint["offset"])
+            overflow_waiting = _file_size(self.overflow_file) > checkpoint["overflow_offset"]
+
+            # Пока в сегменте переполнения есть команды, новые идут за ними, чтобы сохранить порядок
+            if spill and overflow_waiting:
+                result = "spilled"
+            elif depth + len(commands) <= MAX_QUEUE_DEPTH:
+                result = "queued"
+            elif spill:
+                result = "spilled"
+            else:
+                return None, []
+
+            if result == "queued":
+                self._write_records(self.journal_file, commands)
+                self._update_stats(high_water=depth + len(commands))
+            else:
+                self._write_records(self.overflow_file, commands)
+                self._update_stats(high_water=depth, spilled=len(commands))
+            self._dedup.add(cmd.get("idempotency_key") for cmd in commands)
+            return result, commands
+
+    def _load_stats(self):
+        stats = {"high_water": 0, "rejected": 0, "spilled": 0}
+        try:
+            with open(self.stats_file, 'r', encoding='utf-8') as f:
+                stats.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка при чтении счетчиков очереди команд: {e}")
+        return stats
+
+    def _update_stats(self, high_water=0, rejected=0, spilled=0):
+        """Обновляет счетчики переполнения (вызывается под блокировкой очереди)"""
+        # Файл переписывается только при новом максимуме или потере/откладывании команд
+        if high_water <= self._high_water_seen and not rejected and not spilled:
+            return
+
+        stats = self._load_stats()
+        changed = high_water > stats["high_water"] or rejected or spilled
+        stats["high_water"] = max(stats["high_water"], high_water)
+        stats["rejected"] += rejected
+        stats["spilled"] += spilled
+        self._high_water_seen = stats["high_water"]
+
+        if changed:
+            # Атомарно: мониторинг читает файл без блокировки очереди
+            write_json_atomic(self.stats_file, stats)
+
+    def _record_rejected(self, count):
+        with self._locked():
+            self._update_stats(rejected=count)
+
+    def flush(self):
+        """Сбрасывает на диск записи журнала, для которых еще не выполнялся fsync"""
+        with self._lock:
+            if self._journal_fd is not None and self._unsynced:
+                os.fsync(self._journal_fd)
+                self._unsynced = 0
+                self._last_sync = time.monotonic()
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._sync_timer = None
+        self.flush()
+
+    def journal_backlog(self):
+        """
+        Возвращает количество команд в журнале, которые бот еще не прочитал
+
+        :return: количество записей после сохраненного смещения
+        """
+        return self._journal_backlog(self._read_checkpoint()["offset"])
+
+    def backpressure_stats(self):
+        """
+        Возвращает состояние ограничения очереди
+
+        :return: {depth, max_depth, high_water, rejected, spilled, overflow}
+        """
+        checkpoint = self._read_checkpoint()
+        stats = self._load_stats()
+        stats["depth"] = checkpoint["pending"] + self._journal_backlog(checkpoint["offset"])
+        stats["max_depth"] = MAX_QUEUE_DEPTH
+        stats["overflow"] = self._segment_backlog(self.overflow_file, checkpoint["overflow_offset"])
+        return stats
+
+    def tail_stats(self):
+        """
+        Возвращает счетчики очереди для мониторинга, не читая bot_commands.json
+
+        Глубина берется из файла смещений бота и непрочитанной части журнала;
+        журнал и сегменты досчитываются только по байтам, дописанным с прошлого вызова.
+
+        :return: {depth, overflow, dead, enqueued} (enqueued - нарастающий счетчик
+                 поставленных команд, скорость считается по его разности)
+        """
+        checkpoint = self._read_checkpoint()
+        self._enqueued += self._appended_records(self.journal_file) + self._appended_records(self.overflow_file)
+        return {
+            "depth": checkpoint["pending"] + self._segment_backlog(self.journal_file, checkpoint["offset"]),
+            "overflow": self._segment_backlog(self.overflow_file, checkpoint["overflow_offset"]),
+            "dead": self._segment_backlog(self.dead_letter_file, 0),
+            "enqueued": self._enqueued
+        }
+
+    # ---------- Потребитель ----------
+
+    def _write_checkpoint(self):
+        pending = sum(1 for cmd in self._commands.values() if cmd.get("status") == "pending")
+        write_json_atomic(self.offset_file, {"offset": self._offset, "overflow_offset": self._overflow_offset,
+                                             "pending": pending, "generation": self._generation}, indent=None)
+
+    def _load_state(self):
+        """Загружает список команд из bot_commands.json"""
+        if not os.path.exists(self.state_file):
+            return []
+
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                file_content = f.read()
+            if not file_content.strip():
+                return []
+            commands = json.loads(file_content)
+            if not isinstance(commands, list):
+                raise ValueError("файл команд не является списком")
+            return commands
+        except Exception as e:
+            logger.error(f"Ошибка при чтении файла команд: {e}")
+            # Создаем резервную копию поврежденного файла
+            backup_file = f"{self.state_file}.bak.{int(time.time())}"
+            try:
+                shutil.copy2(self.state_file, backup_file)
+                logger.info(f"Создана резервная копия поврежденного файла: {backup_file}")
+            except Exception:
+                pass
+            return []
+
+    def _touch(self, cmd):
+        """Отмечает команду как измененную этим процессом"""
+        cmd["updated_at"] = time.time()
+        self._changed[cmd["id"]] = cmd
+
+    def _merge_state(self, commands):
+        """
+        Загружает записанное состояние и накладывает на него несохраненные изменения этого процесса
+
+        Из двух версий одной команды остается более новая (по updated_at), поэтому
+        несколько ботов могут по очереди сохранять файл, не затирая чужие статусы.
+        """
+        merged = {}
+        for cmd in commands:
+            if not cmd.get("id"):
+                # Команды, записанные старыми версиями без id
+                cmd["id"] = new_command_id()
+                self._changed[cmd["id"]] = cmd
+            merged[cmd["id"]] = cmd
+
+        for command_id, cmd in self._changed.items():
+            theirs = merged.get(command_id)
+            if theirs is None or cmd.get("updated_at", 0) >= theirs.get("updated_at", 0):
+                merged[command_id] = cmd
+        for command_id in self._removed:
+            merged.pop(command_id, None)
+
+        self._commands = merged
+
+    def _add_commands(self, commands):
+        """
+        Добавляет новые команды из журнала
+
+        :return: список добавленных команд (уже известные id пропускаются)
+        """
+        added = []
+        for cmd in commands:
+            if not cmd.get("id"):
+                cmd["id"] = new_command_id()
+            elif cmd["id"] in self._commands or cmd["id"] in self._removed or cmd["id"] in self._finished:
+                # Повторное чтение журнала после сбоя до сохранения смещения или повторная запись
+                # производителя, не дождавшегося ответа бота (команда могла быть уже выполнена)
+                continue
+            self._commands[cmd["id"]] = cmd
+            self._changed[cmd["id"]] = cmd
+            added.append(cmd)
+        return added
+
+    def _ensure_state(self):
+        """Перечитывает bot_commands.json, только если его изменил кто-то другой (без блокировки)"""
+        token = file_token(self.state_file)
+        if self._commands is None or token != self._state_token:
+            self._merge_state(self._load_state())
+            self._state_token = token
+
+    def _refresh_locked(self, checkpoint):
+        """Перечитывает состояние, если его сохранил другой процесс (вызывается под блокировкой)"""
+        token = file_token(self.state_file)
+        # Поколение в файле смещений меняется при каждой записи - надежнее mtime при частых записях
+        if self._commands is None or token != self._state_token or checkpoint["generation"] != self._generation:
+            self._merge_state(self._load_state())
+            self._state_token = token
+            self._generation = checkpoint["generation"]
+        self._offset = checkpoint["offset"]
+        self._overflow_offset = checkpoint["overflow_offset"]
+
+    def _ingest_locked(self):
+        """Переносит новые записи журнала и, если есть место, сегмента переполнения (под блокировкой)"""
+        self._refresh_finished()
+        records, self._offset = _read_segment(self.journal_file, self._offset)
+        self._add_commands(records)
+
+        # Освободившееся место заполняем командами из сегмента переполнения
+        room = MAX_QUEUE_DEPTH - sum(1 for cmd in self._commands.values() if cmd.get("status") == "pending")
+        if room > 0 and _file_size(self.overflow_file) != self._overflow_offset:
+            records, self._overflow_offset = _read_segment(self.overflow_file, self._overflow_offset, limit=room)
+            self._add_commands(records)
+
+    def _refresh_finished(self):
+        """Дочитывает хвост выполненных команд, дописанный с прошлого чтения (в том числе другими ботами)"""
+        for _ in range(2):
+            try:
+                inode = os.stat(self.finished_file).st_ino
+            except OSError:
+                self._finished, self._finished_pos = {}, None
+                return
+            if self._finished_pos is None or self._finished_pos[0] != inode:
+                # Хвост сжат (заменен новым файлом) - читаем с начала
+                self._finished, offset = {}, 0
+            else:
+                offset = self._finished_pos[1]
+            records, offset = _read_segment(self.finished_file, offset)
+            for cmd in records:
+                if cmd.get("id"):
+                    self._finished[cmd["id"]] = cmd
+            self._finished_pos = (inode, offset)
+            try:
+                # Файл заменили во время чтения - прочитанное могло быть из середины другого файла
+                if os.stat(self.finished_file).st_ino == inode:
+                    return
+            except OSError:
+                pass
+            self._finished_pos = None
+
+    def _move_finished_locked(self):
+        """Переносит выполненные команды, которые никто не выполняет, в хвост (под блокировкой)"""
+        finished = [cmd for cmd in self._commands.values()
+                    if cmd.get("status") in FINISHED_STATUSES and not cmd.get("lease_owner")]
+        if not finished:
+            return
+        # Сначала хвост, затем состояние: при сбое между шагами команда окажется в обоих местах, но не потеряется
+        self._write_records(self.finished_file, finished)
+        for cmd in finished:
+            del self._commands[cmd["id"]]
+            self._changed.pop(cmd["id"], None)
+            self._removed.add(cmd["id"])
+        self._refresh_finished()
+
+    def _save_locked(self, checkpoint):
+        """Сохраняет состояние и смещения одной записью, если что-то изменилось (под блокировкой)"""
+        self._move_finished_locked()
+        if (not self._changed and not self._removed and self._offset == checkpoint["offset"]
+                and self._overflow_offset == checkpoint["overflow_offset"]):
+            return
+
+        # Другие боты читают файл без блокировки, поэтому он заменяется целиком
+        self._state_token = write_json_atomic(self.state_file, list(self._commands.values()))
+        self._changed = {}
+        self._removed = set()
+
+        # Смещения сохраняем только после состояния: при сбое записи журнала будут прочитаны повторно
+        self._generation = checkpoint["generation"] + 1
+        self._write_checkpoint()
+
+        if self._offset >= JOURNAL_TRUNCATE_SIZE or self._overflow_offset >= JOURNAL_TRUNCATE_SIZE:
+            self._truncate_segments_locked()
+
+    def _sync(self, ingest=True):
+        """Сводит состояние этого процесса с файлом: чужие изменения, новые записи журнала, свои изменения"""
+        with self._locked():
+            checkpoint = self._read_checkpoint()
+            self._refresh_locked(checkpoint)
+            if ingest:
+                self._ingest_locked()
+            self._save_locked(checkpoint)
+
+    def fetch_pending(self):
+        """
+        Переносит новые команды из журнала в очередь и возвращает ожидающие выполнения
+
+        :return: Список команд со статусом pending
+        """
+        self._sync()
+        with self._lock:
+            return [cmd for cmd in self._commands.values() if cmd.get("status") == "pending"]
+
+    def all_commands(self):
+        """Возвращает все команды очереди: недавно выполненные, затем ожидающие в порядке постановки"""
+        # Чтение под блокировкой потоков: канал команд ищет команды из рабочего потока
+        with self._lock:
+            self._ensure_state()
+            self._refresh_finished()
+            finished = [cmd for command_id, cmd in self._finished.items() if command_id not in self._commands]
+            return finished + list(self._commands.values())
+
+    def get(self, command_id):
+        """
+        Возвращает команду по id
+
+        :param command_id: Идентификатор команды
+        :return: команда или None
+        """
+        with self._lock:
+            self._ensure_state()
+            cmd = self._commands.get(command_id)
+            if cmd is None:
+                self._refresh_finished()
+                cmd = self._finished.get(command_id)
+            return cmd
+
+    def claim(self, commands, lease=LEASE_DURATION):
+        """
+        Захватывает команды для выполнения этим процессом
+
+        Команду, захваченную другим живым ботом, пропускаем; аренда умершего бота
+        (истекшая или принадлежащая завершившемуся процессу) переходит к нам.
+        Повторный захват своей команды продлевает аренду.
+
+        :param commands: Команды, которые бот собирается выполнить
+        :param lease: Срок аренды в секундах
+        :return: Список захваченных команд (актуальные версии из очереди)
+        """
+        claimed = []
+        with self._locked():
+            checkpoint = self._read_checkpoint()
+            self._refresh_locked(checkpoint)
+            now = time.time()
+            for cmd in commands:
+                record = self._commands.get(cmd.get("id"))
+                if record is None or record.get("status") != "pending" or lease_blocked_until(record, now):
+                    continue
+                record["lease_owner"] = CONSUMER_ID
+                record["lease_expires"] = now + lease
+                self._touch(record)
+                claimed.append(record)
+            self._save_locked(checkpoint)
+        return claimed
+
+    def update(self, commands):
+        """
+        Обновляет команды по id. Изменения сохраняются на диск одной записью в commit()
+
+        :param commands: Список измененных команд
+        """
+        self._ensure_state()
+        for cmd in commands:
+            if cmd.get("id") not in self._commands:
+                continue
+            # Версия бота главнее: файл мог быть перечитан, пока команда выполнялась
+            self._commands[cmd["id"]] = cmd
+            self._touch(cmd)
+
+    def purge_finished(self, max_age, archive=None):
+        """
+        Удаляет из хвоста выполненные и ошибочные команды старше max_age секунд
+
+        Хвост переписывается, только когда удалить можно не меньше половины его
+        записей, поэтому каждая команда переписывается в среднем не больше одного раза.
+        Сверх FINISHED_TAIL_SIZE хранятся только команды моложе max_age.
+
+        :param max_age: Возраст команды в секундах
+        :param archive: Архив (CommandArchive), куда переносятся удаляемые команды
+        :return: количество удаленных команд
+        """
+        with self._locked():
+            self._refresh_finished()
+            now = time.time()
+            expired = {command_id for command_id, cmd in self._finished.items()
+                       if now - command_timestamp(cmd) >= max_age}
+            # Самые старые команды сверх размера хвоста тоже можно убрать, если хвост разросся вдвое
+            excess = len(self._finished) - FINISHED_TAIL_SIZE
+            if excess > FINISHED_TAIL_SIZE:
+                expired.update(list(self._finished)[:excess])
+            if not expired or len(expired) * 2 < len(self._finished):
+                return 0
+
+            if archive is not None:
+                archive.append([self._finished[command_id] for command_id in expired])
+            remaining = [cmd for command_id, cmd in self._finished.items() if command_id not in expired]
+            write_text_atomic(self.finished_file, _records_text(remaining))
+            self._refresh_finished()
+        return len(expired)
+
+    # ---------- Недоставленные команды ----------
+
+    def bury(self, commands):
+        """
+        Переносит команды из очереди в хранилище недоставленных
+
+        :param commands: Список команд, исчерпавших попытки
+        """
+        if not commands:
+            return
+        self._ensure_state()
+        for cmd in commands:
+            release_lease(cmd)
+            cmd["status"] = "dead"
+            cmd["dead_at"] = time.time()
+
+        # Сначала сохраняем запись о команде, затем убираем ее из очереди:
+        # при сбое между шагами команда будет выполнена повторно, но не потеряна
+        with self._locked():
+            self._write_records(self.dead_letter_file, commands)
+        for cmd in commands:
+            self._commands.pop(cmd.get("id"), None)
+            self._changed.pop(cmd.get("id"), None)
+            self._removed.add(cmd.get("id"))
+
+    def dead_letters(self):
+        """
+        Возвращает недоставленные команды
+
+        :return: Список команд (повторные записи с одним id схлопываются)
+        """
+        records, _ = _read_segment(self.dead_letter_file, 0)
+        return list({cmd["id"]: cmd for cmd in records if cmd.get("id")}.values())
+
+    def requeue_dead_letters(self, command_ids=None):
+        """
+        Возвращает недоставленные команды в очередь
+
+        :param command_ids: ID команд (None - все недоставленные)
+        :return: количество возвращенных команд
+        """
+        selected = [cmd for cmd in self.dead_letters() if command_ids is None or cmd["id"] in command_ids]
+        if not selected:
+            return 0
+
+        # Команды сохраняют id, поэтому повторный возврат после сбоя не создаст дублей
+        self.enqueue([_revive_command(cmd) for cmd in selected], overflow="spill")
+
+        requeued = {cmd["id"] for cmd in selected}
+        with self._locked():
+            write_text_atomic(self.dead_letter_file,
+                              _records_text(cmd for cmd in self.dead_letters() if cmd["id"] not in requeued))
+        return len(selected)
+
+    # ---------- Обслуживание (check_bot_commands.py) ----------
+
+    def count_by_status(self):
+        """
+        Считает команды по статусам (без непрочитанной части журнала)
+
+        :return: {статус: количество}
+        """
+        counts = {}
+        for cmd in self.all_commands():
+            status = cmd.get("status", "unknown")
+            counts[status] = counts.get(status, 0) + 1
+        dead = len(self.dead_letters())
+        if dead:
+            counts["dead"] = dead
+        return counts
+
+    def pending_by_priority(self):
+        """
+        Считает ожидающие команды по полосам, включая непрочитанную часть журнала
+
+        :return: {полоса: количество}
+        """
+        self._ensure_state()
+        counts = {lane: 0 for lane in PRIORITY_LANES}
+        for cmd in self._commands.values():
+            if cmd.get("status") == "pending":
+                counts[command_priority(cmd)] += 1
+
+        records, _ = _read_segment(self.journal_file, self._read_checkpoint()["offset"])
+        for cmd in records:
+            if cmd.get("id") not in self._commands:
+                counts[command_priority(cmd)] += 1
+        return counts
+
+    def release_expired_leases(self):
+        """
+        Снимает истекшие аренды и аренды завершившихся процессов
+
+        Бот и сам забирает такие команды, когда подходит их время; снятие
+        аренды лишь делает их свободными сразу и видимыми в статистике.
+
+        :return: количество освобожденных команд
+        """
+        released = 0
+        with self._locked():
+            checkpoint = self._read_checkpoint()
+            self._refresh_locked(checkpoint)
+            now = time.time()
+            for cmd in self._commands.values():
+                if cmd.get("lease_owner") and not lease_blocked_until(cmd, now) and cmd.get("lease_owner") != CONSUMER_ID:
+                    release_lease(cmd)
+                    self._touch(cmd)
+                    released += 1
+            self._save_locked(checkpoint)
+        return released
+
+    def clear_finished(self, archive=None):
+        """
+        Удаляет все команды, кроме ожидающих выполнения
+
+        :param archive: Архив (CommandArchive), куда переносятся удаляемые команды
+        :return: количество удаленных команд
+        """
+        with self._locked():
+            checkpoint = self._read_checkpoint()
+            self._refresh_locked(checkpoint)
+            removed = [command_id for command_id, cmd in self._commands.items() if cmd.get("status") != "pending"]
+            if archive is not None:
+                archive.append([self._commands[command_id] for command_id in removed])
+            for command_id in removed:
+                del self._commands[command_id]
+                self._changed.pop(command_id, None)
+                self._removed.add(command_id)
+            self._save_locked(checkpoint)
+
+            # Хвост выполненных команд очищается целиком
+            self._refresh_finished()
+            if self._finished:
+                if archive is not None:
+                    archive.append(list(self._finished.values()))
+                removed.extend(self._finished)
+                write_text_atomic(self.finished_file, "")
+                self._refresh_finished()
+        return len(removed)
+
+    def commit(self):
+        """Сохраняет изменения этого процесса одной записью, сводя их с изменениями других ботов"""
+        self._sync(ingest=False)
+
+    def _truncate_segments_locked(self):
+        """Обрезает полностью прочитанные журнал и сегмент переполнения (под блокировкой)"""
+        truncated = False
+        if self._offset and _file_size(self.journal_file) == self._offset:
+            os.truncate(self.journal_file, 0)
+            self._offset = 0
+            truncated = True
+        if self._overflow_offset and _file_size(self.overflow_file) == self._overflow_offset:
+            os.truncate(self.overflow_file, 0)
+            self._overflow_offset = 0
+            truncated = True
+        if truncated:
+            self._write_checkpoint()
+            logger.debug("Прочитанные сегменты очереди команд обрезаны")
+
+
+class SqliteCommandQueue(BaseCommandQueue):
+    """
+    Очередь команд в SQLite (режим WAL)
+
+    Команда хранится целиком в колонке data (JSON), а status и timestamp
+    вынесены в отдельные индексированные колонки для выборок и очистки.
+    Статус в колонке главнее статуса внутри data. Команды сверх лимита
+    хранятся со статусом "spilled", пока для них не освободится место.
+    """
+
+    def __init__(self, db_file=BOT_COMMANDS_DB):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._pending_updates = {}
+        self._conn = sqlite3.connect(db_file, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS commands (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                command TEXT,
+                status TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_commands_status ON commands (status, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_commands_timestamp ON commands (timestamp);
+            CREATE TABLE IF NOT EXISTS queue_stats (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys (expires_at);
+        """)
+
+    @property
+    def watch_paths(self):
+        """Файлы, изменение которых означает появление новых команд"""
+        # В режиме WAL новые записи сначала попадают в файл -wal
+        return [self.db_file, self.db_file + "-wal"]
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _execute_many(self, sql, rows):
+        with self._transaction() as conn:
+            return conn.executemany(sql, rows).rowcount
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _load_row(status, data):
+        cmd = json.loads(data)
+        cmd["status"] = status
+        return cmd
+
+    def _row(self, cmd, status=None):
+        if not cmd.get("id"):
+            cmd["id"] = new_command_id()
+        return (cmd["id"], cmd.get("command"), status or cmd.get("status", "pending"),
+                command_timestamp(cmd), json.dumps(cmd, ensure_ascii=False))
+
+    @staticmethod
+    def _bump_stats(conn, high_water=0, rejected=0, spilled=0):
+        conn.execute("INSERT INTO queue_stats (key, value) VALUES ('high_water', ?) "
+                     "ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)", (high_water,))
+        for key, delta in (("rejected", rejected), ("spilled", spilled)):
+            if delta:
+                conn.execute("INSERT INTO queue_stats (key, value) VALUES (?, ?) "
+                             "ON CONFLICT (key) DO UPDATE SET value = value + excluded.value", (key, delta))
+
+    @staticmethod
+    def _remember_keys(conn, keys):
+        """Запоминает ключи идемпотентности и вытесняет истекшие и лишние"""
+        keys = [key for key in keys if key is not None]
+        if not keys:
+            return
+        now = time.time()
+        conn.executemany("INSERT OR REPLACE INTO idempotency_keys (key, expires_at) VALUES (?, ?)",
+                         [(key, now + IDEMPOTENCY_TTL) for key in keys])
+        conn.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+        excess = conn.execute("SELECT COUNT(*) FROM idempotency_keys").fetchone()[0] - MAX_IDEMPOTENCY_KEYS
+        if excess > 0:
+            conn.execute("DELETE FROM idempotency_keys WHERE key IN "
+                         "(SELECT key FROM idempotency_keys ORDER BY expires_at LIMIT ?)", (excess,))
+
+    # ---------- Производитель ----------
+
+    def _append(self, commands, spill):
+        with self._transaction() as conn:
+            def is_known(key):
+                return conn.execute("SELECT 1 FROM idempotency_keys WHERE key = ? AND expires_at > ?",
+                                    (key, time.time())).fetchone() is not None
+
+            commands = _drop_duplicates(commands, is_known)
+            if not commands:
+                return "queued", commands
+
+            depth = conn.execute("SELECT COUNT(*) FROM commands WHERE status = 'pending'").fetchone()[0]
+            overflow_waiting = conn.execute("SELECT 1 FROM commands WHERE status = 'spilled' LIMIT 1").fetchone()
+
+            # Пока есть отложенные команды, новые идут за ними, чтобы сохранить порядок
+            if spill and overflow_waiting:
+                result = "spilled"
+            elif depth + len(commands) <= MAX_QUEUE_DEPTH:
+                result = "queued"
+            elif spill:
+                result = "spilled"
+            else:
+                return None, []
+
+            status = "pending" if result == "queued" else "spilled"
+            conn.executemany(
+                "INSERT OR IGNORE INTO commands (id, command, status, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+                [self._row(cmd, status) for cmd in commands]
+            )
+            if result == "queued":
+                self._bump_stats(conn, high_water=depth + len(commands))
+            else:
+                self._bump_stats(conn, high_water=depth, spilled=len(commands))
+            self._remember_keys(conn, [cmd.get("idempotency_key") for cmd in commands])
+            return result, commands
+
+    def _record_rejected(self, count):
+        with self._transaction() as conn:
+            self._bump_stats(conn, rejected=count)
+
+    def flush(self):
+        """Транзакции SQLite фиксируются сразу - сбрасывать нечего"""
+
+    def journal_backlog(self):
+        """Журнала у SQLite-хранилища нет"""
+        return 0
+
+    def backpressure_stats(self):
+        """
+        Возвращает состояние ограничения очереди
+
+        :return: {depth, max_depth, high_water, rejected, spilled, overflow}
+        """
+        stats = {"high_water": 0, "rejected": 0, "spilled": 0}
+        stats.update(dict(self._query("SELECT key, value FROM queue_stats")))
+        counts = self.count_by_status()
+        stats["depth"] = counts.get("pending", 0)
+        stats["max_depth"] = MAX_QUEUE_DEPTH
+        stats["overflow"] = counts.get("spilled", 0)
+        return stats
+
+    def tail_stats(self):
+        """
+        Возвращает счетчики очереди для мониторинга (выборки только по индексу статуса)
+
+        :return: {depth, overflow, dead, enqueued} (enqueued - последний выданный seq,
+                 скорость постановки считается по его разности)
+        """
+        counts = dict(self._query("SELECT status, COUNT(*) FROM commands "
+                                  "WHERE status IN ('pending', 'spilled', 'dead') GROUP BY status"))
+        rows = self._query("SELECT seq FROM sqlite_sequence WHERE name = 'commands'")
+        return {
+            "depth": counts.get("pending", 0),
+            "overflow": counts.get("spilled", 0),
+            "dead": counts.get("dead", 0),
+            "enqueued": rows[0][0] if rows else 0
+        }
+
+    # ---------- Потребитель ----------
+
+    def fetch_pending(self):
+        """
+        Возвращает ожидающие выполнения команды (выборка по индексу статуса)
+
+        :return: Список команд со статусом pending
+        """
+        with self._transaction() as conn:
+            depth = conn.execute("SELECT COUNT(*) FROM commands WHERE status = 'pending'").fetchone()[0]
+            room = MAX_QUEUE_DEPTH - depth
+            if room > 0:
+                # Освободившееся место заполняем отложенными командами
+                conn.execute("UPDATE commands SET status = 'pending' WHERE seq IN "
+                             "(SELECT seq FROM commands WHERE status = 'spilled' ORDER BY seq LIMIT ?)", (room,))
+            rows = conn.execute("SELECT status, data FROM commands WHERE status = 'pending' ORDER BY seq").fetchall()
+        return [self._load_row(status, data) for status, data in rows]
+
+    def all_commands(self):
+        """Возвращает все команды очереди в порядке постановки"""
+        rows = self._query("SELECT status, data FROM commands ORDER BY seq")
+        return [self._load_row(status, data) for status, data in rows]
+
+    def get(self, command_id):
+        """
+        Возвращает команду по id
+
+        :param command_id: Идентификатор команды
+        :return: команда или None
+        """
+        rows = self._query("SELECT status, data FROM commands WHERE id = ?", (command_id,))
+        return self._load_row(*rows[0]) if rows else None
+
+    def claim(self, commands, lease=LEASE_DURATION):
+        """
+        Захватывает команды для выполнения этим процессом
+
+        Проверка и запись аренды идут в одной транзакции (BEGIN IMMEDIATE),
+        поэтому два бота не могут захватить одну команду.
+
+        :param commands: Команды, которые бот собирается выполнить
+        :param lease: Срок аренды в секундах
+        :return: Список захваченных команд (актуальные версии из базы)
+        """
+        claimed = []
+        with self._transaction() as conn:
+            now = time.time()
+            for cmd in commands:
+                row = conn.execute("SELECT status, data FROM commands WHERE id = ?", (cmd.get("id"),)).fetchone()
+                if row is None or row[0] != "pending":
+                    continue
+                record = self._load_row(*row)
+                if lease_blocked_until(record, now):
+                    continue
+                record["lease_owner"] = CONSUMER_ID
+                record["lease_expires"] = now + lease
+                conn.execute("UPDATE commands SET data = ? WHERE id = ?",
+                             (json.dumps(record, ensure_ascii=False), record["id"]))
+                claimed.append(record)
+        return claimed
+
+    def update(self, commands):
+        """
+        Запоминает измененные команды. На диск они записываются одной транзакцией в commit()
+
+        :param commands: Список измененных команд
+        """
+        for cmd in commands:
+            if cmd.get("id"):
+                self._pending_updates[cmd["id"]] = cmd
+
+    def _delete_where(self, condition, params, archive):
+        """Удаляет команды по условию, предварительно перенося их в архив (в одной транзакции)"""
+        with self._transaction() as conn:
+            if archive is not None:
+                rows = conn.execute(f"SELECT status, data FROM commands WHERE {condition} ORDER BY seq",
+                                    params).fetchall()
+                archive.append([self._load_row(status, data) for status, data in rows])
+            return conn.execute(f"DELETE FROM commands WHERE {condition}", params).rowcount
+
+    def purge_finished(self, max_age, archive=None):
+        """
+        Удаляет выполненные и ошибочные команды старше max_age секунд
+
+        :param max_age: Возраст команды в секундах
+        :param archive: Архив (CommandArchive), куда переносятся удаляемые команды
+        :return: количество удаленных команд
+        """
+        return self._delete_where("status IN ('completed', 'error') AND timestamp <= ?",
+                                  (time.time() - max_age,), archive)
+
+    def commit(self):
+        """Записывает накопленные изменения статусов одной транзакцией"""
+        if not self._pending_updates:
+            return
+        updates, self._pending_updates = self._pending_updates, {}
+        # Команду, которую после истечения нашей аренды захватил другой бот, не перезаписываем
+        self._execute_many(
+            "UPDATE commands SET status = ?, timestamp = ?, data = ? "
+            "WHERE id = ? AND COALESCE(json_extract(data, '$.lease_owner'), ?) = ?",
+            [(cmd.get("status", "pending"), command_timestamp(cmd), json.dumps(cmd, ensure_ascii=False),
+              command_id, CONSUMER_ID, CONSUMER_ID) for command_id, cmd in updates.items()]
+        )
+
+    # ---------- Недоставленные команды ----------
+
+    def bury(self, commands):
+        """
+        Переводит команды в статус "dead"
+
+        :param commands: Список команд, исчерпавших попытки
+        """
+        if not commands:
+            return
+        now = time.time()
+        for cmd in commands:
+            release_lease(cmd)
+            cmd["status"] = "dead"
+            cmd["dead_at"] = now
+            self._pending_updates.pop(cmd.get("id"), None)
+        self._execute_many(
+            "UPDATE commands SET status = 'dead', data = ? WHERE id = ?",
+            [(json.dumps(cmd, ensure_ascii=False), cmd.get("id")) for cmd in commands]
+        )
+
+    def dead_letters(self):
+        """
+        Возвращает недоставленные команды
+
+        :return: Список команд
+        """
+        rows = self._query("SELECT status, data FROM commands WHERE status = 'dead' ORDER BY seq")
+        return [self._load_row(status, data) for status, data in rows]
+
+    def requeue_dead_letters(self, command_ids=None):
+        """
+        Возвращает недоставленные команды в очередь
+
+        :param command_ids: ID команд (None - все недоставленные)
+        :return: количество возвращенных команд
+        """
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT status, data FROM commands WHERE status = 'dead' ORDER BY seq").fetchall()
+            commands = [self._load_row(status, data) for status, data in rows]
+            selected = [cmd for cmd in commands if command_ids is None or cmd["id"] in command_ids]
+            depth = conn.execute("SELECT COUNT(*) FROM commands WHERE status = 'pending'").fetchone()[0]
+            room = max(0, MAX_QUEUE_DEPTH - depth)
+            for cmd in selected:
+                _revive_command(cmd)
+
+            # Сверх лимита команды возвращаются отложенными, как при переполнении
+            conn.executemany(
+                "UPDATE commands SET status = ?, timestamp = ?, data = ? WHERE id = ?",
+                [("pending" if index < room else "spilled", command_timestamp(cmd),
+                  json.dumps(cmd, ensure_ascii=False), cmd["id"]) for index, cmd in enumerate(selected)]
+            )
+        return len(selected)
+
+    # ---------- Обслуживание (check_bot_commands.py) ----------
+
+    def count_by_status(self):
+        """
+        Считает команды по статусам
+
+        :return: {статус: количество}
+        """
+        return dict(self._query("SELECT status, COUNT(*) FROM commands GROUP BY status"))
+
+    def pending_by_priority(self):
+        """
+        Считает ожидающие команды по полосам
+
+        :return: {полоса: количество}
+        """
+        counts = {lane: 0 for lane in PRIORITY_LANES}
+        rows = self._query("SELECT json_extract(data, '$.priority'), COUNT(*) FROM commands "
+                           "WHERE status = 'pending' GROUP BY 1")
+        for priority, count in rows:
+            counts[command_priority({"priority": priority})] += count
+        return counts
+
+    def release_expired_leases(self):
+        """
+        Снимает истекшие аренды и аренды завершившихся процессов
+
+        :return: количество освобожденных команд
+        """
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT status, data FROM commands WHERE status = 'pending' "
+                                "AND json_extract(data, '$.lease_owner') IS NOT NULL").fetchall()
+            now = time.time()
+            released = []
+            for row in rows:
+                cmd = self._load_row(*row)
+                if cmd["lease_owner"] != CONSUMER_ID and not lease_blocked_until(cmd, now):
+                    release_lease(cmd)
+                    released.append(cmd)
+            conn.executemany("UPDATE commands SET data = ? WHERE id = ?",
+                             [(json.dumps(cmd, ensure_ascii=False), cmd["id"]) for cmd in released])
+        return len(released)
+
+    def clear_finished(self, archive=None):
+        """
+        Удаляет все команды, кроме ожидающих выполнения, отложенных и недоставленных
+
+        :param archive: Архив (CommandArchive), куда переносятся удаляемые команды
+        :return: количество удаленных команд
+        """
+        return self._delete_where("status NOT IN ('pending', 'spilled', 'dead')", (), archive)
+
+    def import_commands(self, commands):
+        """
+        Переносит команды из файловой очереди (уже известные id пропускаются)
+
+        :param commands: Список команд
+        :return: количество перенесенных команд
+        """
+        if not commands:
+            return 0
+        return self._execute_many(
+            "INSERT OR IGNORE INTO commands (id, command, status, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+            [self._row(cmd) for cmd in commands]
+        )
+
+
+def migrate_file_queue_to_sqlite(db_file=BOT_COMMANDS_DB):
+    """
+    Переносит команды из bot_commands.json и непрочитанной части журнала в SQLite
+
+    :return: количество перенесенных команд
+    """
+    file_queue = FileCommandQueue()
+    # Дочитываем журнал; вместе с ожидающими переносим и историю выполненных команд
+    file_queue.fetch_pending()
+    imported = SqliteCommandQueue(db_file).import_commands(file_queue.all_commands())
+    # Журнал считается прочитанным: повторная миграция не создаст дублей
+    file_queue.commit()
+    logger.info(f"Перенесено {imported} команд из файловой очереди в {db_file}")
+    return imported
+
+
+_command_queue = None
+
+
+def get_command_queue():
+    """Возвращает общий для процесса экземпляр очереди команд выбранного хранилища"""
+    global _command_queue
+    if _command_queue is None:
+        if COMMAND_QUEUE_BACKEND == "sqlite":
+            _command_queue = SqliteCommandQueue()
+        else:
+            _command_queue = FileCommandQueue()
+        atexit.register(_command_queue.flush)
+    return _command_queue
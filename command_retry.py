@@ -0,0 +1,48 @@
+"""
+Повторные попытки выполнения команд бота
+
+Команда, завершившаяся временной ошибкой (сеть, сервер Telegram), не считается
+ошибочной сразу: бот возвращает ее в ожидание и повторяет с экспоненциально
+растущей задержкой со случайным разбросом (next_attempt_at). После
+MAX_COMMAND_ATTEMPTS попыток, а также при постоянной ошибке (бот заблокирован,
+чат не найден) команда переносится в хранилище недоставленных.
+"""
+import random
+import time
+
+# Максимальное количество попыток выполнения команды
+MAX_COMMAND_ATTEMPTS = 5
+# Задержка перед первым повтором (в секундах); каждая следующая вдвое больше
+RETRY_BASE_DELAY = 5
+# Максимальная задержка между попытками (в секундах)
+RETRY_MAX_DELAY = 600
+
+
+def retry_delay(attempt):
+    """
+    Возвращает задержку перед следующей попыткой
+
+    :param attempt: Номер неудачной попытки (с 1)
+    :return: задержка в секундах - от половины до полного экспоненциального шага
+    """
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    # Разброс не дает повторам после общего сбоя прийти в Telegram одной волной
+    return random.uniform(delay / 2, delay)
+
+
+def schedule_retry(cmd, now=None):
+    """
+    Возвращает ошибочную команду в ожидание следующей попытки
+
+    :param cmd: Команда со статусом "error"
+    :param now: Текущее время (по умолчанию - time.time())
+    :return: True если повтор запланирован, False если команду пора считать недоставленной
+    """
+    if cmd.get("retryable") is False or cmd.get("attempts", 0) >= MAX_COMMAND_ATTEMPTS:
+        return False
+
+    now = time.time() if now is None else now
+    cmd["status"] = "pending"
+    cmd["last_error"] = cmd.pop("error", None)
+    cmd["next_attempt_at"] = now + retry_delay(cmd.get("attempts", 1))
+    return True
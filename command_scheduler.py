@@ -0,0 +1,80 @@
+"""
+Расписание выполнения команд бота
+
+Команда может ждать момента отправки (send_at, задается производителем) или
+следующей попытки после ошибки (next_attempt_at). Бот держит ожидающие команды
+в min-heap по времени выполнения, поэтому выбирает готовые команды и узнает,
+сколько спать до ближайшей, не просматривая всю очередь. После перезапуска
+расписание восстанавливается из сохраненной очереди за один проход (heapify).
+Команду, захваченную другим ботом, бот откладывает до конца чужой аренды.
+"""
+import heapq
+import itertools
+import time
+
+from command_queue import lease_blocked_until
+
+
+def command_due_at(cmd):
+    """
+    Возвращает время, не раньше которого команду можно выполнять
+
+    :param cmd: Команда
+    :return: время (секунды с начала эпохи); 0 - выполнять сразу
+    """
+    due_at = 0.0
+    for key in ("send_at", "next_attempt_at"):
+        try:
+            due_at = max(due_at, float(cmd.get(key) or 0))
+        except (TypeError, ValueError):
+            continue
+    return max(due_at, lease_blocked_until(cmd))
+
+
+class CommandScheduler:
+    """Min-heap ожидающих команд по времени выполнения"""
+
+    def __init__(self):
+        self._heap = []
+        # Порядковый номер сохраняет порядок постановки для команд с одинаковым временем
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def rebuild(self, commands):
+        """
+        Перестраивает расписание по списку ожидающих команд за один проход
+
+        :param commands: Ожидающие команды в порядке постановки
+        """
+        self._heap = [(command_due_at(cmd), next(self._counter), cmd) for cmd in commands]
+        heapq.heapify(self._heap)
+
+    def push(self, cmd):
+        """Добавляет команду в расписание"""
+        heapq.heappush(self._heap, (command_due_at(cmd), next(self._counter), cmd))
+
+    def pop_due(self, now=None):
+        """
+        Извлекает команды, время выполнения которых наступило
+
+        :param now: Текущее время (по умолчанию - time.time())
+        :return: Список команд в порядке времени выполнения
+        """
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def next_delay(self, now=None):
+        """
+        Возвращает время до ближайшей команды
+
+        :return: задержка в секундах или None, если расписание пусто
+        """
+        if not self._heap:
+            return None
+        now = time.time() if now is None else now
+        return max(0.0, self._heap[0][0] - now)
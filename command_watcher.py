@@ -0,0 +1,156 @@
+"""
+Отслеживание изменений файлов очереди команд
+
+На Linux используется inotify (через ctypes, без внешних зависимостей): бот
+просыпается сразу после записи в журнал или bot_commands.json и не делает
+ничего, пока файлы не меняются. На остальных системах, а также если inotify
+недоступен, используется опрос os.stat с коротким интервалом.
+"""
+import os
+import sys
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import struct
+
+from atomic_write import file_token
+
+logger = logging.getLogger(__name__)
+
+# Интервал опроса файлов, если inotify недоступен (в секундах)
+POLL_INTERVAL = 0.5
+
+# Константы inotify из <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class CommandWatcher:
+    """Пробуждает потребителя очереди при изменении отслеживаемых файлов"""
+
+    def __init__(self, paths, poll_interval=POLL_INTERVAL):
+        """
+        :param paths: Пути к отслеживаемым файлам (должны лежать в одной директории)
+        :param poll_interval: Интервал опроса для резервного режима
+        """
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.poll_interval = poll_interval
+        self._names = {os.path.basename(path).encode() for path in self.paths}
+        self._event = asyncio.Event()
+        self._fd = None
+        self._loop = None
+        self._tokens = None
+        self.mode = "poll"
+
+        if sys.platform.startswith("linux"):
+            try:
+                self._init_inotify()
+                self.mode = "inotify"
+            except Exception as e:
+                logger.warning(f"inotify недоступен, используется опрос файлов: {e}")
+                self._fd = None
+
+        logger.info(f"Отслеживание очереди команд: режим {self.mode}")
+
+    def _init_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+        # Следим за директорией: файлы очереди могут создаваться и заменяться заново
+        directory = os.path.dirname(self.paths[0])
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, "inotify_add_watch")
+
+        self._fd = fd
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(fd, self._on_inotify_events)
+
+    def _on_inotify_events(self):
+        """Читает все накопившиеся события и будит ожидающего, если затронуты файлы очереди"""
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+
+            pos = 0
+            while pos + _EVENT_HEADER.size <= len(data):
+                _wd, _mask, _cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+                pos += _EVENT_HEADER.size
+                name = data[pos:pos + length].rstrip(b"\0")
+                pos += length
+                if name in self._names:
+                    changed = True
+
+        if changed:
+            self._event.set()
+
+    def notify(self):
+        """Будит ожидающего потребителя вручную (например, после записи из того же процесса)"""
+        self._event.set()
+
+    async def wait(self, timeout=None):
+        """
+        Ждет изменения файлов очереди
+
+        :param timeout: Максимальное время ожидания в секундах (None - без ограничения)
+        :return: True если файлы изменились, False если истек таймаут
+        """
+        if self._fd is not None:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+            self._event.clear()
+            return True
+
+        return await self._poll(timeout)
+
+    async def _poll(self, timeout):
+        """Резервный режим: сравнивает mtime и размер файлов с интервалом poll_interval"""
+        tokens = [file_token(path) for path in self.paths]
+        if self._tokens is None:
+            self._tokens = tokens
+
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while True:
+            if self._event.is_set():
+                self._event.clear()
+                self._tokens = tokens
+                return True
+            if tokens != self._tokens:
+                self._tokens = tokens
+                return True
+            if deadline is not None and loop.time() >= deadline:
+                return False
+
+            delay = self.poll_interval
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - loop.time()))
+            await asyncio.sleep(delay)
+            tokens = [file_token(path) for path in self.paths]
+
+    def close(self):
+        """Прекращает отслеживание"""
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
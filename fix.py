@@ -14,6 +14,9 @@ import logging
 import signal
 from datetime import datetime
 
+from atomic_write import copy_file_atomic, write_json_atomic
+from chat_store import chats_migrated, copy_chats
+
 # Настройка логирования для отслеживания проблем
 logging.basicConfig(
     level=logging.INFO,
@@ -39,10 +42,10 @@ def check_file_exists(filepath, default_content=None):
             os.makedirs(directory)
 
         if default_content is not None:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                if isinstance(default_content, (dict, list)):
-                    json.dump(default_content, f, ensure_ascii=False, indent=4)
-                else:
+            if isinstance(default_content, (dict, list)):
+                write_json_atomic(filepath, default_content)
+            else:
+                with open(filepath, 'w', encoding='utf-8') as f:
                     f.write(default_content)
         return False
     return True
@@ -97,7 +100,9 @@ def backup_file(filepath):
 
 def synchronize_file(src, dst):
     """Копирует файл из src в dst с созданием резервной копии"""
-    if not os.path.exists(src):
+    # Чаты бота после переноса хранятся в каталоге чатов (см. chat_store.py), а не в chats.json
+    chats = os.path.basename(src) == 'chats.json' and (chats_migrated(src) or chats_migrated(dst))
+    if not chats and not os.path.exists(src):
         logger.error(f"Исходный файл {src} не существует")
         return False
 
@@ -106,8 +111,11 @@ def synchronize_file(src, dst):
         if os.path.exists(dst):
             backup_file(dst)
 
-        # Копируем файл
-        shutil.copy2(src, dst)
+        # Копируем файл (атомарно: бот не увидит наполовину скопированный JSON)
+        if chats:
+            copy_chats(src, dst)
+        else:
+            copy_file_atomic(src, dst)
         logger.info(f"Успешно скопирован файл {src} -> {dst}")
         return True
     except Exception as e:
@@ -216,15 +224,15 @@ def repair_json_files():
         bot_file = os.path.join(BASE_DIR, filename)
         admin_file = os.path.join(ADMIN_DIR, filename)
 
-        # Проверяем файл в директории бота
-        check_file_exists(bot_file, default_structure)
-        if not check_json_file_valid(bot_file, default_structure):
-            logger.warning(f"Файл {bot_file} поврежден, создаю резервную копию и восстанавливаю")
-            if os.path.exists(bot_file):
-                backup_file(bot_file)
-            with open(bot_file, 'w', encoding='utf-8') as f:
-                json.dump(default_structure, f, ensure_ascii=False, indent=4)
-            repaired_count += 1
+        # Проверяем файл в директории бота (перенесенные чаты хранятся в каталоге чатов, см. chat_store.py)
+        if not (filename == 'chats.json' and chats_migrated(bot_file)):
+            check_file_exists(bot_file, default_structure)
+            if not check_json_file_valid(bot_file, default_structure):
+                logger.warning(f"Файл {bot_file} поврежден, создаю резервную копию и восстанавливаю")
+                if os.path.exists(bot_file):
+                    backup_file(bot_file)
+                write_json_atomic(bot_file, default_structure)
+                repaired_count += 1
 
         # Проверяем файл в директории админки
         check_file_exists(admin_file, default_structure)
@@ -232,8 +240,7 @@ def repair_json_files():
             logger.warning(f"Файл {admin_file} поврежден, создаю резервную копию и восстанавливаю")
             if os.path.exists(admin_file):
                 backup_file(admin_file)
-            with open(admin_file, 'w', encoding='utf-8') as f:
-                json.dump(default_structure, f, ensure_ascii=False, indent=4)
+            write_json_atomic(admin_file, default_structure)
             repaired_count += 1
 
     return repaired_count
@@ -245,8 +252,7 @@ def check_bot_commands():
 
     # Проверяем существование файла
     if not os.path.exists(bot_commands_file):
-        with open(bot_commands_file, 'w', encoding='utf-8') as f:
-            json.dump([], f, ensure_ascii=False, indent=4)
+        write_json_atomic(bot_commands_file, [])
         logger.info(f"Создан пустой файл команд бота")
         return True
 
@@ -255,8 +261,7 @@ def check_bot_commands():
         with open(bot_commands_file, 'r', encoding='utf-8') as f:
             content = f.read().strip()
             if not content:
-                with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                    json.dump([], f, ensure_ascii=False, indent=4)
+                write_json_atomic(bot_commands_file, [])
                 logger.info(f"Файл команд бота был пуст, создан пустой список")
                 return True
 
@@ -265,29 +270,23 @@ def check_bot_commands():
 
                 if not isinstance(commands, list):
                     backup_file(bot_commands_file)
-                    with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                        json.dump([], f, ensure_ascii=False, indent=4)
+                    write_json_atomic(bot_commands_file, [])
                     logger.info(f"Исправлена структура файла команд бота (не был списком)")
                     return True
 
-                # Проверяем зависшие команды
-                fixed = False
-                for cmd in commands:
-                    if cmd.get('status') == 'pending':
-                        cmd['timestamp'] = '0'  # Сбрасываем метку времени для ускорения обработки
-                        fixed = True
-
-                if fixed:
-                    with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                        json.dump(commands, f, ensure_ascii=False, indent=4)
-                    logger.info(f"Сброшены метки времени для зависших команд")
+                # Зависшие команды - это команды, захваченные упавшим ботом. Бот сам забирает
+                # их после истечения аренды, здесь аренды освобождаются сразу
+                from command_queue import get_command_queue
+                released = get_command_queue().release_expired_leases()
+
+                if released:
+                    logger.info(f"Освобождены аренды {released} зависших команд")
                     return True
 
                 return False
             except json.JSONDecodeError:
                 backup_file(bot_commands_file)
-                with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                    json.dump([], f, ensure_ascii=False, indent=4)
+                write_json_atomic(bot_commands_file, [])
                 logger.info(f"Файл команд бота был поврежден и восстановлен")
                 return True
     except Exception as e:
@@ -547,9 +546,11 @@ def diagnose():
         bot_file = os.path.join(BASE_DIR, filename)
         admin_file = os.path.join(ADMIN_DIR, filename)
 
-        if not os.path.exists(bot_file):
+        # Чаты бота после переноса хранятся в каталоге чатов (см. chat_store.py)
+        bot_file_used = not (filename == 'chats.json' and chats_migrated(bot_file))
+        if bot_file_used and not os.path.exists(bot_file):
             issues.append(f"Файл {filename} отсутствует в директории бота")
-        elif os.path.getsize(bot_file) == 0:
+        elif bot_file_used and os.path.getsize(bot_file) == 0:
             issues.append(f"Файл {filename} в директории бота пуст")
 
         if not os.path.exists(admin_file):
@@ -2,12 +2,28 @@ import asyncio
 import logging
 import json
 import os
+import sys
+import time
+import traceback
+from collections import deque
+from datetime import datetime
 from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.fsm.storage.memory import MemoryStorage
 
 from aiogram.types import WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton
 
 from handlers import setup_routers
+from command_archive import CommandArchive
+from command_ipc import CommandServer
+from command_queue import LEASE_DURATION, PRIORITY_BULK, command_priority, get_command_queue, release_lease
+from command_watcher import CommandWatcher
+from command_metrics import CommandMetrics
+from command_dispatcher import CommandDispatcher, get_command_chat
+from command_retry import schedule_retry
+from command_scheduler import CommandScheduler
+from command_coalescing import COALESCE_MESSAGES, coalesce_messages, spread_coalesced_result
+from command_handlers import BATCH_HANDLERS, COMMAND_HANDLERS, group_by_handler, mark_invalid
 
 def write_pid_file():
     """Записывает PID процесса в файл"""
@@ -27,133 +43,337 @@ async def main():
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
+# Максимальное время сна обработчика команд без изменений в очереди (в секундах)
+COMMANDS_IDLE_TIMEOUT = 60
+# Сколько получателей рассылки обрабатывается за один шаг
+BROADCAST_CHUNK_SIZE = 50
+# Как часто сохранять прогресс рассылки (в секундах)
+BROADCAST_CHECKPOINT_INTERVAL = 10
+# Сколько массовых команд выполняется в фоне за один раз (результат сохраняется после каждой части)
+BULK_COMMANDS_PER_CYCLE = 30
+
+
+# Функция для выполнения одной команды бота
+async def execute_bot_command(bot, cmd):
+    """Выполняет команду обработчиком ее типа и записывает в нее результат (status, completed_at, error)"""
+    cmd_type = cmd.get("command")
+    params = cmd.get("params", {})
+    print(f"Обработка команды: {cmd_type} с параметрами {params}")
+
+    handler = COMMAND_HANDLERS.get(cmd_type)
+    if handler is None:
+        mark_invalid(cmd, f"Unknown command: {cmd_type}")
+        print(f"Неизвестный тип команды: {cmd_type}")
+        return
+
+    try:
+        await handler(bot, cmd)
+    except TelegramRetryAfter:
+        raise
+    except Exception as e:
+        # Обновляем статус команды на "error"
+        cmd["status"] = "error"
+        cmd["error"] = str(e)
+        cmd["error_class"] = type(e).__name__
+        print(f"Ошибка при обработке команды {cmd_type}: {e}")
+        traceback.print_exc()
+
+
+# Функция для выполнения пачки команд одного типа
+async def execute_command_batch(bot, cmd_type, commands, dispatch):
+    """Выполняет команды одного типа пакетным обработчиком одним проходом"""
+    print(f"Обработка {len(commands)} команд {cmd_type} одной пачкой")
+    try:
+        await BATCH_HANDLERS[cmd_type](bot, commands, dispatch)
+    except Exception as e:
+        # Команды, до которых обработчик не дошел, будут повторены
+        for cmd in commands:
+            if cmd.get("status") not in ("completed", "error"):
+                cmd["status"] = "error"
+                cmd["error"] = str(e)
+                cmd["error_class"] = type(e).__name__
+        print(f"Ошибка при обработке команд {cmd_type}: {e}")
+        traceback.print_exc()
+
+
+def _record_broadcast_progress(progress, messages):
+    """Учитывает в прогрессе рассылки обработанные сообщения от начала части"""
+    for message in messages:
+        status = message.get("status")
+        # Сообщения после первого необработанного будут отправлены при продолжении рассылки
+        if status is None:
+            break
+        progress["position"] += 1
+        progress["sent" if status == "completed" else "failed"] += 1
+
+
+# Функция для выполнения рассылки как одного задания
+async def run_broadcast(cmd, dispatcher, queue):
+    """
+    Выполняет рассылку частями и периодически сохраняет прогресс в команде
+
+    Прогресс (position, sent, failed) хранится в самой команде, поэтому после
+    перезапуска бота рассылка продолжается с первого необработанного получателя.
+    """
+    params = cmd.get("params", {})
+    user_ids = [str(user_id) for user_id in params.get("user_ids", [])]
+    text = params.get("text")
+
+    progress = cmd.setdefault("progress", {"total": len(user_ids), "position": 0, "sent": 0, "failed": 0})
+    if progress["position"]:
+        print(f"Продолжение рассылки {cmd.get('id')} с получателя {progress['position']} из {progress['total']}")
+
+    messages = []
+    try:
+        if not text:
+            cmd["status"] = "error"
+            cmd["error"] = "Missing text"
+            cmd["error_class"] = "InvalidCommand"
+            return
+
+        last_checkpoint = time.monotonic()
+        while progress["position"] < len(user_ids):
+            chunk = user_ids[progress["position"]:progress["position"] + BROADCAST_CHUNK_SIZE]
+            messages = [{"command": "send_message", "params": {"user_id": user_id, "text": text},
+                         "priority": PRIORITY_BULK} for user_id in chunk]
+
+            # Сообщения рассылки делят лимиты Telegram с остальными командами
+            await dispatcher.dispatch(messages)
+            _record_broadcast_progress(progress, messages)
+            messages = []
+
+            if time.monotonic() - last_checkpoint >= BROADCAST_CHECKPOINT_INTERVAL:
+                # Продлеваем аренду, пока рассылка идет
+                cmd["lease_expires"] = time.time() + LEASE_DURATION
+                queue.update([cmd])
+                queue.commit()
+                last_checkpoint = time.monotonic()
+
+        cmd["status"] = "completed"
+        cmd["completed_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"Рассылка {cmd.get('id')} завершена: отправлено={progress['sent']}, ошибок={progress['failed']}")
+    finally:
+        # Сохраняем прогресс и при остановке бота, чтобы не отправлять сообщения повторно;
+        # прерванную рассылку сразу может продолжить другой бот
+        _record_broadcast_progress(progress, messages)
+        release_lease(cmd)
+        queue.update([cmd])
+        queue.commit()
+
 
 # Функция для проверки команд бота
 async def check_bot_commands(bot):
     """Проверяет наличие команд для бота и выполняет их"""
-    bot_commands_file = "bot_commands.json"
+    queue = get_command_queue()
+    metrics = CommandMetrics()
+    archive = CommandArchive()
+    # Бот просыпается по изменению файлов очереди, а не по таймеру
+    watcher = CommandWatcher(queue.watch_paths)
+    # Админка может отправлять команды через локальный канал: ответ сразу, бот просыпается без ожидания
+    server = CommandServer(queue, watcher.notify)
+    await server.start()
+
+    async def run_command(cmd):
+        if "id" in cmd:
+            cmd["attempts"] = cmd.get("attempts", 0) + 1
+        started_at = time.time()
+        metrics.record_started(cmd, started_at)
+        try:
+            await execute_bot_command(bot, cmd)
+        except TelegramRetryAfter:
+            # Повтор после паузы выполняет диспетчер - это продолжение той же попытки
+            if "id" in cmd:
+                cmd["attempts"] -= 1
+            raise
+        metrics.record_finished(cmd, started_at)
+
+    def give_up_command(cmd, started_at):
+        # Диспетчер пометил команду ошибкой после ответов RetryAfter - это одна неудачная попытка
+        if "id" in cmd:
+            cmd["attempts"] = cmd.get("attempts", 0) + 1
+        metrics.record_finished(cmd, started_at)
+
+    dispatcher = CommandDispatcher(run_command, on_give_up=give_up_command)
+
+    async def run_batch(cmd_type, commands):
+        started_at = time.time()
+        for cmd in commands:
+            cmd["attempts"] = cmd.get("attempts", 0) + 1
+            # Результат учитывается по отдельным запросам, которые обработчик передает диспетчеру
+            metrics.record_started(cmd, started_at)
+        await execute_command_batch(bot, cmd_type, commands, dispatcher.dispatch)
+    # Ожидающие команды по времени выполнения (send_at, next_attempt_at)
+    scheduler = CommandScheduler()
+    # Выполняющиеся рассылки: id команды -> задача
+    broadcasts = {}
+    # Массовые команды: выполняющиеся в фоне (id -> команда) и ждущие своей очереди
+    bulk_in_flight = {}
+    bulk_backlog = deque()
+    # Срочные команды: выполняющиеся в фоне (id -> команда) и ждущие, пока освободится их чат
+    interactive_in_flight = {}
+    interactive_backlog = deque()
+
+    async def run_commands(commands):
+        # Выполняем только команды, которые удалось захватить: остальные уже выполняет другой бот
+        commands = queue.claim(commands)
+        if not commands:
+            return
+
+        # Сообщения одному получателю отправляем одним сообщением
+        batch, merged = coalesce_messages(commands) if COALESCE_MESSAGES else (commands, [])
+        if merged:
+            print(f"Объединено {sum(len(members) for _, members in merged)} сообщений в {len(merged)}")
+
+        # Типы с пакетными обработчиками выполняются одной пачкой на тип, остальные - по одной;
+        # все запросы идут параллельно в пределах лимитов Telegram
+        single, batches = group_by_handler(batch)
+        await asyncio.gather(dispatcher.dispatch(single),
+                             *(run_batch(cmd_type, group) for cmd_type, group in batches.items()))
+        for merged_cmd, members in merged:
+            spread_coalesced_result(merged_cmd, members)
+
+        # Временные ошибки повторяем с растущей задержкой, остальное - в недоставленные
+        failed = [cmd for cmd in commands if cmd.get("status") == "error"]
+        dead = [cmd for cmd in failed if not schedule_retry(cmd)]
+        # Повтор может выполнить любой бот
+        for cmd in commands:
+            release_lease(cmd)
+        queue.update(commands)
+        if dead:
+            queue.bury(dead)
+            print(f"{len(dead)} команд перенесено в недоставленные")
+        for cmd in failed:
+            if cmd.get("status") == "pending":
+                scheduler.push(cmd)
+        # Результат сохраняем сразу: до сохранения команды снова считались бы ожидающими
+        queue.commit()
+        # Отвечаем тем, кто ждет результата по локальному каналу
+        server.resolve(commands)
+
+    def start_bulk(commands):
+        def on_done(task):
+            bulk_in_flight.clear()
+            if not task.cancelled() and task.exception() is not None:
+                print(f"Ошибка при выполнении массовых команд: {task.exception()}")
+            # Будим цикл, чтобы сохранить результат и взять следующую часть
+            watcher.notify()
+
+        for cmd in commands:
+            bulk_in_flight[cmd["id"]] = cmd
+        task = asyncio.create_task(run_commands(commands))
+        task.add_done_callback(on_done)
+
+    def start_interactive(commands):
+        def on_done(task):
+            for cmd in commands:
+                interactive_in_flight.pop(cmd["id"], None)
+            if not task.cancelled() and task.exception() is not None:
+                print(f"Ошибка при выполнении команд: {task.exception()}")
+            # Будим цикл, чтобы запустить команды, ждавшие освобождения своих чатов
+            watcher.notify()
+
+        for cmd in commands:
+            interactive_in_flight[cmd["id"]] = cmd
+        task = asyncio.create_task(run_commands(commands))
+        task.add_done_callback(on_done)
+
+    def take_ready_interactive():
+        """Забирает из очереди ожидания срочные команды чатов, в которых сейчас ничего не выполняется"""
+        busy = {get_command_chat(cmd) for cmd in interactive_in_flight.values()}
+        ready = []
+        held = []
+        for cmd in interactive_backlog:
+            chat_id = get_command_chat(cmd)
+            # Команды чата, где еще выполняются прежние, ждут их: порядок внутри чата сохраняется
+            if chat_id is not None and chat_id in busy:
+                held.append(cmd)
+            else:
+                ready.append(cmd)
+        interactive_backlog.clear()
+        interactive_backlog.extend(held)
+        return ready
+
+    def start_broadcast(cmd):
+        claimed = queue.claim([cmd])
+        if not claimed:
+            return
+        cmd = claimed[0]
+
+        def on_done(task):
+            broadcasts.pop(cmd["id"], None)
+            server.resolve([cmd])
+            # Прерванная рассылка останется в статусе pending и продолжится в следующем цикле
+            if not task.cancelled() and task.exception() is not None:
+                print(f"Ошибка при выполнении рассылки {cmd['id']}: {task.exception()}")
+
+        task = asyncio.create_task(run_broadcast(cmd, dispatcher, queue))
+        task.add_done_callback(on_done)
+        broadcasts[cmd["id"]] = task
+
+    refresh = True
 
-    while True:
-        if os.path.exists(bot_commands_file):
+    try:
+        while True:
             try:
-                # Проверяем, что файл не пустой
-                if os.path.getsize(bot_commands_file) == 0:
-                    # Создаем пустой массив в файле
-                    with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                        json.dump([], f)
-                    await asyncio.sleep(3)
-                    continue
-
-                # Пытаемся загрузить содержимое файла
-                with open(bot_commands_file, 'r', encoding='utf-8') as f:
-                    try:
-                        file_content = f.read()
-                        if not file_content.strip():
-                            commands = []
-                        else:
-                            commands = json.loads(file_content)
-                    except json.JSONDecodeError as e:
-                        print(f"Ошибка при разборе JSON: {e}")
-                        # Создаем резервную копию
-                        backup_file = f"{bot_commands_file}.bak.{int(time.time())}"
-                        shutil.copy2(bot_commands_file, backup_file)
-                        print(f"Создана резервная копия поврежденного файла: {backup_file}")
-                        # Создаем пустой массив в файле
-                        with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                            json.dump([], f)
-                        await asyncio.sleep(3)
-                        continue
-
-                # Обрабатываем команды со статусом "pending"
-                pending_commands = [cmd for cmd in commands if cmd.get("status") == "pending"]
-
-                if pending_commands:
-                    print(f"Найдено {len(pending_commands)} команд в очереди")
-
-                    # Обновляем команды - сначала копируем список
-                    updated_commands = commands.copy()
-
-                    # Обрабатываем каждую команду
-                    for cmd in pending_commands:
-                        cmd_type = cmd.get("command")
-                        params = cmd.get("params", {})
-                        print(f"Обработка команды: {cmd_type} с параметрами {params}")
-
-                        try:
-            if cmd_type == "send_message":
-                user_id = params.get("user_id")
-                text = params.get("text")
-
-                if user_id and text:
-                    print(f"Отправка сообщения пользователю {user_id}: {text[:30]}...")
-                    try:
-                        # Преобразуем user_id в целое число
-                        user_id_int = int(user_id)
-                        await bot.send_message(user_id_int, text)
-
-                        # Обновляем статус команды на "completed"
-                        cmd_index = commands.index(cmd)
-                        updated_commands[cmd_index]["status"] = "completed"
-                        updated_commands[cmd_index]["completed_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                        print(f"Сообщение успешно отправлено пользователю {user_id}")
-                    except Exception as e:
-                        # Обновляем статус команды на "error"
-                        cmd_index = commands.index(cmd)
-                        updated_commands[cmd_index]["status"] = "error"
-                        updated_commands[cmd_index]["error"] = f"Ошибка отправки: {str(e)}"
-                        print(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-                else:
-                    # Обновляем статус команды на "error"
-                    cmd_index = commands.index(cmd)
-                    updated_commands[cmd_index]["status"] = "error"
-                    updated_commands[cmd_index]["error"] = "Missing user_id or text"
-                    print(f"Отсутствует user_id или text в команде {cmd}")
+                if refresh:
+                    # Очередь изменилась: читаем новые записи журнала и перестраиваем расписание одним проходом
+                    bulk_backlog.clear()
+                    interactive_backlog.clear()
+                    pending = queue.fetch_pending()
+                    metrics.observe_pending(pending)
+                    scheduler.rebuild(cmd for cmd in pending
+                                      if cmd["id"] not in broadcasts and cmd["id"] not in bulk_in_flight
+                                      and cmd["id"] not in interactive_in_flight)
+
+                due_commands = scheduler.pop_due()
+
+                # Рассылки выполняются в фоне и не задерживают остальные команды
+                for cmd in due_commands:
+                    if cmd.get("command") == "broadcast" and cmd["id"] not in broadcasts:
+                        start_broadcast(cmd)
+                due_commands = [cmd for cmd in due_commands if cmd.get("command") != "broadcast"]
+
+                # Массовые команды выполняются в фоне частями и делят лимит Telegram со срочными по весам
+                bulk_backlog.extend(cmd for cmd in due_commands if command_priority(cmd) == PRIORITY_BULK)
+                if bulk_backlog and not bulk_in_flight:
+                    start_bulk([bulk_backlog.popleft() for _ in range(min(BULK_COMMANDS_PER_CYCLE, len(bulk_backlog)))])
+                due_commands = [cmd for cmd in due_commands if command_priority(cmd) != PRIORITY_BULK]
+
+                # Срочные команды тоже выполняются в фоне: пауза RetryAfter одного чата
+                # не задерживает команды остальных чатов до следующего цикла
+                interactive_backlog.extend(due_commands)
+                ready = take_ready_interactive()
+                if ready:
+                    print(f"Найдено {len(ready)} команд в очереди")
+                    start_interactive(ready)
+
+                # Переносим в архив команды со статусом "completed" или "error", которые старше 1 часа
+                removed = queue.purge_finished(3600, archive)
+                if removed:
+                    print(f"Перенесено в архив {removed} обработанных команд")
+
+                # Сохраняем статусы и смещение журнала одной записью за цикл
+                queue.commit()
+                metrics.save()
             except Exception as e:
-            # Обновляем статус команды на "error"
-            cmd_index = commands.index(cmd)
-            updated_commands[cmd_index]["status"] = "error"
-            updated_commands[cmd_index]["error"] = str(e)
-            print(f"Ошибка при обработке команды {cmd_type}: {e}")
-            import traceback
-            traceback.print_exc()
-
-            # Сохраняем обновленные статусы
-        try:
-            with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                json.dump(updated_commands, f, ensure_ascii=False, indent=4)
-            print("Статусы команд успешно обновлены")
-
-            # Очистка обработанных команд
-            # Удаляем команды со статусом "completed" или "error", которые старше 1 часа
-            now = time.time()
-            commands_to_keep = []
-            for cmd in updated_commands:
-                if cmd.get("status") == "pending":
-                    commands_to_keep.append(cmd)
-                elif cmd.get("status") in ["completed", "error"]:
-                    # Проверяем возраст команды
-                    cmd_time = float(cmd.get("timestamp", 0))
-                    if now - cmd_time < 3600:  # 1 час в секундах
-                        commands_to_keep.append(cmd)
-
-            # Если произошла очистка, сохраняем очищенный список
-            if len(commands_to_keep) < len(updated_commands):
-                with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                    json.dump(commands_to_keep, f, ensure_ascii=False, indent=4)
-                print(f"Очищено {len(updated_commands) - len(commands_to_keep)} обработанных команд")
-        except Exception as e:
-            print(f"Ошибка при сохранении обновленных статусов команд: {e}")
-            import traceback
-            traceback.print_exc()
-
-        except Exception as e:
-            print(f"Ошибка при обработке команд бота: {e}")
-            import traceback
-            traceback.print_exc()
-
-            # Проверяем каждые 3 секунды
-        await asyncio.sleep(3)
+                print(f"Ошибка при обработке команд бота: {e}")
+                traceback.print_exc()
+
+            # Спим до ближайшей запланированной команды или до изменения файлов очереди;
+            # раз в минуту просыпаемся для очистки старых команд
+            timeout = COMMANDS_IDLE_TIMEOUT
+            next_delay = scheduler.next_delay()
+            if next_delay is not None and next_delay < timeout:
+                timeout = next_delay
+            changed = await watcher.wait(timeout)
+            # Если проснулись только ради запланированной команды, очередь перечитывать не нужно
+            refresh = changed or timeout == COMMANDS_IDLE_TIMEOUT
+    finally:
+        for task in broadcasts.values():
+            task.cancel()
+        await server.close()
+        watcher.close()
+        metrics.save(force=True)
 
 
 async def main():
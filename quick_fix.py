@@ -12,6 +12,9 @@ import traceback
 import argparse
 from datetime import datetime
 
+from atomic_write import copy_file_atomic, write_json_atomic
+from chat_store import chats_migrated, copy_chats
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -65,8 +68,7 @@ def fix_file(file_path, default_structure):
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
         # Создаем файл с дефолтной структурой
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(default_structure, f, ensure_ascii=False, indent=4)
+        write_json_atomic(file_path, default_structure)
 
         logger.info(f"Создан новый файл: {file_path}")
         return True
@@ -75,8 +77,7 @@ def fix_file(file_path, default_structure):
         # Проверяем размер файла
         if os.path.getsize(file_path) == 0:
             # Файл пуст, записываем дефолтную структуру
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(default_structure, f, ensure_ascii=False, indent=4)
+            write_json_atomic(file_path, default_structure)
 
             logger.info(f"Исправлен пустой файл: {file_path}")
             return True
@@ -87,8 +88,7 @@ def fix_file(file_path, default_structure):
 
             if not content:
                 # Файл пуст, записываем дефолтную структуру
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(default_structure, f, ensure_ascii=False, indent=4)
+                write_json_atomic(file_path, default_structure)
 
                 logger.info(f"Исправлен пустой файл: {file_path}")
                 return True
@@ -100,16 +100,14 @@ def fix_file(file_path, default_structure):
                 # Проверяем тип данных
                 if isinstance(default_structure, list) and not isinstance(data, list):
                     # Неверный тип данных, записываем дефолтную структуру
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        json.dump(default_structure, f, ensure_ascii=False, indent=4)
+                    write_json_atomic(file_path, default_structure)
 
                     logger.info(f"Исправлен файл с неверным типом данных: {file_path}")
                     return True
 
                 if isinstance(default_structure, dict) and not isinstance(data, dict):
                     # Неверный тип данных, записываем дефолтную структуру
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        json.dump(default_structure, f, ensure_ascii=False, indent=4)
+                    write_json_atomic(file_path, default_structure)
 
                     logger.info(f"Исправлен файл с неверным типом данных: {file_path}")
                     return True
@@ -122,8 +120,7 @@ def fix_file(file_path, default_structure):
                 shutil.copy2(file_path, backup_file)
 
                 # Записываем дефолтную структуру
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(default_structure, f, ensure_ascii=False, indent=4)
+                write_json_atomic(file_path, default_structure)
 
                 logger.info(f"Исправлен поврежденный файл: {file_path} (резервная копия: {backup_file})")
                 return True
@@ -142,9 +139,11 @@ def fix_all_files():
     fixed_count = 0
 
     for filename in SYNC_FILES:
-        # Исправляем файл в директории бота
+        # Исправляем файл в директории бота (перенесенные чаты хранятся в каталоге чатов, см. chat_store.py)
         bot_file = os.path.join(BASE_DIR, filename)
-        if fix_file(bot_file, DEFAULT_STRUCTURES[filename]):
+        if filename == 'chats.json' and chats_migrated(bot_file):
+            pass
+        elif fix_file(bot_file, DEFAULT_STRUCTURES[filename]):
             fixed_count += 1
 
         # Исправляем файл в директории админки
@@ -167,8 +166,11 @@ def copy_files_from_bot_to_admin():
         bot_file = os.path.join(BASE_DIR, filename)
         admin_file = os.path.join(ADMIN_DIR, filename)
 
+        # Чаты бота после переноса хранятся в каталоге чатов (см. chat_store.py)
+        chats = filename == 'chats.json' and chats_migrated(bot_file)
+
         # Проверяем существование исходного файла
-        if not os.path.exists(bot_file):
+        if not chats and not os.path.exists(bot_file):
             logger.warning(f"Файл {bot_file} не существует")
             continue
 
@@ -180,7 +182,10 @@ def copy_files_from_bot_to_admin():
                 logger.info(f"Создана резервная копия файла админки: {backup_file}")
 
             # Копируем файл из бота в админку
-            shutil.copy2(bot_file, admin_file)
+            if chats:
+                copy_chats(bot_file, admin_file)
+            else:
+                copy_file_atomic(bot_file, admin_file)
             logger.info(f"Файл {filename} скопирован из бота в админку")
             copied_count += 1
         except Exception as e:
@@ -214,8 +219,11 @@ def copy_files_from_admin_to_bot():
                 shutil.copy2(bot_file, backup_file)
                 logger.info(f"Создана резервная копия файла бота: {backup_file}")
 
-            # Копируем файл из админки в бота
-            shutil.copy2(admin_file, bot_file)
+            # Копируем файл из админки в бота (чаты после переноса - в каталог чатов, см. chat_store.py)
+            if filename == 'chats.json' and chats_migrated(bot_file):
+                copy_chats(admin_file, bot_file)
+            else:
+                copy_file_atomic(admin_file, bot_file)
             logger.info(f"Файл {filename} скопирован из админки в бота")
             copied_count += 1
         except Exception as e:
@@ -356,8 +364,7 @@ def add_user_manually(user_id, user_type):
             if user_id not in users:
                 users.append(user_id)
 
-                with open(allowed_users_bot, 'w', encoding='utf-8') as f:
-                    json.dump(users, f, ensure_ascii=False, indent=4)
+                write_json_atomic(allowed_users_bot, users)
 
                 logger.info(f"Пользователь {user_id} добавлен в файл разрешенных пользователей бота")
 
@@ -369,8 +376,7 @@ def add_user_manually(user_id, user_type):
             if user_id not in users:
                 users.append(user_id)
 
-                with open(allowed_users_admin, 'w', encoding='utf-8') as f:
-                    json.dump(users, f, ensure_ascii=False, indent=4)
+                write_json_atomic(allowed_users_admin, users)
 
                 logger.info(f"Пользователь {user_id} добавлен в файл разрешенных пользователей админки")
 
@@ -396,8 +402,7 @@ def add_user_manually(user_id, user_type):
                     if user_id not in users:
                         users.append(user_id)
 
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            json.dump(users, f, ensure_ascii=False, indent=4)
+                        write_json_atomic(file_path, users)
 
                         logger.info(f"Пользователь {user_id} добавлен в файл {os.path.basename(file_path)} бота")
 
@@ -410,8 +415,7 @@ def add_user_manually(user_id, user_type):
                                 if user_id not in users:
                                     users.append(user_id)
 
-                                    with open(file_path, 'w', encoding='utf-8') as f:
-                                        json.dump(users, f, ensure_ascii=False, indent=4)
+                                    write_json_atomic(file_path, users)
 
                                     logger.info(
                                         f"Пользователь {user_id} добавлен в файл {os.path.basename(file_path)} админки")
@@ -461,8 +465,7 @@ def add_user_manually(user_id, user_type):
                             if user_id in users:
                                 users.remove(user_id)
 
-                                with open(bot_file, 'w', encoding='utf-8') as f:
-                                    json.dump(users, f, ensure_ascii=False, indent=4)
+                                write_json_atomic(bot_file, users)
 
                                 removed_from.append(f"{filename} (бот)")
 
@@ -475,8 +478,7 @@ def add_user_manually(user_id, user_type):
                             if user_id in users:
                                 users.remove(user_id)
 
-                                with open(admin_file, 'w', encoding='utf-8') as f:
-                                    json.dump(users, f, ensure_ascii=False, indent=4)
+                                write_json_atomic(admin_file, users)
 
                                 removed_from.append(f"{filename} (админка)")
 
@@ -501,8 +503,7 @@ def add_user_manually(user_id, user_type):
 
                 if not os.path.exists(bot_commands_file):
                     # Создаем пустой файл
-                    with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                        json.dump([], f)
+                    write_json_atomic(bot_commands_file, [], indent=None)
 
                     logger.info(f"Создан пустой файл команд бота: {bot_commands_file}")
                     return True
@@ -514,8 +515,7 @@ def add_user_manually(user_id, user_type):
 
                         if not content:
                             # Файл пуст, создаем пустой список
-                            with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                                json.dump([], f)
+                            write_json_atomic(bot_commands_file, [], indent=None)
 
                             logger.info(f"Файл команд бота был пуст, создан пустой список")
                             return True
@@ -525,55 +525,28 @@ def add_user_manually(user_id, user_type):
 
                             if not isinstance(commands, list):
                                 # Неверная структура, создаем пустой список
-                                with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                                    json.dump([], f)
+                                write_json_atomic(bot_commands_file, [], indent=None)
 
                                 logger.info(f"Исправлена структура файла команд бота (не был списком)")
                                 return True
 
-                            # Проверяем наличие зависших команд
-                            fixed_commands = False
-                            now = time.time()
-
-                            for cmd in commands:
-                                if cmd.get('status') == 'pending':
-                                    try:
-                                        # Проверяем возраст команды
-                                        cmd_time = float(cmd.get('timestamp', '0'))
-                                        if now - cmd_time > 300:  # 5 минут
-                                            cmd['timestamp'] = '0'
-                                            fixed_commands = True
-                                    except:
-                                        cmd['timestamp'] = '0'
-                                        fixed_commands = True
-
-                            # Если были исправления, сохраняем файл
-                            if fixed_commands:
-                                with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                                    json.dump(commands, f, ensure_ascii=False, indent=4)
-
-                                logger.info(f"Исправлены метки времени для зависших команд")
+                            # Зависшие команды - это команды, захваченные упавшим ботом. Бот сам забирает
+                            # их после истечения аренды, здесь аренды освобождаются сразу
+                            from command_archive import CommandArchive
+                            from command_queue import get_command_queue
+                            queue = get_command_queue()
+                            released = queue.release_expired_leases()
+
+                            if released:
+                                logger.info(f"Освобождены аренды {released} зависших команд")
                                 return True
 
-                            # Проверяем наличие устаревших команд
-                            old_commands = [cmd for cmd in commands if cmd.get('status') in ['completed', 'error']]
-                            if old_commands and len(old_commands) > 50:  # Если более 50 устаревших команд
-                                # Оставляем только команды со статусом pending и последние 10 завершенных
-                                pending_commands = [cmd for cmd in commands if cmd.get('status') == 'pending']
-                                recent_commands = sorted(
-                                    old_commands,
-                                    key=lambda x: float(x.get('timestamp', '0')),
-                                    reverse=True
-                                )[:10]
-
-                                # Обновляем список команд
-                                commands = pending_commands + recent_commands
-
-                                # Сохраняем обновленный список
-                                with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                                    json.dump(commands, f, ensure_ascii=False, indent=4)
-
-                                logger.info(f"Очищены устаревшие команды, оставлено {len(commands)} команд")
+                            # Устаревшие команды переносим в архив под блокировкой очереди
+                            counts = queue.count_by_status()
+                            if counts.get('completed', 0) + counts.get('error', 0) > 50:  # Если более 50 устаревших команд
+                                removed = queue.clear_finished(CommandArchive())
+
+                                logger.info(f"Перенесено в архив {removed} устаревших команд")
                                 return True
 
                             return False
@@ -583,8 +556,7 @@ def add_user_manually(user_id, user_type):
                             shutil.copy2(bot_commands_file, backup_file)
 
                             # Создаем пустой список
-                            with open(bot_commands_file, 'w', encoding='utf-8') as f:
-                                json.dump([], f)
+                            write_json_atomic(bot_commands_file, [], indent=None)
 
                             logger.info(
                                 f"Исправлен поврежденный файл команд бота, создана резервная копия: {backup_file}")
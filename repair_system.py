@@ -10,6 +10,9 @@ import logging
 import time
 import traceback
 from datetime import datetime
+
+from atomic_write import write_json_atomic
+from chat_store import chats_migrated
 import argparse
 
 # Настройка логирования
@@ -50,17 +53,13 @@ def check_file_exists(file_path):
 
         # Создаем пустой файл с соответствующей структурой
         if file_path.endswith(('admins.json', 'global_admins.json', 'allowed_users.json', 'streamers.json')):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump([], f, ensure_ascii=False, indent=4)
+            write_json_atomic(file_path, [])
         elif file_path.endswith(('user_stats.json', 'user_settings.json')):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False, indent=4)
+            write_json_atomic(file_path, {})
         elif file_path.endswith('chats.json'):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False, indent=4)
+            write_json_atomic(file_path, {})
         elif file_path.endswith('bot_commands.json'):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump([], f, ensure_ascii=False, indent=4)
+            write_json_atomic(file_path, [])
         else:
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write("")
@@ -102,17 +101,13 @@ def reset_json_file(file_path):
     """Сбрасывает JSON-файл к значениям по умолчанию"""
     try:
         if file_path.endswith(('admins.json', 'global_admins.json', 'allowed_users.json', 'streamers.json')):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump([], f, ensure_ascii=False, indent=4)
+            write_json_atomic(file_path, [])
         elif file_path.endswith(('user_stats.json', 'user_settings.json')):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False, indent=4)
+            write_json_atomic(file_path, {})
         elif file_path.endswith('chats.json'):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False, indent=4)
+            write_json_atomic(file_path, {})
         elif file_path.endswith('bot_commands.json'):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump([], f, ensure_ascii=False, indent=4)
+            write_json_atomic(file_path, [])
 
         logger.info(f"Файл {file_path} сброшен к значениям по умолчанию")
         return True
@@ -131,6 +126,10 @@ def check_and_repair_all_files():
     # Проверяем файлы в корневой директории
     for filename in SYNC_FILES:
         file_path = os.path.join(BASE_DIR, filename)
+        if filename == 'chats.json' and chats_migrated(file_path):
+            # Чаты бота перенесены в каталог чатов (см. chat_store.py), chats.json не создаем
+            logger.info(f"Файл {filename} не используется: чаты хранятся в каталоге чатов")
+            continue
         exists = check_file_exists(file_path)
 
         if exists:
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Хранилище данных бота в SQLite
+
+Вместо восьми JSON-файлов, каждый из которых читается и переписывается
+целиком, данные лежат в одной базе bot_data.db (режим WAL):
+
+  user_roles     - allowed_users, admins, global_admins, streamers (роль, user_id, порядок)
+  user_stats     - статистика по пользователям (user_id -> JSON)
+  user_settings  - настройки по пользователям (user_id -> JSON)
+  chats          - чаты поддержки (id чата -> JSON, user_id и статус вынесены в индекс)
+  commands       - очередь команд (SqliteCommandQueue, см. command_queue.py)
+
+Хранилище включается переменной окружения BOT_STORAGE_BACKEND=sqlite;
+SyncedDataStorage при этом работает с прежним API. Сохранение пишет только
+изменившиеся строки: хранилище помнит последнюю записанную или прочитанную
+версию каждого набора и сравнивает с ней то, что передал вызывающий. Номер
+версии набора (data_versions) растет при каждой записи, поэтому проверка
+"изменились ли данные" стоит одного запроса по первичному ключу.
+
+Существующие JSON-файлы переносятся в базу один раз: автоматически при первом
+запуске с пустой базой или вручную командой
+    python sqlite_storage.py --import [--force] [--no-commands]
+"""
+import os
+import sys
+import json
+import time
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Получаем абсолютный путь к текущей директории
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Общая база данных бота
+BOT_DATA_DB = os.path.join(BASE_DIR, "bot_data.db")
+# Хранилище данных: "json" (файлы) или "sqlite"
+STORAGE_BACKEND = os.environ.get("BOT_STORAGE_BACKEND", "json")
+
+# Файл данных -> набор в базе
+DATASET_FILES = {
+    "allowed_users.json": "allowed_users",
+    "admins.json": "admins",
+    "global_admins.json": "global_admins",
+    "streamers.json": "streamers",
+    "user_stats.json": "user_stats",
+    "user_settings.json": "user_settings",
+    "chats.json": "chats"
+}
+# Наборы-списки ролей (хранятся в user_roles)
+ROLE_DATASETS = ("allowed_users", "admins", "global_admins", "streamers")
+# Наборы-словари: набор -> таблица
+KEYED_DATASETS = {"user_stats": "user_stats", "user_settings": "user_settings", "chats": "chats"}
+
+
+def dataset_for_file(file_path):
+    """Возвращает набор данных для файла или None, если файл не переносится в базу"""
+    return DATASET_FILES.get(os.path.basename(file_path))
+
+
+class SqliteDataStore:
+    """Наборы данных бота в одной базе SQLite"""
+
+    def __init__(self, db_file=BOT_DATA_DB):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS user_roles (
+                role TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                PRIMARY KEY (role, user_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_user_roles_user ON user_roles (user_id);
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS user_settings (
+                user_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id TEXT PRIMARY KEY,
+                user_id TEXT,
+                status TEXT,
+                created_at TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_chats_user ON chats (user_id, status);
+            CREATE TABLE IF NOT EXISTS data_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS storage_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        # Последняя известная этому процессу версия набора и ее содержимое (копия для сравнения)
+        self._versions = {}
+        self._persisted = {}
+
+    @contextmanager
+    def _transaction(self, immediate=True):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _version(conn, name):
+        row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _bump_version(conn, name):
+        conn.execute("INSERT INTO data_versions (name, version) VALUES (?, 1) "
+                     "ON CONFLICT (name) DO UPDATE SET version = version + 1", (name,))
+
+    # ---------- Чтение ----------
+
+    def _read(self, conn, name):
+        """Читает набор: (данные для вызывающего, независимая копия для сравнения при записи)"""
+        if name in ROLE_DATASETS:
+            rows = conn.execute("SELECT user_id FROM user_roles WHERE role = ? ORDER BY position", (name,)).fetchall()
+            user_ids = [user_id for user_id, in rows]
+            return user_ids, dict.fromkeys(user_ids)
+
+        rows = conn.execute(f"SELECT rowid, * FROM {KEYED_DATASETS[name]} ORDER BY rowid").fetchall()
+        data = {}
+        persisted = {}
+        for row in rows:
+            key, text = row[1], row[-1]
+            # Второй разбор дает копию, которую вызывающий не изменит на месте
+            data[key] = json.loads(text)
+            persisted[key] = json.loads(text)
+        return data, persisted
+
+    def load(self, name):
+        """
+        Читает набор целиком
+
+        :param name: Набор ("admins", "user_stats", ...)
+        :return: список ID или словарь
+        """
+        with self._transaction(immediate=False) as conn:
+            version = self._version(conn, name)
+            data, self._persisted[name] = self._read(conn, name)
+        self._versions[name] = version
+        return data
+
+    def load_if_changed(self, name):
+        """
+        Читает набор, только если его записали после последней загрузки этим процессом
+
+        :param name: Набор
+        :return: данные или None, если набор не менялся
+        """
+        if name in self._versions:
+            with self._lock:
+                version = self._version(self._conn, name)
+            if version == self._versions[name]:
+                return None
+        return self.load(name)
+
+    # ---------- Запись ----------
+
+    def _write_roles(self, conn, name, user_ids):
+        old = self._persisted.get(name, {})
+        new = dict.fromkeys(str(user_id) for user_id in user_ids)
+        removed = [user_id for user_id in old if user_id not in new]
+        added = [user_id for user_id in new if user_id not in old]
+        if removed:
+            conn.executemany("DELETE FROM user_roles WHERE role = ? AND user_id = ?",
+                             [(name, user_id) for user_id in removed])
+        if added:
+            start = conn.execute("SELECT COALESCE(MAX(position), 0) FROM user_roles WHERE role = ?",
+                                 (name,)).fetchone()[0]
+            conn.executemany("INSERT OR IGNORE INTO user_roles (role, user_id, position) VALUES (?, ?, ?)",
+                             [(name, user_id, start + index + 1) for index, user_id in enumerate(added)])
+        self._persisted[name] = new
+        return len(removed) + len(added)
+
+    def _write_keyed(self, conn, name, data):
+        table = KEYED_DATASETS[name]
+        old = self._persisted.get(name, {})
+        data = {str(key): value for key, value in data.items()}
+        changed = {key: value for key, value in data.items() if key not in old or old[key] != value}
+        removed = [key for key in old if key not in data]
+        if removed:
+            conn.executemany(f"DELETE FROM {table} WHERE {'chat_id' if name == 'chats' else 'user_id'} = ?",
+                             [(key,) for key in removed])
+        rows = []
+        for key, value in changed.items():
+            text = json.dumps(value, ensure_ascii=False)
+            old[key] = json.loads(text)
+            if name == "chats":
+                details = value if isinstance(value, dict) else {}
+                user_id = details.get("user_id")
+                rows.append((key, None if user_id is None else str(user_id), details.get("status"),
+                             details.get("created_at"), text))
+            else:
+                rows.append((key, text))
+        if rows:
+            placeholders = ", ".join("?" * len(rows[0]))
+            conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", rows)
+        for key in removed:
+            del old[key]
+        self._persisted[name] = old
+        return len(removed) + len(rows)
+
+    def save(self, name, data):
+        """
+        Записывает изменения набора относительно последней известной версии
+
+        Строки, которые вызывающий не менял, не переписываются; изменения других
+        процессов, сделанные после нашей загрузки, сохраняются.
+
+        :param name: Набор
+        :param data: Новое содержимое (список ID или словарь)
+        :return: количество записанных и удаленных строк
+        """
+        if name in ROLE_DATASETS and not isinstance(data, list) or name in KEYED_DATASETS and not isinstance(data, dict):
+            raise ValueError(f"неверный тип данных для {name}: {type(data).__name__}")
+
+        try:
+            with self._transaction() as conn:
+                version = self._version(conn, name)
+                if name not in self._persisted:
+                    # Набор еще не читался: сравниваем с тем, что сейчас в базе
+                    _, self._persisted[name] = self._read(conn, name)
+                if name in ROLE_DATASETS:
+                    count = self._write_roles(conn, name, data)
+                else:
+                    count = self._write_keyed(conn, name, data)
+                if not count:
+                    return 0
+                self._bump_version(conn, name)
+        except Exception:
+            # Копия для сравнения могла измениться до отката - набор будет перечитан
+            self._versions.pop(name, None)
+            self._persisted.pop(name, None)
+            raise
+
+        # Если до записи набор никто не менял, в памяти вызывающего - ровно то, что теперь в базе
+        if self._versions.get(name) == version:
+            self._versions[name] = version + 1
+        return count
+
+    # ---------- Перенос из JSON-файлов ----------
+
+    def imported(self):
+        """True, если JSON-файлы уже переносились в базу"""
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM storage_meta WHERE key = 'imported_at'").fetchone() is not None
+
+    def import_files(self, file_paths, force=False):
+        """
+        Переносит JSON-файлы данных в базу одной транзакцией
+
+        :param file_paths: Пути к файлам (набор определяется по имени файла)
+        :param force: Переносить, даже если перенос уже выполнялся (наборы из файлов заменяются целиком)
+        :return: {набор: количество записей} или None, если перенос уже выполнялся
+        """
+        result = {}
+        with self._transaction() as conn:
+            # Проверка внутри транзакции: два одновременно запущенных бота не перенесут файлы дважды
+            if not force and conn.execute("SELECT 1 FROM storage_meta WHERE key = 'imported_at'").fetchone():
+                return None
+
+            for file_path in file_paths:
+                name = dataset_for_file(file_path)
+                if name is None or not os.path.exists(file_path):
+                    continue
+                try:
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    if name in ROLE_DATASETS:
+                        conn.execute("DELETE FROM user_roles WHERE role = ?", (name,))
+                        self._persisted[name] = {}
+                        self._write_roles(conn, name, data)
+                    else:
+                        conn.execute(f"DELETE FROM {KEYED_DATASETS[name]}")
+                        self._persisted[name] = {}
+                        self._write_keyed(conn, name, data)
+                except Exception as e:
+                    logger.error(f"Файл {file_path} не перенесен в базу: {e}")
+                    continue
+                self._bump_version(conn, name)
+                result[name] = len(data)
+
+            conn.execute("INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('imported_at', ?)",
+                         (str(time.time()),))
+        # Загруженные при переносе копии не соответствуют версиям - наборы будут перечитаны
+        self._versions.clear()
+        self._persisted.clear()
+        logger.info(f"Файлы данных перенесены в {self.db_file}: {result}")
+        return result
+
+
+def import_json_files(base_dir=BASE_DIR, db_file=BOT_DATA_DB, force=False, commands=True):
+    """
+    Переносит JSON-файлы данных и очередь команд в базу
+
+    :param base_dir: Каталог с JSON-файлами
+    :param db_file: База данных
+    :param force: Заменить наборы в базе содержимым файлов, даже если перенос уже выполнялся
+    :param commands: Перенести и очередь команд (bot_commands.json и журнал), если бот
+                     будет читать ее из SQLite (BOT_COMMANDS_BACKEND не задан как "json")
+    :return: {набор: количество записей}
+    """
+    result = SqliteDataStore(db_file).import_files(
+        [os.path.join(base_dir, filename) for filename in DATASET_FILES], force=force) or {}
+    if commands and os.environ.get("BOT_COMMANDS_BACKEND", "sqlite") != "sqlite":
+        # Очередь остается на файлах: перенесенные в базу команды никто бы не выполнил
+        logger.info("Очередь команд не переносится: BOT_COMMANDS_BACKEND задает файловую очередь")
+    elif commands:
+        from command_queue import migrate_file_queue_to_sqlite
+        # Туда же, откуда очередь будет читать бот при BOT_STORAGE_BACKEND=sqlite
+        result["commands"] = migrate_file_queue_to_sqlite(os.environ.get("BOT_COMMANDS_DB", db_file))
+    return result
+
+
+def main():
+    """Перенос JSON-файлов в базу из командной строки"""
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Хранилище данных бота в SQLite')
+    parser.add_argument('--import', dest='do_import', action='store_true',
+                        help='Перенести JSON-файлы данных и очередь команд в базу')
+    parser.add_argument('--force', action='store_true',
+                        help='Перенести заново, заменив наборы в базе содержимым файлов')
+    parser.add_argument('--no-commands', action='store_true', help='Не переносить очередь команд')
+    parser.add_argument('--db', default=BOT_DATA_DB, help='Путь к базе данных')
+    args = parser.parse_args()
+
+    if not args.do_import:
+        parser.print_help()
+        return 0
+
+    result = import_json_files(db_file=args.db, force=args.force, commands=not args.no_commands)
+    for name, count in result.items():
+        print(f"{name}: {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,19 +3,180 @@ import os
 import json
 import logging
 
+from atomic_write import GroupCommitWriter, file_token
+from chat_store import CHATS_STORAGE, ShardedChatStore, chats_dir_for, chats_migrated
+from sqlite_storage import STORAGE_BACKEND, SqliteDataStore, dataset_for_file
+
 logger = logging.getLogger(__name__)
 
+# Общая для всех хранилищ процесса групповая запись файлов
+_writer = GroupCommitWriter()
+
+# Биты ролей в маске, которую возвращает SyncedDataStorage.user_roles
+ROLE_USER = 1
+ROLE_ADMIN = 2
+ROLE_GLOBAL_ADMIN = 4
+ROLE_STREAMER = 8
+
+
+class RoleList(list):
+    """
+    Список ID пользователей одной роли с индексом для проверки "user_id in список" за O(1)
+
+    На диск сохраняется как обычный список (json.dump видит list), а оператор in
+    смотрит в словарь id -> число вхождений, который обновляется при каждом
+    изменении списка.
+    """
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self._rebuild()
+
+    def _rebuild(self):
+        self._index = {}
+        # Нехешируемые элементы (поврежденный файл) - проверяем принадлежность перебором, как раньше
+        self._linear = False
+        for item in self:
+            self._add(item)
+
+    def _add(self, item):
+        try:
+            self._index[item] = self._index.get(item, 0) + 1
+        except TypeError:
+            self._linear = True
+
+    def _discard(self, item):
+        try:
+            count = self._index.get(item, 0) - 1
+        except TypeError:
+            return
+        if count > 0:
+            self._index[item] = count
+        else:
+            self._index.pop(item, None)
+
+    def __contains__(self, item):
+        if self._linear:
+            return super().__contains__(item)
+        try:
+            return item in self._index
+        except TypeError:
+            return super().__contains__(item)
+
+    def __reduce__(self):
+        return RoleList, (list(self),)
+
+    def append(self, item):
+        super().append(item)
+        self._add(item)
+
+    def insert(self, position, item):
+        super().insert(position, item)
+        self._add(item)
+
+    def extend(self, items):
+        items = list(items)
+        super().extend(items)
+        for item in items:
+            self._add(item)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, count):
+        super().__imul__(count)
+        self._rebuild()
+        return self
+
+    def remove(self, item):
+        super().remove(item)
+        self._discard(item)
+
+    def pop(self, position=-1):
+        item = super().pop(position)
+        self._discard(item)
+        return item
+
+    def clear(self):
+        super().clear()
+        self._rebuild()
+
+    def __setitem__(self, key, value):
+        old = self[key]
+        if isinstance(key, slice):
+            value = list(value)
+            super().__setitem__(key, value)
+            for item in old:
+                self._discard(item)
+            for item in value:
+                self._add(item)
+        else:
+            super().__setitem__(key, value)
+            self._discard(old)
+            self._add(value)
+
+    def __delitem__(self, key):
+        old = self[key]
+        super().__delitem__(key)
+        for item in (old if isinstance(key, slice) else [old]):
+            self._discard(item)
+
+
+def _role_list(name):
+    """Атрибут хранилища, который держит список роли в RoleList при любом присваивании"""
+    attr = f"_{name}_list"
+
+    def getter(self):
+        return getattr(self, attr)
+
+    def setter(self, value):
+        # Не-список (например, поврежденный файл) оставляем как есть, чтобы не менять поведение
+        setattr(self, attr, RoleList(value) if isinstance(value, list) and not isinstance(value, RoleList) else value)
+
+    return property(getter, setter)
+
 
 class SyncedDataStorage(DataStorage):
     """Простая версия SyncedDataStorage, которая наследует все методы от DataStorage"""
 
+    # Списки ролей с индексом: "user_id in self.admins" и подобные проверки на каждом
+    # обновлении Telegram стоят O(1), а перезагрузка из файла сразу перестраивает индекс
+    allowed_users = _role_list("allowed_users")
+    admins = _role_list("admins")
+    global_admins = _role_list("global_admins")
+    streamers = _role_list("streamers")
+
+    _ROLES = (("allowed_users", ROLE_USER), ("admins", ROLE_ADMIN),
+              ("global_admins", ROLE_GLOBAL_ADMIN), ("streamers", ROLE_STREAMER))
+
     def __init__(self):
+        # Признаки файлов на момент последней загрузки: путь -> (inode, размер, mtime_ns)
+        self._file_tokens = {}
+        # Номера своих записей, еще не сверенных с файлом: путь -> номер
+        self._saved = {}
+        # При BOT_STORAGE_BACKEND=sqlite файлы данных заменяет одна база (см. sqlite_storage.py)
+        self._store = SqliteDataStore() if STORAGE_BACKEND == "sqlite" else None
+        # При BOT_CHATS_STORAGE=sharded чаты хранятся по файлу на чат (см. chat_store.py)
+        self._chat_store = None
         super().__init__()
+        if self._store is not None:
+            # При первом запуске переносим существующие JSON-файлы, затем читаем все из базы
+            self._store.import_files([self.user_file, self.admin_file, self.global_admin_file,
+                                      self.streamer_file, self.stats_file, self.settings_file,
+                                      self._chats_file()])
+            self._reload_all()
+        elif CHATS_STORAGE == "sharded" or chats_migrated(self._chats_file()):
+            # После переноса chats.json не используется, даже если BOT_CHATS_STORAGE не задана
+            chats_file = self._chats_file()
+            self._chat_store = ShardedChatStore(chats_dir_for(chats_file))
+            self._chat_store.migrate_from_json(chats_file)
+            self._reload_chats()
         logger.info("Инициализировано синхронизированное хранилище данных")
         # Все методы наследуются от базового класса
 
     def _reload_all(self):
-        """Перезагружает все данные из файлов"""
+        """Перезагружает из файлов данные, файлы которых изменились с прошлой загрузки"""
         self._reload_users()
         self._reload_admins()
         self._reload_global_admins()
@@ -24,65 +185,206 @@ class SyncedDataStorage(DataStorage):
         self._reload_settings()
         self._reload_chats()
 
+    def _save_to_file(self, file_path, data):
+        """
+        Сохраняет данные в файл атомарно (временный файл, fsync, rename)
+
+        Записи, сделанные в течение нескольких миллисекунд (например, три списка
+        в remove_user), уходят на диск одной пачкой в фоновом потоке. Поэтому
+        True означает, что данные приняты в запись, а не что они уже на диске:
+        кому нужна гарантия (изменение ролей), вызывает flush() после сохранения.
+
+        :return: True если данные приняты в запись, False если запись не удалась
+        """
+        try:
+            name = dataset_for_file(file_path) if self._store is not None else None
+            if name is not None:
+                # Пишутся только изменившиеся строки набора
+                self._store.save(name, data)
+                return True
+            if self._chat_store is not None and os.path.basename(file_path) == "chats.json":
+                # Переписываются только изменившиеся чаты, новые сообщения дописываются
+                self._chat_store.save_all(data)
+                return True
+            self._saved[file_path] = _writer.write(file_path, data)
+            # Прошлая запись файла не удалась: данные ждут повтора только в памяти
+            error = _writer.failed(file_path)
+            if error is not None:
+                logger.error(f"Файл {file_path} не записан на диск: {error}")
+                return False
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении файла {file_path}: {e}")
+            return False
+
+    def flush(self):
+        """
+        Дожидается записи на диск всех сохраненных данных
+
+        :return: True если все данные записаны, False если какие-то файлы записать не удалось
+        """
+        return _writer.flush()
+
+    def _reload_file(self, file_path, attr):
+        """
+        Перечитывает JSON-файл в атрибут, только если файл изменился с прошлой загрузки
+
+        Неизменный файл стоит одного вызова stat. Признак снимается до чтения:
+        если файл изменится во время чтения, он будет перечитан в следующий раз.
+
+        :param file_path: Путь к файлу
+        :param attr: Имя атрибута хранилища
+        :return: True если данные перечитаны
+        :raises Exception: при ошибке чтения или разбора (признак не запоминается)
+        """
+        name = dataset_for_file(file_path) if self._store is not None else None
+        if name is not None:
+            # Набор в базе: неизменный набор стоит одного запроса номера версии
+            data = self._store.load_if_changed(name)
+            if data is None:
+                return False
+            setattr(self, attr, data)
+            return True
+        # Пока своя запись не дошла до диска, данные в памяти новее файла
+        if _writer.pending(file_path):
+            return False
+        token = file_token(file_path)
+        if token is None:
+            return False
+        # На диске версия, которую записали мы сами, - перечитывать незачем
+        ticket = self._saved.pop(file_path, None)
+        if ticket is not None and _writer.committed(file_path) == (ticket, token):
+            self._file_tokens[file_path] = token
+        if self._file_tokens.get(file_path) == token:
+            return False
+        with open(file_path, 'r', encoding='utf-8') as f:
+            setattr(self, attr, json.load(f))
+        self._file_tokens[file_path] = token
+        return True
+
     def _reload_users(self):
         """Перезагружает список пользователей из файла"""
-        if os.path.exists(self.user_file):
-            try:
-                with open(self.user_file, 'r', encoding='utf-8') as f:
-                    self.allowed_users = json.load(f)
+        try:
+            if self._reload_file(self.user_file, "allowed_users"):
                 logger.debug(f"Перезагружены пользователи: {len(self.allowed_users)}")
-            except Exception as e:
-                logger.error(f"Ошибка при перезагрузке пользователей: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при перезагрузке пользователей: {e}")
 
     def _reload_admins(self):
         """Перезагружает список администраторов из файла"""
-        if os.path.exists(self.admin_file):
-            try:
-                with open(self.admin_file, 'r', encoding='utf-8') as f:
-                    self.admins = json.load(f)
+        try:
+            if self._reload_file(self.admin_file, "admins"):
                 logger.debug(f"Перезагружены администраторы: {len(self.admins)}")
-            except Exception as e:
-                logger.error(f"Ошибка при перезагрузке администраторов: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при перезагрузке администраторов: {e}")
 
     def _reload_global_admins(self):
         """Перезагружает список глобальных администраторов из файла"""
-        if os.path.exists(self.global_admin_file):
-            try:
-                with open(self.global_admin_file, 'r', encoding='utf-8') as f:
-                    self.global_admins = json.load(f)
+        try:
+            if self._reload_file(self.global_admin_file, "global_admins"):
                 logger.debug(f"Перезагружены глобальные администраторы: {len(self.global_admins)}")
-            except Exception as e:
-                logger.error(f"Ошибка при перезагрузке глобальных администраторов: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при перезагрузке глобальных администраторов: {e}")
 
     def _reload_streamers(self):
         """Перезагружает список стриммеров из файла"""
-        if os.path.exists(self.streamer_file):
-            try:
-                with open(self.streamer_file, 'r', encoding='utf-8') as f:
-                    self.streamers = json.load(f)
+        try:
+            if self._reload_file(self.streamer_file, "streamers"):
                 logger.debug(f"Перезагружены стриммеры: {len(self.streamers)}")
-            except Exception as e:
-                logger.error(f"Ошибка при перезагрузке стриммеров: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при перезагрузке стриммеров: {e}")
 
     def _reload_stats(self):
         """Перезагружает статистику пользователей из файла"""
-        if os.path.exists(self.stats_file):
-            try:
-                with open(self.stats_file, 'r', encoding='utf-8') as f:
-                    self.user_stats = json.load(f)
+        try:
+            if self._reload_file(self.stats_file, "user_stats"):
                 logger.debug(f"Перезагружена статистика пользователей")
-            except Exception as e:
-                logger.error(f"Ошибка при перезагрузке статистики: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при перезагрузке статистики: {e}")
 
     def _reload_settings(self):
         """Перезагружает настройки пользователей из файла"""
-        if os.path.exists(self.settings_file):
-            try:
-                with open(self.settings_file, 'r', encoding='utf-8') as f:
-                    self.user_settings = json.load(f)
+        try:
+            if self._reload_file(self.settings_file, "user_settings"):
                 logger.debug(f"Перезагружены настройки пользователей")
-            except Exception as e:
-                logger.error(f"Ошибка при перезагрузке настроек: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при перезагрузке настроек: {e}")
+
+    def _chats_file(self):
+        """Путь к файлу чатов (лежит рядом с остальными файлами данных)"""
+        return getattr(self, "chats_file", os.path.join(os.path.dirname(self.user_file), "chats.json"))
+
+    def _reload_chats(self):
+        """Перезагружает чаты; при хранении в SQLite - из базы, по файлу на чат - только изменившиеся"""
+        if self._store is None and self._chat_store is None:
+            return super()._reload_chats()
+        try:
+            if self._chat_store is not None:
+                if os.path.exists(self._chats_file()):
+                    # chats.json записан заново после переноса (например, синхронизацией с админкой):
+                    # переносим его чаты, иначе правки файла молча потерялись бы. Чаты, копии которых
+                    # в каталоге новее, остаются как есть (см. ShardedChatStore.migrate_from_json)
+                    self._chat_store.migrate_from_json(self._chats_file(), force=True)
+                chats = self._chat_store.load_if_changed(getattr(self, "chats", None))
+                if chats is not None:
+                    self.chats = chats
+                    logger.debug(f"Перезагружены чаты: {len(self.chats)}")
+            elif self._reload_file(self._chats_file(), "chats"):
+                logger.debug(f"Перезагружены чаты: {len(self.chats)}")
+        except Exception as e:
+            logger.error(f"Ошибка при перезагрузке чатов: {e}")
+
+    def append_chat_message(self, chat_id, message):
+        """
+        Добавляет сообщение в чат поддержки
+
+        При хранении по файлу на чат сообщение дописывается в файл своего чата,
+        остальные чаты не сериализуются.
+
+        :param chat_id: ID чата
+        :param message: Сообщение
+        :return: True если сообщение сохранено
+        """
+        chat_id = str(chat_id)
+        self._reload_chats()
+        chat = self.chats.get(chat_id)
+        if not isinstance(chat, dict):
+            logger.error(f"Чат {chat_id} не найден")
+            return False
+        chat.setdefault("messages", []).append(message)
+
+        if self._chat_store is None:
+            return self._save_to_file(self._chats_file(), self.chats)
+        try:
+            self._chat_store.append_message(chat_id, message)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении сообщения чата {chat_id}: {e}")
+            return False
+
+    def user_roles(self, user_id):
+        """
+        Возвращает роли пользователя битовой маской
+
+        :param user_id: ID пользователя
+        :return: комбинация ROLE_USER, ROLE_ADMIN, ROLE_GLOBAL_ADMIN, ROLE_STREAMER (0 - нет ролей)
+        """
+        user_id = str(user_id)
+        mask = 0
+        for name, role in self._ROLES:
+            if user_id in (getattr(self, name, None) or ()):
+                mask |= role
+        return mask
+
+    def has_role(self, user_id, role):
+        """
+        Проверяет, есть ли у пользователя хотя бы одна из ролей
+
+        :param user_id: ID пользователя
+        :param role: Бит роли или их комбинация
+        :return: True если роль есть
+        """
+        return bool(self.user_roles(user_id) & role)
 
     # Переопределяем методы для добавления/удаления с явным сохранением
 
@@ -100,6 +402,7 @@ class SyncedDataStorage(DataStorage):
             if user_id_str not in self.allowed_users:
                 self.allowed_users.append(user_id_str)
                 self._save_to_file(self.user_file, self.allowed_users)
+                self.flush()
                 print(f"Пользователь {user_id_str} успешно добавлен в allowed_users")
                 print(f"Обновленный список allowed_users: {self.allowed_users}")
                 return True
@@ -139,6 +442,9 @@ class SyncedDataStorage(DataStorage):
             logger.debug(f"SyncedDataStorage: Пользователь {user_id} удален из streamers")
             success = True
 
+        if success:
+            # Все списки уходят на диск одной пачкой, но удаление должно пережить перезапуск
+            self.flush()
         return success
 
     def add_admin(self, user_id):
@@ -157,6 +463,7 @@ class SyncedDataStorage(DataStorage):
 
             self.admins.append(user_id_str)
             self._save_to_file(self.admin_file, self.admins)
+            self.flush()
             print(f"Администратор {user_id_str} успешно добавлен")
             return True
 
@@ -174,6 +481,7 @@ class SyncedDataStorage(DataStorage):
         if user_id_str in self.admins:
             self.admins.remove(user_id_str)
             self._save_to_file(self.admin_file, self.admins)
+            self.flush()
             logger.debug(f"SyncedDataStorage: Администратор {user_id_str} успешно удален")
             return True
 
@@ -196,6 +504,7 @@ class SyncedDataStorage(DataStorage):
 
             self.streamers.append(user_id_str)
             self._save_to_file(self.streamer_file, self.streamers)
+            self.flush()
             print(f"Стриммер {user_id_str} успешно добавлен")
             return True
 
@@ -213,6 +522,7 @@ class SyncedDataStorage(DataStorage):
         if user_id_str in self.streamers:
             self.streamers.remove(user_id_str)
             self._save_to_file(self.streamer_file, self.streamers)
+            self.flush()
             logger.debug(f"SyncedDataStorage: Стриммер {user_id_str} успешно удален")
             return True
 
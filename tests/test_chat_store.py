@@ -0,0 +1,102 @@
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_store import MIGRATED_SUFFIX, ShardedChatStore, chats_dir_for, chats_migrated, copy_chats
+
+
+def make_chat(user_id, *texts, status="open"):
+    return {"user_id": user_id, "status": status, "created_at": "2024-01-01 10:00:00",
+            "messages": [{"from": "user", "text": text} for text in texts]}
+
+
+def write_chats(path, chats, age=0):
+    """Пишет chats.json; age - на сколько секунд файл старше текущего момента"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(chats, f, ensure_ascii=False)
+    if age:
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+
+def migrated_store(tmp_path):
+    """Каталог бота с перенесенными чатами 1 и 2"""
+    chats_file = str(tmp_path / "chats.json")
+    write_chats(chats_file, {"1": make_chat(10, "hi"), "2": make_chat(20, "hello")})
+    store = ShardedChatStore(chats_dir_for(chats_file))
+    assert store.migrate_from_json(chats_file) == 2
+    return chats_file, store
+
+
+def test_migrate_append_reload_copy_round_trip(tmp_path):
+    chats_file, store = migrated_store(tmp_path)
+    assert not os.path.exists(chats_file)
+    assert os.path.exists(chats_file + MIGRATED_SUFFIX)
+    assert chats_migrated(chats_file)
+
+    store.append_message("1", {"from": "admin", "text": "answer"})
+
+    # Другой процесс видит дописанное сообщение
+    chats = ShardedChatStore(chats_dir_for(chats_file)).load_if_changed()
+    assert [m["text"] for m in chats["1"]["messages"]] == ["hi", "answer"]
+    assert chats["2"] == make_chat(20, "hello")
+
+    # Копия для админки - обычный chats.json в своем каталоге
+    admin_dir = tmp_path / "admin"
+    admin_dir.mkdir()
+    admin_file = str(admin_dir / "chats.json")
+    assert copy_chats(chats_file, admin_file) == 2
+    with open(admin_file, encoding="utf-8") as f:
+        admin_chats = json.load(f)
+    assert admin_chats == chats
+
+    # Правки админки возвращаются в каталог чатов, chats.json не появляется
+    admin_chats["1"]["status"] = "closed"
+    admin_chats["3"] = make_chat(30, "new")
+    write_chats(admin_file, admin_chats)
+    assert copy_chats(admin_file, chats_file) == 3
+    assert not os.path.exists(chats_file)
+
+    chats = store.load_if_changed()
+    assert set(chats) == {"1", "2", "3"}
+    assert chats["1"]["status"] == "closed"
+    assert [m["text"] for m in chats["1"]["messages"]] == ["hi", "answer"]
+
+
+def test_stale_chats_json_does_not_replace_shards(tmp_path):
+    chats_file, store = migrated_store(tmp_path)
+    store.append_message("1", {"from": "admin", "text": "answer"})
+
+    # Администратор вернул старую копию chats.json: в ней нет ответа, зато есть удаленный позже чат
+    write_chats(chats_file, {"1": make_chat(10, "hi"), "2": make_chat(20, "hello"),
+                             "4": make_chat(40, "restored")}, age=3600)
+    assert store.migrate_from_json(chats_file, force=True) == 1
+
+    chats = ShardedChatStore(chats_dir_for(chats_file)).load_if_changed()
+    assert [m["text"] for m in chats["1"]["messages"]] == ["hi", "answer"]
+    assert chats["4"] == make_chat(40, "restored")
+
+    # Копия первого переноса не затерта, вернувшийся файл сохранен рядом
+    with open(chats_file + MIGRATED_SUFFIX, encoding="utf-8") as f:
+        assert "4" not in json.load(f)
+    backups = [name for name in os.listdir(tmp_path) if name.startswith("chats.json" + MIGRATED_SUFFIX + ".")]
+    assert len(backups) == 1
+    assert not os.path.exists(chats_file)
+
+
+def test_newer_chats_json_is_migrated_only_if_it_keeps_messages(tmp_path):
+    chats_file, store = migrated_store(tmp_path)
+    store.append_message("1", {"from": "user", "text": "answer"})
+    time.sleep(0.01)
+
+    # Чат 1 дописан другой программой поверх актуальной версии, в чате 2 сообщение потеряно
+    write_chats(chats_file, {"1": make_chat(10, "hi", "answer", "thanks", status="closed"),
+                             "2": make_chat(20, "other")})
+    assert store.migrate_from_json(chats_file, force=True) == 1
+
+    chats = ShardedChatStore(chats_dir_for(chats_file)).load_if_changed()
+    assert chats["1"] == make_chat(10, "hi", "answer", "thanks", status="closed")
+    assert chats["2"] == make_chat(20, "hello")
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from command_queue import FINISHED_TAIL_SIZE, FileCommandQueue, PRIORITY_BULK, release_lease
+
+
+def make_queue(tmp_path):
+    return FileCommandQueue(
+        state_file=str(tmp_path / "bot_commands.json"),
+        journal_file=str(tmp_path / "bot_commands.journal"),
+        offset_file=str(tmp_path / "bot_commands.offset"),
+        overflow_file=str(tmp_path / "bot_commands.overflow"),
+        stats_file=str(tmp_path / "bot_commands.queue_stats.json"),
+        lock_file=str(tmp_path / "bot_commands.lock"),
+        dead_letter_file=str(tmp_path / "bot_commands.dead"),
+        dedup_file=str(tmp_path / "bot_commands.dedup.json"),
+        finished_file=str(tmp_path / "bot_commands.finished"),
+    )
+
+
+def make_command(user_id, text, **fields):
+    return dict({"command": "send_message", "params": {"user_id": str(user_id), "text": text},
+                 "status": "pending", "timestamp": str(time.time())}, **fields)
+
+
+def run_cycle(queue, batch_size):
+    """Один цикл бота: прочитать журнал, захватить часть команд, выполнить, сохранить"""
+    pending = queue.fetch_pending()
+    commands = queue.claim(pending[:batch_size])
+    for cmd in commands:
+        cmd["status"] = "completed"
+        release_lease(cmd)
+    queue.update(commands)
+    queue.commit()
+    return len(commands)
+
+
+def test_state_file_stays_bounded_under_bulk_enqueue(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue([make_command(i, "x" * 100, priority=PRIORITY_BULK) for i in range(3000)], overflow="spill")
+
+    state_file = str(tmp_path / "bot_commands.json")
+    run_cycle(queue, 0)
+    initial_size = os.path.getsize(state_file)
+
+    written = 0
+    cycles = 0
+    while run_cycle(queue, 50):
+        written += os.path.getsize(state_file)
+        cycles += 1
+        # В bot_commands.json остаются только ожидающие команды: файл не растет по мере выполнения
+        assert os.path.getsize(state_file) <= initial_size
+        queue.purge_finished(3600)
+
+    assert cycles == 60
+    # Хвост выполненных команд тоже ограничен: лишнее уходит в архив при очистке
+    assert queue.count_by_status()["completed"] <= 2 * FINISHED_TAIL_SIZE
+    # Каждый цикл переписывает не больше очереди ожидающих (MAX_QUEUE_DEPTH), а не всю историю
+    assert written <= cycles * initial_size
+    assert os.path.getsize(state_file) < 16
+
+
+def test_finished_commands_stay_visible_until_purged(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue([make_command(1, "hi")])
+    run_cycle(queue, 10)
+
+    command_id = queue.all_commands()[0]["id"]
+    # Статус выполненной команды виден и другому процессу
+    assert make_queue(tmp_path).get(command_id)["status"] == "completed"
+
+    archived = []
+
+    class Archive:
+        def append(self, commands):
+            archived.extend(commands)
+
+    assert queue.purge_finished(0, Archive()) == 1
+    assert [cmd["id"] for cmd in archived] == [command_id]
+    assert make_queue(tmp_path).get(command_id) is None
+
+
+def test_finished_tail_is_compacted(tmp_path):
+    queue = make_queue(tmp_path)
+    for _ in range(3):
+        queue.enqueue([make_command(i, "x") for i in range(FINISHED_TAIL_SIZE)])
+        while run_cycle(queue, 500):
+            pass
+
+    assert queue.purge_finished(3600) == 2 * FINISHED_TAIL_SIZE
+    assert len(queue.all_commands()) == FINISHED_TAIL_SIZE
+
+
+def test_late_duplicate_of_finished_command_is_ignored(tmp_path):
+    queue = make_queue(tmp_path)
+    command = make_command(1, "hi", id="late")
+    queue.enqueue([dict(command)])
+    run_cycle(queue, 10)
+
+    # Производитель не дождался ответа бота и записал ту же команду напрямую
+    make_queue(tmp_path).enqueue([dict(command)])
+    assert queue.fetch_pending() == []
+    assert queue.get("late")["status"] == "completed"
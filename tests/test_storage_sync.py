@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+from collections import Counter
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# storage_sync наследует DataStorage бота; без пакета core проверять нечего
+pytest.importorskip("core.storage")
+
+from storage_sync import RoleList, SyncedDataStorage, _role_list
+
+
+class Roles:
+    """Минимальный держатель списков ролей: тот же дескриптор и та же перезагрузка из файла"""
+
+    admins = _role_list("admins")
+    streamers = _role_list("streamers")
+    _reload_file = SyncedDataStorage._reload_file
+
+    def __init__(self):
+        self._store = None
+        self._saved = {}
+        self._file_tokens = {}
+
+
+def assert_index_matches(roles):
+    """Индекс совпадает со списком, и оператор in отвечает так же, как перебор"""
+    assert roles._index == Counter(roles)
+    for item in set(roles) | {"missing"}:
+        assert (item in roles) == (item in list(roles))
+
+
+def test_index_follows_list_mutations():
+    roles = RoleList(["1", "2"])
+    assert_index_matches(roles)
+
+    roles.append("3")
+    roles.insert(0, "0")
+    roles.extend(str(i) for i in range(4, 6))
+    roles += ["6"]
+    assert_index_matches(roles)
+    assert "5" in roles and "6" in roles
+
+    roles.remove("2")
+    assert roles.pop() == "6"
+    del roles[0]
+    assert_index_matches(roles)
+    assert "2" not in roles and "6" not in roles and "0" not in roles
+
+    roles[1:3] = ["a", "b", "c"]
+    roles[0] = "z"
+    assert_index_matches(roles)
+    assert "z" in roles and "1" not in roles
+
+    del roles[::2]
+    assert_index_matches(roles)
+
+    roles *= 2
+    assert_index_matches(roles)
+
+    roles.clear()
+    assert_index_matches(roles)
+    assert "a" not in roles
+
+
+def test_duplicates_are_counted():
+    roles = RoleList(["1", "1", "2"])
+    roles.remove("1")
+    # Второе вхождение осталось в списке - значит, и в индексе
+    assert "1" in roles
+    roles.remove("1")
+    assert "1" not in roles
+    assert_index_matches(roles)
+
+
+def test_assignment_wraps_lists():
+    roles = Roles()
+    roles.admins = ["1", "2"]
+    assert isinstance(roles.admins, RoleList)
+    assert "2" in roles.admins
+
+    # Не-список (поврежденный файл) сохраняется как есть
+    roles.streamers = {"1": True}
+    assert roles.streamers == {"1": True}
+
+
+def test_membership_after_reload(tmp_path):
+    path = str(tmp_path / "admins.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(["1", "2"], f)
+
+    roles = Roles()
+    assert roles._reload_file(path, "admins")
+    roles.admins.append("3")
+    assert "3" in roles.admins
+
+    # Файл переписал другой процесс: после перезагрузки индекс строится по новому списку
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(["2", "40", "50"], f)
+    assert roles._reload_file(path, "admins")
+    assert isinstance(roles.admins, RoleList)
+    assert "1" not in roles.admins and "3" not in roles.admins
+    assert "40" in roles.admins
+    assert_index_matches(roles.admins)
+
+    roles.admins.remove("40")
+    assert "40" not in roles.admins
+    assert_index_matches(roles.admins)
+
+    # Неизменный файл не перечитывается, изменения в памяти остаются
+    assert not roles._reload_file(path, "admins")
+    assert "40" not in roles.admins